@@ -0,0 +1,149 @@
+""" Benchmark snapshot cycles against a synthetic fleet on an in-process fake EC2
+
+Each fleet size runs in its own process, so peak memory is per size.
+
+    python benchmark.py --volumes 100,1000,10000,50000 --latency 0.005 --throttle-rate 0.01
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import Queue
+import resource
+import time
+
+# boto wants credentials even though no request leaves the process
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+from ebs_snapshots import ebs_snapshots_daemon as daemon
+from ebs_snapshots import clients
+from ebs_snapshots.completion_tracker import CompletionTracker
+from ebs_snapshots.copy_queue import CopyQueue
+from simulation.fake_ec2 import FakeRegion, FakeClientRegistry, generate_fleet
+from ebs_snapshots.rate_limiter import RateLimiter
+from simulation.simulator import StaticConfig
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_benchmark(volumes, args):
+    """ Generate a fleet of the given size and time args.cycles cycles over it
+
+    :returns: list -- one dict of measurements per cycle
+    """
+    source, backup = 'us-west-1', 'us-east-1'
+    regions = {}
+    for name in (source, backup):
+        regions[name] = FakeRegion(
+            name, latency=args.latency, throttle_rate=args.throttle_rate, max_rps=args.max_rps,
+            copy_limit=args.copy_limit, completion_seconds=args.completion_seconds, seed=args.seed)
+    config = generate_fleet(regions[source], regions[backup], volumes, seed=args.seed)
+    target = daemon.Target(source, backup, StaticConfig(config), inventory_db=args.inventory_db)
+
+    clients.registry = FakeClientRegistry(regions, limiter=RateLimiter() if args.rate_limit else None)
+    # Not started: background polling would make call counts depend on timing
+    target.copy_queue = CopyQueue(target.ec2_backup_client(), max_in_flight=args.copy_limit)
+    target.completion_tracker = CompletionTracker(target.ec2_connection(), target.copy_queue.enqueue)
+
+    results = []
+    for cycle in range(1, args.cycles + 1):
+        for region in regions.values():
+            region.reset_stats()
+        error = None
+        start = time.time()
+        try:
+            daemon.create_snapshots(target, args.concurrency)
+        except Exception as e:
+            error = "{}: {}".format(type(e).__name__, e)
+        wall = time.time() - start
+
+        calls = {}
+        for name, region in regions.items():
+            for operation, count in region.calls.items():
+                calls["{}:{}".format(name, operation)] = count
+        results.append({
+            "volumes": volumes,
+            "cycle": cycle,
+            "wall_seconds": round(wall, 3),
+            "api_calls": sum(calls.values()),
+            "calls": calls,
+            "throttles": sum(r.throttles for r in regions.values()),
+            "copy_limit_errors": sum(r.copy_limit_errors for r in regions.values()),
+            "copies_queued": len(target.copy_queue),
+            "peak_rss_mb": round(_peak_rss_mb(), 1),
+            "error": error,
+        })
+    return results
+
+
+def _run_in_child(volumes, args, results):
+    results.put(run_benchmark(volumes, args))
+
+
+def _collect(volumes, child, results):
+    """ The child's results, or a single failure row if it died without any (e.g. out of memory) """
+    while True:
+        try:
+            return results.get(timeout=1)
+        except Queue.Empty:
+            if child.is_alive():
+                continue
+        # It may have put its results just before exiting
+        try:
+            return results.get_nowait()
+        except Queue.Empty:
+            failure = dict.fromkeys(("cycle", "wall_seconds", "api_calls", "throttles", "copy_limit_errors",
+                                     "copies_queued", "peak_rss_mb"), "-")
+            failure.update(volumes=volumes, calls={},
+                           error="benchmark process exited with code {}".format(child.exitcode))
+            return [failure]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--volumes', default='100,1000,10000,50000',
+                        help='comma-separated fleet sizes (default: %(default)s)')
+    parser.add_argument('--cycles', type=int, default=1, help='cycles per fleet size')
+    parser.add_argument('--concurrency', type=int, default=1, help='volumes processed in parallel')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per EC2 request')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='probability a request fails with RequestLimitExceeded')
+    parser.add_argument('--max-rps', type=int, default=0,
+                        help='requests per second per region before throttling (0 for no limit)')
+    parser.add_argument('--copy-limit', type=int, default=20, help='concurrent copies into the backup region')
+    parser.add_argument('--completion-seconds', type=float, default=0.0,
+                        help='seconds new snapshots stay pending')
+    parser.add_argument('--rate-limit', action='store_true', help="use the daemon's client-side rate limiter")
+    parser.add_argument('--inventory-db', help='inventory cache path (e.g. :memory:)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per cycle')
+    parser.add_argument('--log', action='store_true', help="show the daemon's logs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.log else logging.WARNING)
+
+    if not args.json:
+        print "{:>8} {:>5} {:>10} {:>10} {:>9} {:>11} {:>10}  {}".format(
+            "volumes", "cycle", "wall (s)", "API calls", "throttles", "copy limit", "peak MB", "error")
+    for volumes in [int(v) for v in args.volumes.split(',')]:
+        results = multiprocessing.Queue()
+        child = multiprocessing.Process(target=_run_in_child, args=(volumes, args, results))
+        child.start()
+        cycles = _collect(volumes, child, results)
+        child.join()
+        for result in cycles:
+            if args.json:
+                print json.dumps(result, sort_keys=True)
+            else:
+                print "{volumes:>8} {cycle:>5} {wall_seconds:>10} {api_calls:>10} {throttles:>9} " \
+                    "{copy_limit_errors:>11} {peak_rss_mb:>10}  {error}".format(
+                        **dict(result, error=result["error"] or ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,5 @@
-import jsonschema
-import kayvee
-import logging
+import kvlog
+import metrics
 
 schema = {
     "type": "object",
@@ -9,18 +8,40 @@ schema = {
             "max_snapshots": {"type": "number"},
             "interval": {"type": "string"},
             "name": {"type": "string"},
+            "exclude_boot_volume": {"type": "boolean"},
+            "skip_unchanged": {"type": "boolean"},
+            "retention": {
+                "type": "object",
+                "properties": dict((tier, {"type": "integer", "minimum": 0})
+                                   for tier in ("hourly", "daily", "weekly", "monthly", "yearly")),
+                "additionalProperties": False,
+            },
     },
     "additionalProperties": False,
 }
 
 
+_validator = None
+
+
+def _get_validator():
+    """ Validator for the schema, checked and built once rather than for every config item """
+    global _validator
+    if _validator is None:
+        import jsonschema
+        cls = jsonschema.validators.validator_for(schema)
+        cls.check_schema(schema)
+        _validator = cls(schema)
+    return _validator
+
+
 class BackupConfig:
 
     """
     Interface shared by backup configs
 
-    Config items are dicts, with key equal to the volume id mapped to a dict of
-    parameters
+    Config items are dicts, with key equal to the volume id (or a tag selector
+    or instance id, see discovery) mapped to a dict of parameters
 
     {
         "vol-1234567" : {
@@ -34,25 +55,41 @@ class BackupConfig:
     """
 
     path = None
+    # Last valid config, kept while the source can't be loaded. Replaced, never updated in place
+    config = {}
 
     @classmethod
     def _validate_config(cls, new_config):
         """ Raises exception if config loaded from file doesn't match expected schema """
         assert type(new_config) is dict
+        validator = _get_validator()
         for key, val in new_config.iteritems():
-            jsonschema.validate(val, schema)
+            validator.validate(val)
 
     def get(self):
         """ Get a dict of config items """
         try:
             new_config = self.refresh()
-            self._validate_config(new_config)
-            self.config = new_config
+            # refresh() hands back the same object while the source is unchanged
+            if new_config is not self.config:
+                self._validate_config(new_config)
+                self.config = new_config
         except Exception as e:
-            logging.warning(kayvee.formatLog("ebs-snapshots", "warning", "unable to load backup config", {"path": self.path, "error": str(e)}))
+            metrics.registry.inc('backup_config_errors_total')
+            kvlog.warning("unable to load backup config", {"path": self.path, "error": str(e)})
 
+        metrics.registry.set('backup_config_volumes', len(self.config))
         return self.config
 
+    def watch(self, callback):
+        """ Call callback as soon as the config source changes, if it can be
+        watched. Otherwise changes are only seen by calling get()
+
+        :returns: bool -- whether the source is watched
+        """
+        return False
+
     def refresh(self):
-      """ returns config dict, after being updated """
+      """ returns config dict, after being updated. Should return the same
+      object as long as the underlying config hasn't changed """
       raise NotImplementedError("refresh() must be implemented in subclasses")
@@ -0,0 +1,104 @@
+""" Long-lived AWS clients, created once per region and service and shared across cycles
+
+Each SDK is imported when its first client is created, so a process only pays
+for the SDKs it uses.
+"""
+import threading
+from rate_limiter import RateLimitedClient
+from metrics import InstrumentedClient
+
+""" Default HTTP connection pool size of boto3 clients """
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+""" EC2 API version for boto2 requests. boto2 defaults to 2014-10-01, which predates TagSpecification """
+EC2_API_VERSION = '2016-11-15'
+
+
+class ClientRegistry:
+
+    """
+    Creates each client on first use and hands out the same one afterwards,
+    so credentials, endpoints and TLS connections are reused
+
+    Clients are per region and AWS credentials profile (None for the default
+    credentials), so several accounts can be handled by one process.
+
+    EC2 clients are wrapped in a RateLimitedClient if a limiter is given,
+    with the SDKs' own retries turned off so it sees throttling. If
+    a metrics registry is given, every client records its calls there (rate
+    limiter waits aren't counted as call latency).
+    boto3 clients get max_pool_connections keep-alive connections, which
+    should be at least the number of worker threads using them.
+    """
+
+    def __init__(self, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS, limiter=None, metrics=None):
+        self.max_pool_connections = max_pool_connections
+        self.limiter = limiter
+        self.metrics = metrics
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._sessions = {}  # profile -> boto3 Session
+
+    def _get(self, key, create):
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = create()
+            return self._clients[key]
+
+    def _instrumented(self, client, service, region):
+        if self.metrics is None:
+            return client
+        return InstrumentedClient(client, self.metrics, service, region)
+
+    def _rate_limited(self, client, region, profile=None):
+        # Rate budgets and metrics are per account and region
+        scope = region if profile is None else '{}/{}'.format(profile, region)
+        client = self._instrumented(client, 'ec2', scope)
+        if self.limiter is None:
+            return client
+        return RateLimitedClient(client, self.limiter, scope)
+
+    def _boto3_client(self, service, region, profile=None, sdk_retries=True):
+        import boto3
+        from botocore.config import Config
+        # boto3 sessions aren't thread-safe, so clients are all created from
+        # one session per profile, under the registry lock
+        if profile not in self._sessions:
+            self._sessions[profile] = boto3.session.Session(profile_name=profile)
+        config = Config(max_pool_connections=self.max_pool_connections)
+        if not sdk_retries:
+            config = config.merge(Config(retries={'max_attempts': 0}))
+        return self._sessions[profile].client(service, region_name=region, config=config)
+
+    def ec2_connection(self, region, profile=None):
+        """ boto2 EC2 connection for a region """
+        from boto import ec2
+
+        def create():
+            connection = ec2.connect_to_region(region, api_version=EC2_API_VERSION, profile_name=profile)
+            if self.limiter is not None:
+                # The limiter retries, slowing down on throttling. boto's own
+                # retries would hide the throttling from it.
+                connection.num_retries = 0
+            return self._rate_limited(connection, region, profile)
+        return self._get(('boto-ec2', region, profile), create)
+
+    def ec2_client(self, region, profile=None):
+        """ boto3 EC2 client for a region """
+        return self._get(('ec2', region, profile), lambda: self._rate_limited(
+            self._boto3_client('ec2', region, profile, sdk_retries=self.limiter is None), region, profile))
+
+    def ebs_client(self, region, profile=None):
+        """ boto3 EBS direct APIs client for a region. Those have their own request limits """
+        scope = region if profile is None else '{}/{}'.format(profile, region)
+        return self._get(('ebs', region, profile), lambda: self._instrumented(
+            self._boto3_client('ebs', region, profile), 'ebs', scope))
+
+    def s3_connection(self):
+        """ boto2 S3 connection """
+        from boto import connect_s3
+        return self._get(('boto-s3', None), lambda: self._instrumented(connect_s3(), 's3', ''))
+
+
+""" Registry shared by the daemon and config loaders. Replaced by the daemon to size it for its workers """
+registry = ClientRegistry()
@@ -0,0 +1,136 @@
+""" Watch new snapshots and act as soon as they complete """
+import heapq
+import threading
+import time
+import kvlog
+
+""" Seconds before the first poll of a new snapshot, doubled after every poll that finds it pending """
+INITIAL_POLL_INTERVAL = 15
+MAX_POLL_INTERVAL = 600
+
+""" Max snapshot ids per describe call """
+POLL_BATCH_SIZE = 200
+
+
+class CompletionTracker:
+
+    """
+    Polls pending snapshots in the primary region and calls on_complete(volume,
+    snapshot_id, name) once each reaches "completed"
+
+    Each snapshot has its own poll interval, starting at INITIAL_POLL_INTERVAL
+    and doubling up to MAX_POLL_INTERVAL. All snapshots due for a poll are
+    described together.
+    """
+
+    def __init__(self, connection, on_complete, clock=time.time):
+        self.connection = connection
+        self.on_complete = on_complete
+        self._clock = clock
+        self._watched = {}  # snapshot id -> (volume, name, next poll time, poll interval)
+        # (next poll time, snapshot id), with entries left behind by later polls skipped when they come up
+        self._polls = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._watched)
+
+    def __contains__(self, snapshot_id):
+        with self._lock:
+            return snapshot_id in self._watched
+
+    def watch(self, snapshot_id, volume, name):
+        """ Start watching a pending snapshot. No-op if it is already watched """
+        with self._lock:
+            if snapshot_id in self._watched:
+                return
+            poll_time = self._clock() + INITIAL_POLL_INTERVAL
+            self._watched[snapshot_id] = (volume, name, poll_time, INITIAL_POLL_INTERVAL)
+            heapq.heappush(self._polls, (poll_time, snapshot_id))
+        self._wakeup.set()
+
+    def _drop_stale_polls(self):
+        """ Pop heap entries of snapshots no longer watched, or since rescheduled. Call with the lock held """
+        while self._polls:
+            poll_time, snapshot_id = self._polls[0]
+            watched = self._watched.get(snapshot_id)
+            if watched is not None and watched[2] == poll_time:
+                return
+            heapq.heappop(self._polls)
+
+    def next_poll_time(self):
+        """ Earliest time any watched snapshot is due for a poll, or None """
+        with self._lock:
+            self._drop_stale_polls()
+            return self._polls[0][0] if self._polls else None
+
+    def poll(self):
+        """ Describe the snapshots due for a poll and hand off the completed ones """
+        now = self._clock()
+        with self._lock:
+            due = []
+            self._drop_stale_polls()
+            while self._polls and self._polls[0][0] <= now:
+                due.append(heapq.heappop(self._polls)[1])
+                self._drop_stale_polls()
+
+        states = {}
+        try:
+            for i in range(0, len(due), POLL_BATCH_SIZE):
+                batch = due[i:i + POLL_BATCH_SIZE]
+                # A filter (rather than snapshot ids) doesn't fail if a snapshot has been deleted
+                for snapshot in self.connection.get_all_snapshots(filters={'snapshot-id': batch}):
+                    states[snapshot.id] = snapshot.status
+        except Exception:
+            # Still due, for the next poll
+            with self._lock:
+                for snapshot_id in due:
+                    heapq.heappush(self._polls, (self._watched[snapshot_id][2], snapshot_id))
+            raise
+
+        for snapshot_id in due:
+            state = states.get(snapshot_id)
+            with self._lock:
+                volume, name, _, interval = self._watched[snapshot_id]
+                if state == "pending":
+                    interval = min(interval * 2, MAX_POLL_INTERVAL)
+                    self._watched[snapshot_id] = (volume, name, now + interval, interval)
+                    heapq.heappush(self._polls, (now + interval, snapshot_id))
+                    continue
+                del self._watched[snapshot_id]
+
+            if state == "completed":
+                kvlog.info("snapshot completed", {
+                    "volume": volume.id,
+                    "snapshot": snapshot_id,
+                })
+                self.on_complete(volume, snapshot_id, name)
+            else:
+                kvlog.warning("snapshot did not complete", {
+                    "volume": volume.id,
+                    "snapshot": snapshot_id,
+                    "state": state,
+                })
+
+    def run_forever(self):
+        """ Sleep until the next snapshot is due for a poll (or a new one is watched), then poll """
+        while True:
+            next_poll = self.next_poll_time()
+            timeout = None if next_poll is None else max(next_poll - self._clock(), 0)
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+            try:
+                self.poll()
+            except Exception as e:
+                kvlog.error("could not poll pending snapshots", {
+                    "error": str(e)
+                })
+
+    def start(self):
+        """ Poll from a background thread """
+        thread = threading.Thread(target=kvlog.with_current_summary(self.run_forever))
+        thread.daemon = True
+        thread.start()
+        return thread
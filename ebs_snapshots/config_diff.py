@@ -0,0 +1,40 @@
+""" What changed between two versions of a backup config """
+
+
+class ConfigDiff:
+
+    """
+    Volume ids added to and removed from a config, and the ones whose
+    parameters (interval, max_snapshots, name, ...) changed, mapped to the
+    names of the parameters that did
+    """
+
+    def __init__(self, added, removed, changed):
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    def __repr__(self):
+        return 'ConfigDiff(added={!r}, removed={!r}, changed={!r})'.format(self.added, self.removed, self.changed)
+
+
+def diff(old, new):
+    """ Compare two configs, volume id -> backup parameters
+
+    :type old: dict
+    :type new: dict
+    :returns: ConfigDiff
+    """
+    if old is new:
+        return ConfigDiff([], [], {})
+    added = [volume_id for volume_id in new if volume_id not in old]
+    removed = [volume_id for volume_id in old if volume_id not in new]
+    changed = {}
+    for volume_id, params in new.iteritems():
+        previous = old.get(volume_id)
+        if previous is not None and previous != params:
+            changed[volume_id] = sorted(k for k in set(previous) | set(params) if previous.get(k) != params.get(k))
+    return ConfigDiff(added, removed, changed)
@@ -0,0 +1,149 @@
+""" Cross-region snapshot copies, started within AWS's concurrent copy limit """
+from collections import deque
+import threading
+import time
+import kvlog
+from inventory import get_tag
+import snapshot_manager
+
+""" AWS allows this many concurrent snapshot copies into a destination region """
+DEFAULT_COPY_LIMIT = 20
+
+""" Max snapshot ids per describe_snapshots filter """
+POLL_BATCH_SIZE = 200
+
+
+class CopyQueue:
+
+    """
+    Bounded window of in-flight snapshot copies to the backup region
+
+    Copies are queued by source snapshot id and started in order as slots in
+    the window free up. In-flight copies are tracked by polling their state
+    in batches. A copy that hits ResourceLimitExceeded goes back to the front
+    of the queue instead of being dropped. With a stagger, copies over its
+    copy cap stay queued until a later slice.
+
+    :type stagger: ebs_snapshots.stagger.Stagger
+    """
+
+    def __init__(self, backup_client, max_in_flight=DEFAULT_COPY_LIMIT, stagger=None):
+        self.backup_client = backup_client
+        self.max_in_flight = max_in_flight
+        self.stagger = stagger
+        self._queued = deque()  # (source snapshot id, volume, name)
+        self._queued_ids = set()
+        self._in_flight = {}  # copy snapshot id -> source snapshot id
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+
+    def __len__(self):
+        """ Number of copies queued or in flight """
+        with self._lock:
+            return len(self._queued) + len(self._in_flight)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    def enqueue(self, volume, snapshot_id, name):
+        """ Queue a copy of snapshot_id, starting it right away if there is room
+
+        :type volume: boto.ec2.volume.Volume
+        :param volume: Volume that snapshot is of
+        :type snapshot_id: str
+        :param snapshot_id: id of the snapshot to copy
+        :type name: str
+        :param name: a name to tag the copy with
+        """
+        with self._lock:
+            if snapshot_id in self._queued_ids or snapshot_id in self._in_flight.values():
+                return
+            self._queued.append((snapshot_id, volume, name))
+            self._queued_ids.add(snapshot_id)
+        kvlog.info("queued snapshot copy", {
+            "volume": volume.id,
+            "source_snapshot": snapshot_id,
+        })
+        self.start_queued()
+
+    def track_pending(self, inventory):
+        """ Count copies already pending in the backup region (e.g. from before a restart) against the window """
+        with self._lock:
+            for snapshot_infos in inventory.backup_snapshots.values():
+                for snapshot_info in snapshot_infos:
+                    if snapshot_info.get("State") == "pending":
+                        self._in_flight.setdefault(
+                            snapshot_info["SnapshotId"],
+                            get_tag(snapshot_info.get("Tags"), "source_snapshot"))
+
+    def start_queued(self):
+        """ Start queued copies until the window is full, the stagger's copy cap is hit or AWS pushes back """
+        with self._start_lock:
+            while True:
+                with self._lock:
+                    if not self._queued or len(self._in_flight) >= self.max_in_flight:
+                        return
+                    volume = self._queued[0][1]
+                if self.stagger is not None and not self.stagger.take('copy', volume.id):
+                    return
+                with self._lock:
+                    snapshot_id, volume, name = self._queued.popleft()
+                try:
+                    copy_id = snapshot_manager._copy_snapshot(
+                        self.backup_client, volume, snapshot_id, name, raise_on_limit=True)
+                except snapshot_manager.CopyLimitExceeded:
+                    with self._lock:
+                        self._queued.appendleft((snapshot_id, volume, name))
+                    return
+                with self._lock:
+                    self._queued_ids.discard(snapshot_id)
+                    if copy_id is not None:
+                        self._in_flight[copy_id] = snapshot_id
+
+    def poll(self):
+        """ Refresh the state of in-flight copies, then fill free slots from the queue """
+        with self._lock:
+            copy_ids = list(self._in_flight.keys())
+
+        states = {}
+        for i in range(0, len(copy_ids), POLL_BATCH_SIZE):
+            batch = copy_ids[i:i + POLL_BATCH_SIZE]
+            # A filter (rather than SnapshotIds) doesn't fail if a copy has disappeared
+            response = self.backup_client.describe_snapshots(
+                Filters=[{"Name": "snapshot-id", "Values": batch}])
+            for snapshot_info in response["Snapshots"]:
+                states[snapshot_info["SnapshotId"]] = snapshot_info["State"]
+
+        for copy_id in copy_ids:
+            state = states.get(copy_id)
+            if state == "pending":
+                continue
+            with self._lock:
+                source_snapshot_id = self._in_flight.pop(copy_id, None)
+            kvlog.info("snapshot copy finished", {
+                "snapshot_copy": copy_id,
+                "source_snapshot": source_snapshot_id,
+                "state": state,
+            })
+
+        self.start_queued()
+
+    def run_forever(self, poll_interval=30, sleep=time.sleep):
+        """ Poll while there is anything queued or in flight """
+        while True:
+            sleep(poll_interval)
+            if len(self):
+                try:
+                    self.poll()
+                except Exception as e:
+                    kvlog.error("could not poll snapshot copies", {
+                        "error": str(e)
+                    })
+
+    def start(self, poll_interval=30):
+        """ Poll from a background thread """
+        thread = threading.Thread(target=kvlog.with_current_summary(self.run_forever), args=(poll_interval,))
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -0,0 +1,187 @@
+""" Volumes selected in the backup config by EC2 filters, e.g. "tag:backup=daily", or by the instance they are attached to """
+import time
+from boto.ec2.volume import Volume
+from boto.exception import EC2ResponseError
+import kvlog
+import metrics
+import snapshot_manager
+
+""" Seconds a selector's matches are reused before it is described again """
+DEFAULT_DISCOVERY_INTERVAL = 900
+
+""" Page size for DescribeVolumes (AWS allows 5 to 500) """
+PAGE_SIZE = 500
+
+""" Instances described per DescribeInstances call (AWS allows 200 filter values) """
+INSTANCE_BATCH_SIZE = 200
+
+
+def is_selector(key):
+    """ Whether a config key selects volumes by filter rather than naming a volume id """
+    return key.startswith('tag:')
+
+
+def is_instance(key):
+    """ Whether a config key names an instance, whose volumes are snapshotted together """
+    return key.startswith('i-')
+
+
+def parse_selector(key):
+    """ "tag:backup=daily,tag:env=prod" -> {"tag:backup": ["daily"], "tag:env": ["prod"]}
+
+    :type key: str
+    :param key: comma separated name=value DescribeVolumes filters, the first one a tag filter
+    :returns: dict
+    """
+    filters = {}
+    for condition in key.split(','):
+        name, sep, value = condition.strip().partition('=')
+        if not sep or not name or not value:
+            raise ValueError("invalid volume selector {!r}: expected name=value".format(key))
+        filters.setdefault(name, []).append(value)
+    return filters
+
+
+def fetch_matching_volumes(connection, filters):
+    """ Page through the ids of volumes matching DescribeVolumes filters
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object for primary EBS region
+    :type filters: dict
+    :param filters: filter name -> list of values
+    """
+    params = {'MaxResults': PAGE_SIZE}
+    connection.build_filter_params(params, filters)
+    while True:
+        page = connection.get_list('DescribeVolumes', params, [('item', Volume)], verb='POST')
+        for volume in page:
+            yield volume.id
+        if not page.next_token:
+            return
+        params['NextToken'] = page.next_token
+
+
+def fetch_instance_volumes(connection, instance_ids):
+    """ EBS volumes attached to each instance
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object for primary EBS region
+    :type instance_ids: list
+    :returns: dict -- instance id -> list of (volume id, whether it is the root volume).
+        Instances that don't exist are left out.
+    """
+    attached = {}
+    for i in range(0, len(instance_ids), INSTANCE_BATCH_SIZE):
+        batch = instance_ids[i:i + INSTANCE_BATCH_SIZE]
+        for instance in connection.get_only_instances(filters={'instance-id': batch}):
+            mapping = instance.block_device_mapping or {}
+            attached[instance.id] = sorted(
+                (device.volume_id, name == instance.root_device_name)
+                for name, device in mapping.items() if device.volume_id)
+    return attached
+
+
+class DiscoveryIndex:
+
+    """
+    Volume ids matched by each selector in the config, and volumes attached
+    to each instance in it, each re-described once older than refresh_interval
+
+    Selectors are refreshed independently, so a new selector is resolved on
+    its first cycle without re-describing the others. Stale instances are
+    described together. If a refresh fails, the previous matches are kept.
+    """
+
+    def __init__(self, connection, refresh_interval=DEFAULT_DISCOVERY_INTERVAL, clock=time.time):
+        self.connection = connection
+        self.refresh_interval = refresh_interval
+        self._clock = clock
+        self._matches = {}  # selector -> (refreshed at, list of volume ids)
+        self._instances = {}  # instance id -> (refreshed at, list of (volume id, is root volume))
+        # (config, its length) last resolved, and its keys split into (selectors, instance ids, volume
+        # ids). Config sources hand back the same object while unchanged, so the split is only
+        # redone when the config is replaced or keys are added or removed.
+        self._resolved = None
+        self._keys = ([], [], [])
+
+    def matches(self, selector):
+        """ Volume ids matched by a selector, described if unknown or stale """
+        now = self._clock()
+        refreshed, volume_ids = self._matches.get(selector, (None, []))
+        if refreshed is not None and now - refreshed < self.refresh_interval:
+            return volume_ids
+        try:
+            volume_ids = list(fetch_matching_volumes(self.connection, parse_selector(selector)))
+        except EC2ResponseError as error:
+            snapshot_manager.log_aws_error(error)
+            return volume_ids
+        except ValueError as error:
+            kvlog.warning("invalid volume selector", {"selector": selector, "error": str(error)})
+            volume_ids = []
+        self._matches[selector] = (now, volume_ids)
+        metrics.registry.set('discovered_volumes', len(volume_ids), selector=selector)
+        kvlog.info("discovered volumes", {"selector": selector, "count": len(volume_ids)})
+        return volume_ids
+
+    def instance_volumes(self, instance_ids):
+        """ Volumes attached to each instance, describing the unknown or stale ones in one go
+
+        :returns: dict -- instance id -> list of (volume id, whether it is the root volume)
+        """
+        now = self._clock()
+        stale = [i for i in instance_ids
+                 if i not in self._instances or now - self._instances[i][0] >= self.refresh_interval]
+        if stale:
+            try:
+                attached = fetch_instance_volumes(self.connection, stale)
+            except EC2ResponseError as error:
+                snapshot_manager.log_aws_error(error)
+            else:
+                for instance_id in stale:
+                    volumes = attached.get(instance_id, [])
+                    self._instances[instance_id] = (now, volumes)
+                    if not volumes:
+                        kvlog.warning("no volumes attached to instance", {"instance": instance_id})
+                kvlog.info("discovered instance volumes", {"instances": len(stale)})
+        return dict((i, self._instances[i][1]) for i in instance_ids if i in self._instances)
+
+    def resolve(self, config):
+        """ Expand selectors and instances in a config to the volumes they match
+
+        Volume id keys are kept as they are and win over everything else. An
+        instance's volumes take its parameters plus "instance", so they can be
+        snapshotted together; its root volume is left out if
+        exclude_boot_volume is set. A volume matched by several selectors
+        takes the parameters of the first one in sorted order.
+
+        :type config: dict
+        :param config: volume id, selector or instance id -> backup parameters
+        :returns: dict -- volume id -> backup parameters
+        """
+        if self._resolved is None or self._resolved[0] is not config or self._resolved[1] != len(config):
+            selectors = sorted(key for key in config if is_selector(key))
+            instances = sorted(key for key in config if is_instance(key))
+            volume_ids = [key for key in config if not is_selector(key) and not is_instance(key)]
+            for selector in list(self._matches):
+                if selector not in config:
+                    del self._matches[selector]
+                    metrics.registry.remove('discovered_volumes', selector=selector)
+            for instance_id in list(self._instances):
+                if instance_id not in config:
+                    del self._instances[instance_id]
+            self._resolved, self._keys = (config, len(config)), (selectors, instances, volume_ids)
+        selectors, instances, volume_ids = self._keys
+        if not selectors and not instances:
+            return config
+
+        resolved = {}
+        for selector in selectors:
+            for volume_id in self.matches(selector):
+                resolved.setdefault(volume_id, config[selector])
+        for instance_id, volumes in sorted(self.instance_volumes(instances).items()):
+            params = dict(config[instance_id], instance=instance_id)
+            for volume_id, is_root in volumes:
+                if not (is_root and params.get('exclude_boot_volume')):
+                    resolved[volume_id] = params
+        resolved.update((volume_id, config[volume_id]) for volume_id in volume_ids)
+        return resolved
@@ -1,49 +1,608 @@
+import atexit
+import functools
 import time
 import os
-from file_backup_config import FileBackupConfig
-from s3_backup_config import S3BackupConfig
-from inline_backup_config import InlineBackupConfig
+import threading
+from inventory import build_inventory
+from inventory_store import InventoryStore, refresh_inventory, DEFAULT_FULL_REFRESH_INTERVAL
+from copy_queue import CopyQueue, DEFAULT_COPY_LIMIT
+from completion_tracker import CompletionTracker
+from rate_limiter import RateLimiter
+from clients import ClientRegistry, DEFAULT_MAX_POOL_CONNECTIONS
+import clients
+from scheduler import Scheduler
+import config_diff
+from discovery import DiscoveryIndex, DEFAULT_DISCOVERY_INTERVAL
+from sharding import DEFAULT_LEASE_TTL
+from stagger import Stagger, SLICE_SECONDS
+import metrics
+import kvlog
 import snapshot_manager
-from boto import ec2
-import boto3
-import kayvee
-import logging
+from boto.exception import EC2ResponseError
+from botocore.exceptions import ClientError
 
-aws_region = os.environ['AWS_REGION']
-aws_backup_region = os.environ['AWS_BACKUP_REGION']
-config_path = os.environ['BACKUP_CONFIG']
+aws_region = os.environ.get('AWS_REGION')
+aws_backup_region = os.environ.get('AWS_BACKUP_REGION')
+config_path = os.environ.get('BACKUP_CONFIG')
+targets_path = os.environ.get('TARGETS')
+concurrency = int(os.environ.get('CONCURRENCY', '1'))
+scheduler_mode = os.environ.get('SCHEDULER', 'interval')
+copy_limit = int(os.environ.get('COPY_LIMIT', DEFAULT_COPY_LIMIT))
+inventory_db = os.environ.get('INVENTORY_DB')
+full_refresh_interval = int(os.environ.get('FULL_REFRESH_INTERVAL', DEFAULT_FULL_REFRESH_INTERVAL))
+discovery_interval = int(os.environ.get('DISCOVERY_INTERVAL', DEFAULT_DISCOVERY_INTERVAL))
+metrics_port = os.environ.get('METRICS_PORT')
+metrics_address = os.environ.get('METRICS_ADDRESS', '127.0.0.1')
+shard_leases = os.environ.get('SHARD_LEASES')
+replica_id = os.environ.get('REPLICA_ID')
+lease_ttl = int(os.environ.get('LEASE_TTL', DEFAULT_LEASE_TTL))
+stagger_mode = os.environ.get('STAGGER')
+creates_per_minute = int(os.environ.get('CREATES_PER_MINUTE', '0'))
+copies_per_minute = int(os.environ.get('COPIES_PER_MINUTE', '0'))
+
+# Seconds to wait before re-checking a volume whose deadline has already passed
+MIN_RESCHEDULE_DELAY = 10
+
+# Seconds before a failed target's loop is restarted, doubled for every failure in a row
+TARGET_RETRY_DELAY = 30
+TARGET_MAX_RETRY_DELAY = 900
+
+# Shared by every cycle and worker, so total request rate stays under EC2
+# limits and slows down for everyone when EC2 pushes back. Buckets are per
+# account and region, so targets don't share budgets.
+rate_limiter = RateLimiter(metrics=metrics.registry)
+
+# Clients live for the whole process; enough pooled connections for every worker
+clients.registry = ClientRegistry(
+    max_pool_connections=max(concurrency, DEFAULT_MAX_POOL_CONNECTIONS), limiter=rate_limiter,
+    metrics=metrics.registry)
+
+""" Targets being processed, by name """
+targets = {}
+
+targets_schema = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "region": {"type": "string"},
+            "backup_region": {"type": "string"},
+            "config": {"type": "string"},
+            "profile": {"type": "string"},
+            "inventory_db": {"type": "string"},
+        },
+        "required": ["region", "backup_region", "config"],
+        "additionalProperties": False,
+    },
+}
+
+
+def _count_overdue():
+    now = time.time()
+    return sum(1 for target in targets.values() for newest, interval in target.volume_snapshots.values()
+               if newest is None or now - newest > interval)
+
+metrics.registry.describe('volume_snapshot_age_seconds', 'Seconds since the newest snapshot of a volume started')
+metrics.registry.describe('volumes_overdue', 'Volumes whose newest snapshot is older than their interval')
+metrics.registry.describe('target_failures_total', 'Times a target failed and was restarted')
+metrics.registry.set('volumes_overdue', _count_overdue)
 
 
 def get_backup_conf(path):
     """ Gets backup config from file or S3 """
+    # Imported here so only the kind of config in use is loaded (S3 needs boto)
     if path.startswith("s3://"):
+        from s3_backup_config import S3BackupConfig
         return S3BackupConfig(path)
     elif ":" in path:
         # config is YAML or JSON
+        from inline_backup_config import InlineBackupConfig
         return InlineBackupConfig(path)
     else:
+        from file_backup_config import FileBackupConfig
         return FileBackupConfig(path)
 
 
-def create_snapshots(backup_conf):
-    ec2_connection = ec2.connect_to_region(aws_region)
-    ec2_backup_client = boto3.client("ec2", region_name=aws_backup_region)
-    for volume, params in backup_conf.get().iteritems():
-        logging.info(kayvee.formatLog("ebs-snapshots", "info", "about to evaluate ebs snapshots for {} - {}".format(volume, params), data={}))
+class Target:
+
+    """
+    A source region, in an account, with the backup region its snapshots are
+    copied to and the config of its volumes
+
+    Holds everything that outlives a cycle: the copy queue, so copies that
+    don't fit in the window are retried, the completion tracker, so new
+    snapshots are copied as soon as they complete, the inventory cache and
+    the discovery index. Clients come from the shared registry, keyed by
+    profile and region. With a shard, only the volumes this replica owns
+    are processed. With a stagger, volumes are due at their own offset into
+    their interval and creates and copies are capped per minute.
+    """
+
+    def __init__(self, region, backup_region, backup_conf, profile=None, inventory_db=None, shard=None,
+                 stagger_slice=SLICE_SECONDS):
+        self.region = region
+        self.backup_region = backup_region
+        self.backup_conf = backup_conf
+        self.profile = profile
+        self.inventory_db = inventory_db
+        self.shard = shard
+        self.copy_queue = None
+        self.completion_tracker = None
+        self.inventory_store = None
+        self.discovery_index = None
+        self.summary = kvlog.CycleSummary()
+        # Set when the backup config source reports a change, see watch_config
+        self.config_changed = threading.Event()
+        self._watching_config = False
+        # Counts of the last cycle, as logged in its summary
+        self.last_counts = None
+        # Set for single runs: no background copy polling or completion tracking,
+        # the next run picks up whatever is left
+        self.oneshot = False
+        # volume id -> (newest snapshot start in epoch seconds or None, interval in seconds), as of
+        # the last cycle that processed the volume. Backs the snapshot age and overdue metrics.
+        self.volume_snapshots = {}
+        self.stagger = Stagger(creates_per_minute, copies_per_minute, stagger_slice) if stagger_mode else None
+        # What snapshot ages are measured against; simulations swap in a virtual clock
+        self.clock = time.time
+
+    @property
+    def name(self):
+        return self.region if self.profile is None else '{}/{}'.format(self.profile, self.region)
+
+    def ec2_connection(self):
+        return clients.registry.ec2_connection(self.region, self.profile)
+
+    def ec2_backup_client(self):
+        return clients.registry.ec2_client(self.backup_region, self.profile)
+
+    def ebs_client(self):
+        return clients.registry.ebs_client(self.region, self.profile)
+
+    def get_copy_queue(self):
+        """ The target's copy queue, started on first use unless oneshot """
+        if self.copy_queue is None:
+            self.copy_queue = CopyQueue(self.ec2_backup_client(), max_in_flight=copy_limit, stagger=self.stagger)
+            if not self.oneshot:
+                self.copy_queue.start()
+        return self.copy_queue
+
+    def get_completion_tracker(self):
+        """ The target's completion tracker, started on first use (None if oneshot). Completed snapshots go to
+        the copy queue """
+        if self.completion_tracker is None and not self.oneshot:
+            self.completion_tracker = CompletionTracker(self.ec2_connection(), self.get_copy_queue().enqueue)
+            self.completion_tracker.start()
+        return self.completion_tracker
+
+    def get_inventory_store(self):
+        """ The on-disk inventory cache, if the target has one """
+        if self.inventory_store is None and self.inventory_db:
+            self.inventory_store = InventoryStore(self.inventory_db)
+        return self.inventory_store
+
+    def get_discovery_index(self):
+        """ The index of volumes matched by config selectors """
+        if self.discovery_index is None:
+            self.discovery_index = DiscoveryIndex(self.ec2_connection(), discovery_interval)
+        return self.discovery_index
+
+    def get_config(self):
+        """ The backup config, with selectors expanded to the volumes they match, and limited to the shard """
+        config = self.get_discovery_index().resolve(self.backup_conf.get())
+        if self.shard is not None:
+            config = self.shard.filter(config)
+        return config
+
+    def watch_config(self):
+        """ Have the backup config source set config_changed as soon as it changes, if it can be watched """
+        if not self._watching_config:
+            self._watching_config = self.backup_conf.watch(self.config_changed.set)
+
+    def sleep_until_config_change(self, seconds):
+        """ Sleep for up to seconds, waking early if the watched backup config changes """
+        self.config_changed.wait(seconds)
+        self.config_changed.clear()
+
+    def owns(self, key):
+        """ Whether this replica still owns a volume or instance, which may change mid-cycle """
+        return self.shard is None or self.shard.owns(key)
+
+
+def load_targets(path=None, interval=None):
+    """ Targets from the TARGETS file, or the one given by AWS_REGION, AWS_BACKUP_REGION and BACKUP_CONFIG
+
+    The TARGETS file is a YAML or JSON list of targets, each with a region,
+    backup_region and config (a BACKUP_CONFIG value), and optionally a
+    profile (AWS credentials profile of the account) and inventory_db.
+
+    :type interval: int
+    :param interval: seconds between cycles in interval mode, None for single runs
+    :returns: list of Target
+    """
+    # A cycle takes its stagger slice's allowance at once: with one-minute slices,
+    # a five-minute cycle would create at a fifth of CREATES_PER_MINUTE
+    stagger_slice = SLICE_SECONDS
+    if interval is not None and scheduler_mode != 'deadline':
+        stagger_slice = max(SLICE_SECONDS, interval)
+    path = path or targets_path
+    if not path:
+        return [Target(aws_region, aws_backup_region, get_backup_conf(config_path), inventory_db=inventory_db,
+                       stagger_slice=stagger_slice)]
+    import jsonschema
+    import yaml
+    with open(path) as f:
+        entries = yaml.safe_load(f)
+    jsonschema.validate(entries, targets_schema)
+    loaded = [Target(e["region"], e["backup_region"], get_backup_conf(e["config"]),
+                     profile=e.get("profile"), inventory_db=e.get("inventory_db"), stagger_slice=stagger_slice)
+              for e in entries]
+    names = [t.name for t in loaded]
+    if len(set(names)) != len(names):
+        raise ValueError("TARGETS lists a profile and region more than once")
+    return loaded
+
+
+def _record_cycle(target, config, inventory, duration):
+    """ Record cycle timing and the newest snapshot of each volume processed """
+    metrics.registry.observe('cycle_duration_seconds', duration, buckets=metrics.CYCLE_BUCKETS, target=target.name)
+    metrics.registry.set('last_cycle_timestamp_seconds', time.time(), target=target.name)
+    metrics.registry.set('cycle_volumes', len(config), target=target.name)
+    if inventory is None:
+        metrics.registry.inc('cycle_errors_total', target=target.name)
+        return
+
+    for volume_id, params in config.iteritems():
+        interval = snapshot_manager.INTERVAL_SECONDS.get(params.get('interval', 'daily'))
+        if volume_id not in inventory.volumes or interval is None:
+            continue
+        newest = snapshot_manager.newest_start(inventory.snapshot_index(volume_id))
+        target.volume_snapshots[volume_id] = (newest, interval)
+        if newest is not None:
+            metrics.registry.set('volume_newest_snapshot_timestamp_seconds', newest, volume=volume_id)
+            metrics.registry.set('volume_snapshot_age_seconds', _seconds_since(newest), volume=volume_id)
+
+
+def _seconds_since(timestamp):
+    """ Gauge value that is the age of timestamp when read """
+    return lambda: time.time() - timestamp
+
+
+def _forget_volume(target, volume_id):
+    """ Drop the metrics of a volume that is no longer configured """
+    target.volume_snapshots.pop(volume_id, None)
+    metrics.registry.remove('volume_newest_snapshot_timestamp_seconds', volume=volume_id)
+    metrics.registry.remove('volume_snapshot_age_seconds', volume=volume_id)
+
+
+def _process_volumes(target, config, concurrency=concurrency):
+    """ Ensure snapshots for the given config items, and record the cycle's metrics
+
+    :returns: SnapshotInventory -- as updated by this cycle, or None if it could not be fetched
+    """
+    kvlog.use_summary(target.summary)
+    start = time.time()
+    inventory = _snapshot_volumes(target, config, concurrency)
+    duration = time.time() - start
+    _record_cycle(target, config, inventory, duration)
+    target.last_counts = target.summary.flush(
+        {"target": target.name, "volumes": len(config), "duration_seconds": round(duration, 3)})
+    return inventory
+
+
+def _snapshot_volumes(target, config, concurrency=concurrency):
+    """ Ensure snapshots for the given config items
+
+    :type target: Target
+    :type config: dict
+    :param config: volume id -> backup parameters
+    :type concurrency: int
+    :param concurrency: number of volumes to process in parallel
+    :returns: SnapshotInventory -- as updated by this cycle, or None if it could not be fetched
+    """
+    ec2_connection = target.ec2_connection()
+    ec2_backup_client = target.ec2_backup_client()
+
+    # One bulk fetch of volumes and snapshots, shared by every volume this cycle
+    store = target.get_inventory_store()
+    try:
+        if store is not None:
+            inventory = refresh_inventory(
+                store, ec2_connection, ec2_backup_client, config.keys(), full_refresh_interval)
+        else:
+            inventory = build_inventory(ec2_connection, ec2_backup_client, config.keys())
+    except (EC2ResponseError, ClientError) as error:
+        snapshot_manager.log_aws_error(error)
+        return None
+    # Snapshot ages are measured from when processing starts, not from before the fetch
+    inventory.now = target.clock()
+    queue = target.get_copy_queue()
+    queue.track_pending(inventory)
+    tracker = target.get_completion_tracker()
+
+    def process_volume(volume, params):
+        if not target.owns(volume):
+            kvlog.debug("volume moved to another replica", {"volume": volume})
+            return
+        kvlog.debug("evaluating volume", dict(params, volume=volume))
         interval = params.get('interval', 'daily')
         max_snapshots = params.get('max_snapshots', 0)
         name = params.get('name', '')
+        ebs_client = _ebs_client(target, params)
         snapshot_manager.run(
-            ec2_connection, ec2_backup_client, volume, interval, max_snapshots, name)
+            ec2_connection, ec2_backup_client, volume, interval, max_snapshots, name,
+            inventory=inventory, copy_queue=queue, completion_tracker=None if ebs_client else tracker,
+            ebs_client=ebs_client, retention=params.get('retention'), stagger=target.stagger)
+
+    def process_instance(instance_id, volume_ids, params):
+        if not target.owns(instance_id):
+            kvlog.debug("instance moved to another replica", {"instance": instance_id})
+            return
+        kvlog.debug("evaluating instance", dict(params, volumes=volume_ids))
+        ebs_client = _ebs_client(target, params)
+        snapshot_manager.run_instance(
+            ec2_connection, ec2_backup_client, instance_id, volume_ids, params.get('interval', 'daily'),
+            params.get('max_snapshots', 0), params.get('name', ''), params.get('exclude_boot_volume', False),
+            inventory=inventory, copy_queue=queue, completion_tracker=None if ebs_client else tracker,
+            ebs_client=ebs_client, retention=params.get('retention'), stagger=target.stagger)
+
+    volumes, instances = _group_by_instance(config)
+    work = [functools.partial(process_volume, volume, params) for volume, params in volumes]
+    work.extend(functools.partial(process_instance, instance_id, [v for v, _ in members], members[0][1])
+                for instance_id, members in instances.iteritems())
+
+    if concurrency <= 1:
+        for item in work:
+            item()
+        return inventory
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(concurrency, max(len(work), 1)),
+                      initializer=kvlog.use_summary, initargs=(target.summary,))
+    try:
+        pool.map(lambda item: item(), work)
+    finally:
+        pool.close()
+        pool.join()
+    return inventory
+
+
+def _ebs_client(target, params):
+    """ EBS direct APIs client for volumes with skip_unchanged, else None
+
+    Their completed snapshots are checked for changes before copying, in the
+    cycle, so they aren't handed to the completion tracker. The deadline
+    scheduler looks at them again while their newest snapshot is pending.
+    """
+    return target.ebs_client() if params.get('skip_unchanged') else None
+
+
+def _group_by_instance(config):
+    """ Split config items into volumes processed on their own and volumes snapshotted with their instance
+
+    :type config: dict
+    :param config: volume id -> backup parameters, instance volumes marked by an "instance" parameter
+    :returns: tuple -- (list of (volume id, params), dict of instance id -> list of (volume id, params))
+    """
+    volumes, instances = [], {}
+    for volume_id, params in config.iteritems():
+        if params.get('instance'):
+            instances.setdefault(params['instance'], []).append((volume_id, params))
+        else:
+            volumes.append((volume_id, params))
+    return volumes, instances
+
+
+def _with_instance_volumes(due, config, scheduler=None):
+    """ Add the other volumes of the instances of due volumes, as they are snapshotted together
+
+    :returns: list -- volume ids, taken out of the scheduler (if any) like pop_due's
+    """
+    instances = set(config[v].get('instance') for v in due) - set([None])
+    if not instances:
+        return due
+    due = set(due)
+    for volume_id, params in config.iteritems():
+        if params.get('instance') in instances and volume_id not in due:
+            if scheduler is not None:
+                scheduler.remove(volume_id)
+            due.add(volume_id)
+    return list(due)
+
+
+def create_snapshots(target, concurrency=concurrency):
+    """ Ensure snapshots for every configured volume of a target
+
+    :type target: Target
+    :type concurrency: int
+    :param concurrency: number of volumes to process in parallel
+    :returns: dict -- the config processed
+    """
+    config = target.get_config()
+    _process_volumes(target, config, concurrency)
+    for volume_id in target.volume_snapshots.keys():
+        if volume_id not in config:
+            _forget_volume(target, volume_id)
+    return config
+
+
+def _next_deadline(inventory, volume_id, params, now, retry_interval, stagger=None):
+    """ When a volume should next be looked at, based on its newest snapshot and, with a stagger, its offset
 
+    Volumes still due after processing were deferred by the stagger's create
+    cap, and are looked at again when its next slice starts. Volumes with
+    skip_unchanged whose newest snapshot is pending are looked at again
+    after retry_interval: the completion tracker doesn't copy their
+    snapshots, so they are compared and copied once processed after completing.
+    """
+    interval = params.get('interval', 'daily')
+    if inventory is None or volume_id not in inventory.volumes or interval not in snapshot_manager.VALID_INTERVALS:
+        return now + retry_interval
+    index = inventory.snapshot_index(volume_id)
+    deadline = snapshot_manager.next_due(index, interval, stagger, params.get('instance') or volume_id)
+    if stagger is not None and stagger.rates['create'] and (deadline is None or deadline <= now):
+        deadline = stagger.next_slice(now)
+    newest = index.newest()
+    if params.get('skip_unchanged') and newest is not None and newest[1].status == "pending":
+        deadline = min(deadline or now, now + retry_interval)
+    # Clock skew with AWS can leave a deadline in the past; don't spin on it
+    return max(deadline or now, now + MIN_RESCHEDULE_DELAY)
+
+
+def run_scheduled(target, max_sleep=300, clock=time.time, sleep=None):
+    """ Process volumes only when they are due, sleeping until the earliest deadline
+
+    Config is re-read at least every max_sleep seconds, and as soon as it
+    changes if its source can be watched. Only the volumes that changed are
+    rescheduled: new volumes and volumes whose parameters changed are due
+    immediately, removed volumes are dropped. Volumes that could not be
+    found are retried after max_sleep.
+    """
+    if sleep is None:
+        target.watch_config()
+        sleep = target.sleep_until_config_change
+    scheduler = Scheduler()
+    config = {}
+    while True:
+        previous, config = config, target.get_config()
+        changes = config_diff.diff(previous, config)
+        now = clock()
+        for volume_id in changes.added + changes.changed.keys():
+            scheduler.schedule(volume_id, now)
+        for volume_id in changes.removed:
+            scheduler.remove(volume_id)
+            _forget_volume(target, volume_id)
+        if changes and previous:
+            kvlog.info("backup config changed", {
+                "target": target.name,
+                "added": len(changes.added),
+                "removed": len(changes.removed),
+                "changed": len(changes.changed)
+            })
+
+        due = _with_instance_volumes(scheduler.pop_due(now), config, scheduler)
+        if due:
+            kvlog.info("processing due volumes", {"target": target.name, "count": len(due)})
+            inventory = _process_volumes(target, dict((v, config[v]) for v in due))
+            now = clock()
+            for volume_id in due:
+                scheduler.schedule(volume_id, _next_deadline(
+                    inventory, volume_id, config[volume_id], now, max_sleep, target.stagger))
+
+        next_deadline = scheduler.next_deadline()
+        wait = max_sleep if next_deadline is None else min(max_sleep, next_deadline - clock())
+        if wait > 0:
+            sleep(wait)
+
+
+def run_interval(target, interval=300, clock=time.time, sleep=None):
+    """ Check every volume of a target every interval seconds
+
+    If the backup config source can be watched, a change wakes the loop
+    between cycles: volumes added or changed are processed at once (with
+    the other volumes of their instances), removed volumes are forgotten,
+    and the rest wait for the next cycle.
+    """
+    if sleep is None:
+        target.watch_config()
+        sleep = target.sleep_until_config_change
+    while True:
+        config = create_snapshots(target)
+        next_cycle = clock() + interval
+        while clock() < next_cycle:
+            sleep(next_cycle - clock())
+            if clock() >= next_cycle:
+                break
+            previous, config = config, target.get_config()
+            changes = config_diff.diff(previous, config)
+            for volume_id in changes.removed:
+                _forget_volume(target, volume_id)
+            if changes:
+                kvlog.info("backup config changed", {
+                    "target": target.name,
+                    "added": len(changes.added),
+                    "removed": len(changes.removed),
+                    "changed": len(changes.changed)
+                })
+            changed = _with_instance_volumes(changes.added + changes.changed.keys(), config)
+            if changed:
+                _process_volumes(target, dict((v, config[v]) for v in changed))
+
+
+def run_once(concurrency=concurrency):
+    """ Run one cycle for every target and return, for cron or serverless runs
+
+    Nothing runs in the background: copies start during the cycle as the
+    copy window allows. Snapshots that complete after the run, and copies
+    that didn't fit, are copied by the next run, which copies every volume's
+    newest completed snapshot that has no backup, due or not.
+
+    :returns: int -- exit status: 0 if every cycle ran cleanly, 1 if any
+        target couldn't be inventoried or any snapshot operation failed
+    """
+    if shard_leases:
+        kvlog.warning("SHARD_LEASES is ignored for single runs", {})
+    status = 0
+    for target in load_targets():
+        targets[target.name] = target
+        target.oneshot = True
+        config = target.get_config()
+        if _process_volumes(target, config, concurrency) is None or target.last_counts.get('failed'):
+            status = 1
+    return status
+
+
+def _run_target(target, interval, clock=time.time, sleep=time.sleep):
+    """ Run a target's loop for good, restarting it after a delay whenever it fails
+
+    The delay doubles for every failure in a row, up to TARGET_MAX_RETRY_DELAY,
+    and starts over once the loop has run longer than that.
+    """
+    delay = TARGET_RETRY_DELAY
+    while True:
+        started = clock()
+        try:
+            if scheduler_mode == 'deadline':
+                run_scheduled(target, max_sleep=interval)
+            else:
+                run_interval(target, interval)
+        except Exception as e:
+            if clock() - started > TARGET_MAX_RETRY_DELAY:
+                delay = TARGET_RETRY_DELAY
+            metrics.registry.inc('target_failures_total', target=target.name)
+            kvlog.error("target failed", {"target": target.name, "error": str(e), "retry_seconds": delay})
+            sleep(delay)
+            delay = min(delay * 2, TARGET_MAX_RETRY_DELAY)
 
 
 def snapshot_timer(interval=300):
     """ Gets backup conf, every x seconds checks for snapshots to create/delete,
-        and performs the create/delete operations as needed """
-    # Main loop gets the backup conf once.
+        and performs the create/delete operations as needed
+
+    Each target runs in its own thread, so a slow region doesn't hold up the
+    others. A target that fails is logged and restarted after a delay, see
+    _run_target. With SHARD_LEASES set, the volumes of every target are split
+    between the replicas sharing it. """
+    # Main loop gets the backup confs once.
     # Thereafter they are responsible for updating their own data
-    backup_conf = get_backup_conf(config_path)
+    for target in load_targets(interval=interval):
+        targets[target.name] = target
+    if shard_leases:
+        from sharding import Shard, get_lease_store
+        shard = Shard(get_lease_store(shard_leases, lease_ttl), replica_id, lease_ttl)
+        shard.start()
+        atexit.register(shard.stop)
+        for target in targets.values():
+            target.shard = shard
+    if metrics_port:
+        metrics.serve(metrics.registry, int(metrics_port), metrics_address)
+    if len(targets) == 1:
+        return _run_target(targets.values()[0], interval)
+
+    for target in targets.values():
+        thread = threading.Thread(target=_run_target, args=(target, interval), name=target.name)
+        thread.daemon = True
+        thread.start()
     while True:
-        create_snapshots(backup_conf)
-        time.sleep(interval)
+        # Targets restart themselves when they fail; sleep in steps, so the main thread stays interruptible
+        time.sleep(60)
@@ -1,7 +1,5 @@
 from backup_config import BackupConfig
-import yaml
-import jsonschema
-import kayvee
+import os
 
 
 class FileBackupConfig(BackupConfig):
@@ -11,8 +9,23 @@ class FileBackupConfig(BackupConfig):
 
     def __init__(self, path):
         self.path = path
+        self._stamp = None
+        self._parsed = None
 
     def refresh(self):
-        """ Read file and return parsed yml """
+        """ Read file and return parsed yml. Only re-parses if the file's mtime or size changed """
         with open(self.path, "r") as open_file:
-            return yaml.load(open_file)
+            stat = os.fstat(open_file.fileno())
+            stamp = (stat.st_mtime, stat.st_size)
+            if stamp == self._stamp:
+                return self._parsed
+            import yaml
+            parsed = yaml.load(open_file)
+        self._stamp = stamp
+        self._parsed = parsed
+        return parsed
+
+    def watch(self, callback):
+        """ Call callback as soon as the file is written or replaced, through inotify """
+        import file_watch
+        return file_watch.watch(self.path, callback)
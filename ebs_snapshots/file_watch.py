@@ -0,0 +1,72 @@
+""" Watch a file for changes with Linux inotify, called through ctypes so there is no extra dependency """
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import threading
+import kvlog
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+""" Events on the file's directory meaning the file may have changed. The
+directory is watched rather than the file, so a file replaced by a rename (as
+editors and config management tools do) stays watched """
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+""" struct inotify_event, without the name that follows it """
+_EVENT = struct.Struct('iIII')
+
+
+def _libc():
+    name = ctypes.util.find_library('c')
+    if name is None:
+        return None
+    libc = ctypes.CDLL(name, use_errno=True)
+    return libc if hasattr(libc, 'inotify_init') else None
+
+
+def watch(path, callback):
+    """ Call callback from a background thread whenever the file at path is written, replaced or removed
+
+    :type callback: callable
+    :param callback: called without arguments, at least once per change
+    :returns: bool -- False if the file can't be watched (e.g. not on Linux)
+    """
+    libc = _libc()
+    if libc is None:
+        return False
+    directory, filename = os.path.split(os.path.abspath(path))
+    fd = libc.inotify_init()
+    if fd < 0 or libc.inotify_add_watch(fd, directory, WATCH_MASK) < 0:
+        error = ctypes.get_errno()
+        if fd >= 0:
+            os.close(fd)
+        kvlog.warning("could not watch file", {"path": path, "error": os.strerror(error)})
+        return False
+    thread = threading.Thread(target=_read_events, args=(fd, filename, callback), name='watch-' + filename)
+    thread.daemon = True
+    thread.start()
+    return True
+
+
+def _read_events(fd, filename, callback):
+    while True:
+        try:
+            data = os.read(fd, 4096)
+        except OSError as error:
+            if error.errno == errno.EINTR:
+                continue
+            raise
+        changed = False
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            changed = changed or data[offset:offset + length].rstrip('\0') == filename
+            offset += length
+        if changed:
+            callback()
@@ -1,5 +1,4 @@
 from backup_config import BackupConfig
-import yaml
 import json
 
 
@@ -9,12 +8,13 @@ class InlineBackupConfig(BackupConfig):
     path = ""
 
     def __init__(self, path):
-        """ Try loading path as inline YAML, then JSON """
+        """ Try loading path as inline JSON, then YAML (a superset of JSON, but much slower to import and parse) """
         try:
-            self.config = yaml.load(path)
-        except:
+            self.config = json.loads(path)
+        except ValueError:
+            import yaml
             try:
-                self.config = json.loads(path)
+                self.config = yaml.load(path)
             except:
                 raise ValueError("BACKUP_CONFIG is not valid yaml or json")
 
@@ -0,0 +1,193 @@
+""" Fleet-wide inventory of volumes and snapshots, fetched once per cycle """
+from boto.ec2.snapshot import Snapshot
+import time
+import kvlog
+from snapshot_index import SnapshotIndex, backup_snapshot_start
+
+""" Tag value identifying snapshots created by this tool """
+CREATOR = 'ebs-snapshots'
+
+""" Max ids per volume-id filter (EC2 caps filter values per request) """
+VOLUME_BATCH_SIZE = 200
+
+""" Page size for DescribeSnapshots """
+PAGE_SIZE = 1000
+
+
+class SnapshotInventory:
+
+    """
+    Index of the configured volumes and the snapshots we created for them, in
+    both the primary and the backup region
+
+    Primary snapshots are boto.ec2.snapshot.Snapshot objects, backup snapshots
+    are the dicts returned by boto3 describe_snapshots. Both are indexed by
+    volume id, and by start time in a SnapshotIndex per volume.
+    """
+
+    def __init__(self, store=None, now=None):
+        self.volumes = {}
+        self.snapshots = {}
+        self.backup_snapshots = {}
+        self._indexes = {}
+        self._backup_indexes = {}
+        # ebs_snapshots.inventory_store.InventoryStore to write changes through to, if any
+        self.store = store
+        # The time snapshot ages are measured against, one for the whole cycle
+        self.now = time.time() if now is None else now
+
+    def get_snapshots(self, volume_id):
+        """ Snapshots of a volume in the primary region """
+        return self.snapshots.setdefault(volume_id, [])
+
+    def get_backup_snapshots(self, volume_id):
+        """ Snapshot copies of a volume in the backup region """
+        return self.backup_snapshots.setdefault(volume_id, [])
+
+    def snapshot_index(self, volume_id):
+        """ Snapshots of a volume in the primary region by start time. Built on first use """
+        if volume_id not in self._indexes:
+            self._indexes[volume_id] = SnapshotIndex(self.get_snapshots(volume_id))
+        return self._indexes[volume_id]
+
+    def backup_snapshot_index(self, volume_id):
+        """ Snapshot copies of a volume in the backup region by start time. Built on first use """
+        if volume_id not in self._backup_indexes:
+            self._backup_indexes[volume_id] = SnapshotIndex(
+                self.get_backup_snapshots(volume_id), backup_snapshot_start, lambda info: info["SnapshotId"],
+                lambda info: info.get("State"))
+        return self._backup_indexes[volume_id]
+
+    def add_snapshot(self, volume_id, snapshot):
+        self.get_snapshots(volume_id).append(snapshot)
+        if volume_id in self._indexes:
+            self._indexes[volume_id].add(snapshot)
+        if self.store is not None:
+            self.store.save_snapshots([snapshot])
+
+    def remove_snapshot(self, volume_id, snapshot_id):
+        self.snapshots[volume_id] = [
+            s for s in self.get_snapshots(volume_id) if s.id != snapshot_id]
+        if volume_id in self._indexes:
+            self._indexes[volume_id].remove(snapshot_id)
+        if self.store is not None:
+            self.store.delete_snapshot(snapshot_id)
+
+    def add_backup_snapshot(self, volume_id, snapshot_info):
+        self.get_backup_snapshots(volume_id).append(snapshot_info)
+        if volume_id in self._backup_indexes:
+            self._backup_indexes[volume_id].add(snapshot_info)
+        if self.store is not None:
+            self.store.save_backup_snapshots(volume_id, [snapshot_info])
+
+    def remove_backup_snapshot(self, volume_id, snapshot_id):
+        self.backup_snapshots[volume_id] = [
+            s for s in self.get_backup_snapshots(volume_id) if s["SnapshotId"] != snapshot_id]
+        if volume_id in self._backup_indexes:
+            self._backup_indexes[volume_id].remove(snapshot_id)
+        if self.store is not None:
+            self.store.delete_backup_snapshot(snapshot_id)
+
+    def has_backup(self, volume_id, source_snapshot_id):
+        """ Whether a copy of the given snapshot exists in the backup region. Failed copies don't count """
+        return any(get_tag(s.get("Tags"), "source_snapshot") == source_snapshot_id and s.get("State") != "error"
+                   for s in self.get_backup_snapshots(volume_id))
+
+
+def get_tag(tags, key):
+    """ Look up a tag value in a boto3 tag list """
+    for tag in tags or []:
+        if tag["Key"] == key:
+            return tag["Value"]
+    return None
+
+
+def fetch_volumes(connection, volume_ids):
+    """ Describe volumes in batches. Unknown ids are skipped rather than failing the batch """
+    volume_ids = list(volume_ids)
+    volumes = {}
+    for i in range(0, len(volume_ids), VOLUME_BATCH_SIZE):
+        batch = volume_ids[i:i + VOLUME_BATCH_SIZE]
+        for volume in connection.get_all_volumes(filters={'volume-id': batch}):
+            volumes[volume.id] = volume
+    return volumes
+
+
+def fetch_snapshots(connection, filters=None):
+    """ Page through all snapshots in the primary region created by us
+
+    :type filters: dict
+    :param filters: extra DescribeSnapshots filters, name -> list of values
+    """
+    params = {'MaxResults': PAGE_SIZE}
+    filters = dict(filters or {}, **{'tag:creator': CREATOR})
+    connection.build_list_params(params, ['self'], 'Owner')
+    connection.build_filter_params(params, filters)
+    while True:
+        page = connection.get_list('DescribeSnapshots', params, [('item', Snapshot)], verb='POST')
+        for snapshot in page:
+            yield snapshot
+        if not page.next_token:
+            return
+        params['NextToken'] = page.next_token
+
+
+def fetch_backup_snapshots(backup_client, filters=None):
+    """ Page through all snapshot copies in the backup region created by us
+
+    :type filters: dict
+    :param filters: extra DescribeSnapshots filters, name -> list of values
+    """
+    filters = [{"Name": name, "Values": values} for name, values in (filters or {}).items()]
+    filters.append({"Name": "tag:creator", "Values": [CREATOR]})
+    paginator = backup_client.get_paginator('describe_snapshots')
+    pages = paginator.paginate(
+        OwnerIds=['self'],
+        Filters=filters,
+        PaginationConfig={"PageSize": PAGE_SIZE})
+    for page in pages:
+        for snapshot_info in page["Snapshots"]:
+            yield snapshot_info
+
+
+def build_inventory(connection, backup_client, volume_ids):
+    """ Fetch volumes and snapshots for a whole cycle in a few bulk calls
+
+    Holds every snapshot of the given volumes, in both regions, for the
+    whole cycle; snapshots of other volumes are dropped page by page. Memory
+    grows with the snapshots each volume has, which retention keeps near its
+    policy's size.
+
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object for primary EBS region
+    :type backup_client: boto3.EC2.Client
+    :param backup_client: EC2 client for backup region
+    :type volume_ids: list
+    :param volume_ids: ids of the configured volumes
+    :returns: SnapshotInventory
+    """
+    volume_ids = list(volume_ids)
+    inventory = SnapshotInventory()
+    inventory.volumes = fetch_volumes(connection, volume_ids)
+    if not inventory.volumes:
+        return inventory
+
+    # A handful of volumes (e.g. the ones a scheduler found due) are cheaper to
+    # fetch by id than by listing every snapshot in the account
+    by_volume = len(volume_ids) <= VOLUME_BATCH_SIZE
+
+    for snapshot in fetch_snapshots(connection, {'volume-id': volume_ids} if by_volume else None):
+        if snapshot.volume_id in inventory.volumes:
+            inventory.add_snapshot(snapshot.volume_id, snapshot)
+
+    for snapshot_info in fetch_backup_snapshots(backup_client, {'tag:volume-id': volume_ids} if by_volume else None):
+        volume_id = get_tag(snapshot_info.get("Tags"), "volume-id")
+        if volume_id in inventory.volumes:
+            inventory.add_backup_snapshot(volume_id, snapshot_info)
+
+    kvlog.info("built snapshot inventory", {
+        "volumes": len(inventory.volumes),
+        "snapshots": sum(len(s) for s in inventory.snapshots.values()),
+        "backup_snapshots": sum(len(s) for s in inventory.backup_snapshots.values()),
+    })
+    return inventory
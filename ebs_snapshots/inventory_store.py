@@ -0,0 +1,239 @@
+""" On-disk inventory cache, so cycles and restarts only fetch what changed """
+import datetime
+import sqlite3
+import threading
+import time
+from boto.ec2.snapshot import Snapshot
+from dateutil.tz import tzutc
+import kvlog
+from inventory import SnapshotInventory, fetch_volumes, fetch_snapshots, fetch_backup_snapshots, get_tag
+
+""" Seconds between full reconciliations, which also catch snapshots deleted outside of this tool """
+DEFAULT_FULL_REFRESH_INTERVAL = 6 * 3600
+
+""" Fall back to a full refresh if the last snapshot we saw is older than this many days """
+MAX_DELTA_DAYS = 7
+
+""" Max ids per snapshot-id filter or SQL IN clause """
+BATCH_SIZE = 200
+
+BACKUP_START_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS volumes (
+    id TEXT PRIMARY KEY,
+    zone TEXT
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id TEXT PRIMARY KEY,
+    volume_id TEXT,
+    start_time TEXT,
+    status TEXT
+);
+CREATE INDEX IF NOT EXISTS snapshots_volume ON snapshots (volume_id);
+CREATE TABLE IF NOT EXISTS backup_snapshots (
+    id TEXT PRIMARY KEY,
+    volume_id TEXT,
+    source_snapshot_id TEXT,
+    start_time TEXT,
+    state TEXT
+);
+CREATE INDEX IF NOT EXISTS backup_snapshots_volume ON backup_snapshots (volume_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def _batches(items, size=BATCH_SIZE):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class InventoryStore:
+
+    """
+    SQLite store of volumes, snapshots, backup copies and the snapshot each
+    copy was made from. Safe to share between worker threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.executescript(SCHEMA)
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            with self._db:
+                return self._db.execute(sql, params).fetchall()
+
+    def _executemany(self, sql, rows):
+        with self._lock:
+            with self._db:
+                self._db.executemany(sql, rows)
+
+    def get_meta(self, key):
+        rows = self._execute("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def set_meta(self, key, value):
+        self._execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def save_volumes(self, volumes):
+        self._executemany(
+            "INSERT OR REPLACE INTO volumes (id, zone) VALUES (?, ?)",
+            [(v.id, v.zone) for v in volumes])
+
+    def save_snapshots(self, snapshots):
+        self._executemany(
+            "INSERT OR REPLACE INTO snapshots (id, volume_id, start_time, status) VALUES (?, ?, ?, ?)",
+            [(s.id, s.volume_id, s.start_time, s.status) for s in snapshots])
+
+    def save_backup_snapshots(self, volume_id, snapshot_infos):
+        self._executemany(
+            "INSERT OR REPLACE INTO backup_snapshots (id, volume_id, source_snapshot_id, start_time, state) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(s["SnapshotId"], volume_id, get_tag(s.get("Tags"), "source_snapshot"),
+              s["StartTime"].astimezone(tzutc()).strftime(BACKUP_START_TIME_FORMAT), s.get("State"))
+             for s in snapshot_infos])
+
+    def delete_snapshot(self, snapshot_id):
+        self._execute("DELETE FROM snapshots WHERE id = ?", (snapshot_id,))
+
+    def delete_backup_snapshot(self, snapshot_id):
+        self._execute("DELETE FROM backup_snapshots WHERE id = ?", (snapshot_id,))
+
+    def clear_snapshots(self):
+        self._execute("DELETE FROM snapshots")
+        self._execute("DELETE FROM backup_snapshots")
+
+    def newest_start_time(self, table):
+        """ Newest start_time in "snapshots" or "backup_snapshots", as a string, or None """
+        return self._execute("SELECT MAX(start_time) FROM {}".format(table))[0][0]
+
+    def pending_ids(self, table):
+        """ Ids of snapshots in "snapshots" or "backup_snapshots" last seen pending """
+        column = "status" if table == "snapshots" else "state"
+        return [r[0] for r in self._execute("SELECT id FROM {} WHERE {} = 'pending'".format(table, column))]
+
+    def load(self, volumes):
+        """ Build an inventory of the given volumes from the store
+
+        :type volumes: dict
+        :param volumes: volume id -> boto.ec2.volume.Volume
+        :returns: SnapshotInventory -- writing through to this store
+        """
+        inventory = SnapshotInventory()
+        inventory.volumes = volumes
+        for batch in _batches(volumes.keys()):
+            marks = ",".join("?" * len(batch))
+            for id, volume_id, start_time, status in self._execute(
+                    "SELECT id, volume_id, start_time, status FROM snapshots WHERE volume_id IN ({})".format(marks), batch):
+                snapshot = Snapshot()
+                snapshot.id, snapshot.volume_id, snapshot.start_time, snapshot.status = id, volume_id, start_time, status
+                inventory.add_snapshot(volume_id, snapshot)
+            for id, volume_id, source_snapshot_id, start_time, state in self._execute(
+                    "SELECT id, volume_id, source_snapshot_id, start_time, state FROM backup_snapshots "
+                    "WHERE volume_id IN ({})".format(marks), batch):
+                inventory.add_backup_snapshot(volume_id, {
+                    "SnapshotId": id,
+                    "StartTime": datetime.datetime.strptime(start_time, BACKUP_START_TIME_FORMAT).replace(tzinfo=tzutc()),
+                    "State": state,
+                    "Tags": [
+                        {"Key": "volume-id", "Value": volume_id},
+                        {"Key": "source_snapshot", "Value": source_snapshot_id},
+                    ],
+                })
+        inventory.store = self
+        return inventory
+
+
+def _start_days(newest_start_time, today):
+    """ start-time filter values (one wildcard per day) covering the newest snapshot's day through today """
+    day = datetime.datetime.strptime(newest_start_time[:10], '%Y-%m-%d').date()
+    days = []
+    while day <= today:
+        days.append(day.strftime('%Y-%m-%d') + '*')
+        day += datetime.timedelta(days=1)
+    return days
+
+
+def _full_refresh(store, connection, backup_client):
+    """ Replace every stored snapshot with a fresh account-wide listing """
+    store.clear_snapshots()
+    store.save_snapshots(fetch_snapshots(connection))
+    copies = {}
+    for snapshot_info in fetch_backup_snapshots(backup_client):
+        copies.setdefault(get_tag(snapshot_info.get("Tags"), "volume-id"), []).append(snapshot_info)
+    for volume_id, snapshot_infos in copies.items():
+        store.save_backup_snapshots(volume_id, snapshot_infos)
+
+
+def _delta_refresh(store, connection, backup_client, days):
+    """ Fetch snapshots started on the given days, and re-check the ones last seen pending """
+    # Read before the day listing, so snapshots it just fetched aren't re-checked straight away
+    pending = store.pending_ids("snapshots")
+    pending_copies = store.pending_ids("backup_snapshots")
+
+    store.save_snapshots(fetch_snapshots(connection, {'start-time': days}))
+    for batch in _batches(pending):
+        store.save_snapshots(fetch_snapshots(connection, {'snapshot-id': batch}))
+
+    def save_copies(snapshot_infos):
+        for snapshot_info in snapshot_infos:
+            store.save_backup_snapshots(get_tag(snapshot_info.get("Tags"), "volume-id"), [snapshot_info])
+
+    save_copies(fetch_backup_snapshots(backup_client, {'start-time': days}))
+    for batch in _batches(pending_copies):
+        save_copies(fetch_backup_snapshots(backup_client, {'snapshot-id': batch}))
+
+
+def refresh_inventory(store, connection, backup_client, volume_ids,
+                      full_refresh_interval=DEFAULT_FULL_REFRESH_INTERVAL, clock=time.time):
+    """ Bring the store up to date and build this cycle's inventory from it
+
+    Snapshots are listed account-wide on the first run and every
+    full_refresh_interval seconds. In between, only snapshots started since
+    the day of the newest one we have seen are fetched, plus the ones still
+    pending. Volumes are always described, since they are few and a deleted
+    volume must not be snapshotted.
+
+    :type store: InventoryStore
+    :type connection: boto.ec2.connection.EC2Connection
+    :param connection: EC2 connection object for primary EBS region
+    :type backup_client: boto3.EC2.Client
+    :param backup_client: EC2 client for backup region
+    :type volume_ids: list
+    :param volume_ids: ids of the configured volumes
+    :returns: SnapshotInventory
+    """
+    now = clock()
+    volumes = fetch_volumes(connection, volume_ids)
+    store.save_volumes(volumes.values())
+
+    last_full_refresh = store.get_meta("last_full_refresh")
+    newest = [t for t in (store.newest_start_time("snapshots"), store.newest_start_time("backup_snapshots")) if t]
+    today = datetime.datetime.utcfromtimestamp(now).date()
+    days = _start_days(min(newest), today) if newest else []
+
+    if last_full_refresh is None or now - float(last_full_refresh) >= full_refresh_interval \
+            or not days or len(days) > MAX_DELTA_DAYS:
+        _full_refresh(store, connection, backup_client)
+        store.set_meta("last_full_refresh", now)
+        kind = "full"
+    else:
+        _delta_refresh(store, connection, backup_client, days)
+        kind = "delta"
+
+    inventory = store.load(volumes)
+    kvlog.info("refreshed snapshot inventory", {
+        "refresh": kind,
+        "volumes": len(inventory.volumes),
+        "snapshots": sum(len(s) for s in inventory.snapshots.values()),
+        "backup_snapshots": sum(len(s) for s in inventory.backup_snapshots.values()),
+    })
+    return inventory
@@ -0,0 +1,159 @@
+""" Kayvee logging off the hot path: lazily formatted messages, a queue-backed handler and per-cycle summaries """
+import atexit
+import logging
+import Queue
+import threading
+import kayvee
+
+SOURCE = "ebs-snapshots"
+
+""" Events counted in each cycle summary """
+SUMMARY_EVENTS = ('created', 'copied', 'unchanged', 'deleted', 'skipped', 'failed')
+
+
+class _KVMessage(object):
+
+    """ Log message formatted by kayvee only when a handler emits it """
+
+    __slots__ = ('level', 'title', 'data')
+
+    def __init__(self, level, title, data):
+        self.level = level
+        self.title = title
+        self.data = data
+
+    def __str__(self):
+        return kayvee.formatLog(SOURCE, self.level, self.title, self.data)
+
+
+def _log(level, kv_level, title, data):
+    logger = logging.getLogger()
+    if logger.isEnabledFor(level):
+        logger.log(level, _KVMessage(kv_level, title, data))
+
+
+def debug(title, data=None):
+    _log(logging.DEBUG, "debug", title, data)
+
+
+def info(title, data=None):
+    _log(logging.INFO, "info", title, data)
+
+
+def warning(title, data=None):
+    _log(logging.WARNING, "warning", title, data)
+
+
+def error(title, data=None):
+    _log(logging.ERROR, "error", title, data)
+
+
+class QueueHandler(logging.Handler):
+
+    """
+    Hands records to a background thread, which formats them and passes them
+    to the real handlers, so callers never wait on formatting or I/O
+    """
+
+    def __init__(self, handlers):
+        logging.Handler.__init__(self)
+        self.handlers = list(handlers)
+        self.queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._listen)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        if record.exc_info:
+            # The traceback may be gone by the time the listener gets to it
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.queue.put(record)
+
+    def _listen(self):
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    return
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        """ Write out everything queued so far, then stop the listener """
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+        for handler in self.handlers:
+            handler.flush()
+        logging.Handler.close(self)
+
+
+def use_queue(logger=None):
+    """ Move a logger's handlers (the root logger's by default) behind a QueueHandler
+
+    :returns: QueueHandler
+    """
+    logger = logger or logging.getLogger()
+    handler = QueueHandler(logger.handlers)
+    for h in list(logger.handlers):
+        logger.removeHandler(h)
+    logger.addHandler(handler)
+    atexit.register(handler.close)
+    return handler
+
+
+class CycleSummary(object):
+
+    """ Thread-safe counts of what a cycle did, logged as one event at the end of the cycle """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(SUMMARY_EVENTS, 0)
+
+    def count(self, event, n=1):
+        with self._lock:
+            self._counts[event] += n
+
+    def flush(self, data=None):
+        """ Log the counts since the last flush, plus data, and reset them
+
+        :returns: dict -- the counts
+        """
+        with self._lock:
+            counts, self._counts = self._counts, dict.fromkeys(SUMMARY_EVENTS, 0)
+        info("cycle summary", dict(counts, **(data or {})))
+        return counts
+
+
+""" Summary of the current cycle, flushed by the daemon. Used by threads that haven't called use_summary """
+summary = CycleSummary()
+
+_local = threading.local()
+
+
+def use_summary(cycle_summary):
+    """ Count this thread's events in cycle_summary, e.g. the summary of the target it works for """
+    _local.summary = cycle_summary
+
+
+def current_summary():
+    return getattr(_local, 'summary', summary)
+
+
+def with_current_summary(function):
+    """ Wrap function so it counts in the calling thread's summary, wherever it runs """
+    cycle_summary = current_summary()
+
+    def run(*args, **kwargs):
+        use_summary(cycle_summary)
+        return function(*args, **kwargs)
+    return run
+
+
+def count(event, n=1):
+    """ Count an event in this thread's cycle summary """
+    current_summary().count(event, n)
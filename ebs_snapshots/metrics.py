@@ -0,0 +1,228 @@
+""" In-process metrics (counters, gauges, histograms), exposed over HTTP in the Prometheus text format """
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import bisect
+import threading
+import time
+import kvlog
+from rate_limiter import RAW_REQUEST_METHODS, error_code
+
+""" Histogram bucket upper bounds (seconds) for single API calls """
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+""" Histogram bucket upper bounds (seconds) for whole cycles """
+CYCLE_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+class Histogram(object):
+
+    """ Cumulative-bucket histogram, as Prometheus expects """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _value(value):
+    return value() if callable(value) else value
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in pairs) + '}'
+
+
+class MetricsRegistry(object):
+
+    """ Thread-safe store of metrics, keyed by name and labels """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """ Set a gauge. value may be a function, called whenever the gauge is read """
+        with self._lock:
+            self._gauges[(name, _labels(labels))] = value
+
+    def remove(self, name, **labels):
+        """ Drop a gauge, e.g. for a volume that is no longer configured """
+        with self._lock:
+            self._gauges.pop((name, _labels(labels)), None)
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(buckets)
+            self._histograms[key].observe(value)
+
+    def get(self, name, **labels):
+        """ Current value of a counter or gauge, or a histogram's count (0 if never recorded) """
+        key = (name, _labels(labels))
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key].count
+            if key in self._gauges:
+                return _value(self._gauges[key])
+            return self._counters.get(key, 0)
+
+    def render(self):
+        """ All metrics in the Prometheus text exposition format """
+        lines = []
+        with self._lock:
+            for kind, metrics in (('counter', self._counters), ('gauge', self._gauges),
+                                  ('histogram', self._histograms)):
+                by_name = {}
+                for (name, labels), value in metrics.items():
+                    by_name.setdefault(name, []).append((labels, value))
+                for name in sorted(by_name):
+                    if name in self._help:
+                        lines.append('# HELP {} {}'.format(name, self._help[name]))
+                    lines.append('# TYPE {} {}'.format(name, kind))
+                    for labels, value in sorted(by_name[name]):
+                        if kind != 'histogram':
+                            lines.append('{}{} {}'.format(name, _format_labels(labels), _value(value)))
+                            continue
+                        cumulative = 0
+                        for bound, count in zip(list(value.buckets) + ['+Inf'], value.counts):
+                            cumulative += count
+                            lines.append('{}_bucket{} {}'.format(
+                                name, _format_labels(labels, [('le', bound)]), cumulative))
+                        lines.append('{}_sum{} {}'.format(name, _format_labels(labels), value.sum))
+                        lines.append('{}_count{} {}'.format(name, _format_labels(labels), value.count))
+        return '\n'.join(lines) + '\n'
+
+
+def operation_name(name):
+    """ "describe_snapshots" or "DescribeSnapshots" -> "DescribeSnapshots", so boto2 and boto3 calls line up """
+    if '_' not in name:
+        return name
+    return ''.join(part.title() for part in name.split('_'))
+
+
+def record_call(metrics, service, region, operation, seconds, error=None):
+    """ Record one API call's count, latency and error code, if any """
+    metrics.inc('aws_api_calls_total', service=service, region=region, operation=operation)
+    metrics.observe('aws_api_latency_seconds', seconds, service=service, region=region, operation=operation)
+    if error is not None:
+        metrics.inc('aws_api_errors_total', service=service, region=region, operation=operation,
+                    code=error_code(error))
+
+
+class InstrumentedClient(object):
+
+    """
+    Proxy for a boto2 connection or boto3 client which records every API
+    call in a MetricsRegistry. Paginators returned by get_paginator record
+    each page.
+    """
+
+    def __init__(self, client, metrics, service, region):
+        self._client = client
+        self._metrics = metrics
+        self._service = service
+        self._region = region
+
+    def _timed(self, operation, call, *args, **kwargs):
+        start = time.time()
+        try:
+            result = call(*args, **kwargs)
+        except Exception as error:
+            record_call(self._metrics, self._service, self._region, operation, time.time() - start, error)
+            raise
+        record_call(self._metrics, self._service, self._region, operation, time.time() - start)
+        return result
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr) or name.startswith('_') or name.startswith('build_'):
+            return attr
+        if name == 'get_paginator':
+            return lambda operation: _InstrumentedPaginator(attr(operation), self, operation_name(operation))
+        if name in RAW_REQUEST_METHODS:
+            return lambda action, *args, **kwargs: self._timed(action, attr, action, *args, **kwargs)
+        return lambda *args, **kwargs: self._timed(operation_name(name), attr, *args, **kwargs)
+
+
+class _InstrumentedPaginator(object):
+
+    def __init__(self, paginator, client, operation):
+        self._paginator = paginator
+        self._client = client
+        self._operation = operation
+
+    def paginate(self, **kwargs):
+        pages = iter(self._paginator.paginate(**kwargs))
+        client = self._client
+        while True:
+            start = time.time()
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            except Exception as error:
+                record_call(client._metrics, client._service, client._region, self._operation,
+                            time.time() - start, error)
+                raise
+            record_call(client._metrics, client._service, client._region, self._operation, time.time() - start)
+            yield page
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(metrics, port, address='127.0.0.1'):
+    """ Serve metrics on http://address:port/metrics from a background thread
+
+    :returns: HTTPServer
+    """
+    server = HTTPServer((address, port), _MetricsHandler)
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    kvlog.info("serving metrics", {"address": address, "port": port})
+    return server
+
+
+""" Metrics of this process """
+registry = MetricsRegistry()
@@ -0,0 +1,343 @@
+""" Adaptive rate limiting and retries for EC2 API calls, per region and API family
+
+Each (region, family) has a token bucket. Its rate backs off multiplicatively
+whenever EC2 throttles a call and creeps back up additively with every
+success, to at most the configured rate (AIMD), so the daemon settles at
+what the account allows. Throttled and transient failures are retried with
+jittered exponential backoff, paid for out of a retry budget per region that
+successful calls refill.
+"""
+import httplib
+import random
+import re
+import socket
+import threading
+import time
+from boto.exception import BotoServerError
+from botocore.exceptions import ClientError, ConnectionError
+import kvlog
+
+""" Refill rate (tokens per second) and burst size for each API family """
+DEFAULT_RATES = {
+    'describe': (20, 100),
+    'create': (5, 50),
+    'copy': (5, 20),
+    'delete': (5, 50),
+}
+
+""" Methods that take the EC2 action name as their first argument (boto2) """
+RAW_REQUEST_METHODS = ['get_list', 'get_object', 'get_status', 'make_request']
+
+""" Error codes meaning a call was throttled: slow down, then retry it """
+THROTTLE_ERRORS = frozenset([
+    'RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'RequestThrottled', 'SlowDown'])
+
+""" Error codes of transient failures. Only describe calls are retried on
+these, as a create or copy might have gone through """
+TRANSIENT_ERRORS = frozenset(['InternalError', 'InternalFailure', 'ServiceUnavailable', 'Unavailable'])
+
+""" Attempts per call, the first one included """
+MAX_ATTEMPTS = 5
+
+""" Retry n waits a random time between 0 and min(BACKOFF_CAP, BACKOFF_BASE * 2 ** n) seconds """
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 20.0
+
+""" Throttling multiplies the rate by DECREASE_FACTOR, at most once per
+DECREASE_INTERVAL seconds so a burst of throttles from concurrent workers
+counts once, down to MIN_RATE tokens per second """
+DECREASE_FACTOR = 0.5
+DECREASE_INTERVAL = 1.0
+MIN_RATE = 0.5
+
+""" Each success adds INCREASE_PER_SECOND / rate to the rate, so it grows by
+about INCREASE_PER_SECOND tokens per second every second """
+INCREASE_PER_SECOND = 0.5
+
+""" Retries each successful call pays for, and the most that can be saved
+up. Keeps an API that keeps failing from getting MAX_ATTEMPTS times the
+traffic """
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MAX = 20
+
+
+def _snake_case(name):
+    return re.sub('([a-z0-9])([A-Z])', r'\1_\2', name).lower()
+
+
+def api_family(operation):
+    """ Map a boto method or EC2 action name to its API family
+
+    :type operation: str
+    :param operation: e.g. "get_all_snapshots", "copy_snapshot" or "DescribeVolumes"
+    :returns: str -- one of DEFAULT_RATES' keys, or None if not rate limited
+    """
+    operation = _snake_case(operation)
+    if operation.startswith('describe_') or operation.startswith('get_all_') or operation.startswith('get_only_'):
+        return 'describe'
+    if operation.startswith('create_'):
+        return 'create'
+    if operation.startswith('copy_'):
+        return 'copy'
+    if operation.startswith('delete_'):
+        return 'delete'
+    return None
+
+
+def error_code(error):
+    """ AWS error code of a boto2 or boto3 exception, else the exception's class name """
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code", "Unknown")
+    if isinstance(error, BotoServerError):
+        return error.error_code or str(error.status)
+    return type(error).__name__
+
+
+def is_throttle(error):
+    return isinstance(error, (ClientError, BotoServerError)) and error_code(error) in THROTTLE_ERRORS
+
+
+def is_transient(error):
+    """ Server errors and dropped connections, which the same call may well get through next time """
+    if isinstance(error, (socket.error, httplib.HTTPException, ConnectionError)):
+        return True
+    return isinstance(error, (ClientError, BotoServerError)) and error_code(error) in TRANSIENT_ERRORS
+
+
+class TokenBucket(object):
+
+    """
+    Thread-safe token bucket. acquire() blocks until a token is available.
+    decrease() and increase() adjust the rate between min_rate and the
+    initial rate.
+    """
+
+    def __init__(self, rate, capacity, clock=time.time, sleep=time.sleep, min_rate=MIN_RATE):
+        self.rate = float(rate)
+        self.max_rate = float(rate)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._decreased = None
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        """ Take tokens from the bucket, sleeping until they have been refilled
+
+        :returns: float -- seconds spent waiting
+        """
+        with self._lock:
+            self._refill()
+            # Reserve the tokens now, so concurrent callers queue up behind us
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+    def decrease(self):
+        """ Multiplicative decrease, after throttling. Also drops any saved up burst
+
+        :returns: bool -- whether the rate changed, False within DECREASE_INTERVAL of the last decrease
+        """
+        with self._lock:
+            now = self._clock()
+            if self._decreased is not None and now - self._decreased < DECREASE_INTERVAL:
+                return False
+            self._refill()
+            self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+            self.tokens = min(self.tokens, 0.0)
+            self._decreased = now
+            return True
+
+    def increase(self):
+        """ Additive increase, after a successful call """
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + INCREASE_PER_SECOND / self.rate)
+
+
+class RetryBudget(object):
+
+    """ Retries are paid for by successful calls, so they stay a fraction of the traffic """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, maximum=RETRY_BUDGET_MAX):
+        self.ratio = ratio
+        self.maximum = maximum
+        self.balance = float(maximum)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.maximum, self.balance + self.ratio)
+
+    def withdraw(self):
+        """ Take one retry from the budget, if there is one left """
+        with self._lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class RateLimiter(object):
+
+    """
+    Token buckets keyed by (region, API family) and retry budgets keyed by
+    region, created on first use. With a metrics registry, each bucket's
+    current rate is exposed as rate_limit_per_second and retries are counted
+    in aws_api_retries_total.
+    """
+
+    def __init__(self, rates=None, metrics=None, clock=time.time, sleep=time.sleep, random=random.random):
+        self.rates = dict(DEFAULT_RATES)
+        self.rates.update(rates or {})
+        self.metrics = metrics
+        self._clock = clock
+        self._sleep = sleep
+        self._random = random
+        self._buckets = {}
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, region, family):
+        key = (region, family)
+        with self._lock:
+            if key not in self._buckets:
+                rate, capacity = self.rates[family]
+                bucket = self._buckets[key] = TokenBucket(rate, capacity, self._clock, self._sleep)
+                if self.metrics is not None:
+                    self.metrics.set('rate_limit_per_second', lambda: bucket.rate, region=region, family=family)
+            return self._buckets[key]
+
+    def budget(self, region):
+        with self._lock:
+            if region not in self._budgets:
+                self._budgets[region] = RetryBudget()
+            return self._budgets[region]
+
+    def acquire(self, region, family):
+        if family is None or family not in self.rates:
+            return 0.0
+        return self.bucket(region, family).acquire()
+
+    def call(self, region, family, function, *args, **kwargs):
+        """ Call an API method within the rate limit, retrying throttled and transient failures
+
+        Throttling slows the family down for every caller in the region. The
+        error is raised once it isn't retryable, MAX_ATTEMPTS have been made
+        or the region's retry budget is spent.
+        """
+        limited = family is not None and family in self.rates
+        attempt = 0
+        while True:
+            self.acquire(region, family)
+            try:
+                result = function(*args, **kwargs)
+            except Exception as error:
+                throttled = is_throttle(error)
+                if throttled and limited and self.bucket(region, family).decrease():
+                    kvlog.info("throttled, slowing down", {
+                        "region": region,
+                        "family": family,
+                        "rate": round(self.bucket(region, family).rate, 2)
+                    })
+                attempt += 1
+                retryable = throttled or (family == 'describe' and is_transient(error))
+                if not retryable or attempt >= MAX_ATTEMPTS or not self.budget(region).withdraw():
+                    raise
+                if self.metrics is not None:
+                    self.metrics.inc('aws_api_retries_total', region=region, family=family or 'other',
+                                     code=error_code(error))
+                self._sleep(self._random() * min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+                continue
+            if limited:
+                self.bucket(region, family).increase()
+            self.budget(region).deposit()
+            return result
+
+
+class RateLimitedClient(object):
+
+    """
+    Proxy for a boto2 EC2 connection or boto3 EC2 client which makes every
+    API call through the shared limiter (see RateLimiter.call). Paginators
+    returned by get_paginator take a token per page, and retry a failed page
+    from where they left off.
+    """
+
+    def __init__(self, client, limiter, region):
+        self._client = client
+        self._limiter = limiter
+        self._region = region
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        if name == 'get_paginator':
+            return lambda operation: _RateLimitedPaginator(
+                attr(operation), self._limiter, self._region, api_family(operation))
+        if name in RAW_REQUEST_METHODS:
+            def call_action(action, *args, **kwargs):
+                return self._limiter.call(self._region, api_family(action), attr, action, *args, **kwargs)
+            return call_action
+        family = api_family(name)
+        if family is None:
+            return attr
+
+        def call(*args, **kwargs):
+            return self._limiter.call(self._region, family, attr, *args, **kwargs)
+        return call
+
+
+class _RateLimitedPaginator(object):
+
+    def __init__(self, paginator, limiter, region, family):
+        self._paginator = paginator
+        self._limiter = limiter
+        self._region = region
+        self._family = family
+
+    def paginate(self, **kwargs):
+        pages = _ResumablePages(self._paginator, kwargs)
+        while True:
+            page = self._limiter.call(self._region, self._family, pages.next_page)
+            if page is None:
+                return
+            yield page
+
+
+class _ResumablePages(object):
+
+    """ Pages of a boto3 paginator. After a failed page, the next one starts over from the last NextToken """
+
+    def __init__(self, paginator, kwargs):
+        self._paginator = paginator
+        self._config = kwargs.pop('PaginationConfig', {})
+        self._kwargs = kwargs
+        self._token = self._config.get('StartingToken')
+        self._pages = None
+
+    def next_page(self):
+        """ The next page, or None after the last one """
+        if self._pages is None:
+            config = dict(self._config, StartingToken=self._token) if self._token else self._config
+            self._pages = iter(self._paginator.paginate(PaginationConfig=config, **self._kwargs))
+        try:
+            page = next(self._pages, None)
+        except Exception:
+            self._pages = None
+            raise
+        if page is not None:
+            self._token = page.get('NextToken')
+        return page
@@ -1,8 +1,9 @@
-import yaml
 from backup_config import BackupConfig
 import kayvee
-from boto import connect_s3
-import boto
+import clients
+import metrics
+import time
+from boto.exception import S3ResponseError
 from urlparse import urlparse
 
 
@@ -13,17 +14,43 @@ class S3BackupConfig(BackupConfig):
 
     def __init__(self, path):
         self.path = path
+        self._bucket = None
+        self._etag = None
+        self._parsed = None
+
+    def _get_key(self):
+        """ New Key each time (a Key holds on to its last response), but the bucket is looked up once """
+        if self._bucket is None:
+            s3_connection = clients.registry.s3_connection()
+            s3_bucket = urlparse(self.path).hostname
+            self._bucket = s3_connection.lookup(s3_bucket)
+        from boto.s3.key import Key
+        k = Key(self._bucket)
+        k.key = urlparse(self.path).path[1:]  # no leading /
+        return k
 
     def refresh(self):
-        """ Read s3 path and return parsed yml """
-        # Get data from s3
-        s3_connection = connect_s3()
-        s3_bucket = urlparse(self.path).hostname
-        s3_path = urlparse(self.path).path[1:]  # no leading /
-        bucket = s3_connection.lookup(s3_bucket)
-        k = boto.s3.key.Key(bucket)
-        k.key = s3_path
-        s = k.get_contents_as_string()
+        """ Read s3 path and return parsed yml. Only downloads and re-parses if the object's ETag changed """
+        k = self._get_key()
+        headers = {}
+        if self._etag is not None:
+            headers['If-None-Match'] = self._etag
+        start = time.time()
+        try:
+            s = k.get_contents_as_string(headers=headers)
+        except S3ResponseError as error:
+            if error.status == 304:
+                metrics.record_call(metrics.registry, 's3', '', 'GetObject', time.time() - start)
+                return self._parsed
+            metrics.record_call(metrics.registry, 's3', '', 'GetObject', time.time() - start, error)
+            raise
+        metrics.record_call(metrics.registry, 's3', '', 'GetObject', time.time() - start)
+        if self._etag is not None and k.etag == self._etag:
+            return self._parsed
 
         # Update backup config
-        return yaml.load(s)
+        import yaml
+        parsed = yaml.load(s)
+        self._etag = k.etag
+        self._parsed = parsed
+        return parsed
@@ -0,0 +1,54 @@
+""" Priority queue of the times at which volumes next need attention """
+import heapq
+
+
+class Scheduler:
+
+    """
+    Min-heap of (deadline, volume id). Rescheduling a volume pushes a new entry
+    and leaves the old one in the heap; stale entries are skipped when popped.
+    """
+
+    def __init__(self):
+        self._queue = []
+        self._deadlines = {}
+
+    def __contains__(self, volume_id):
+        return volume_id in self._deadlines
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def volume_ids(self):
+        return self._deadlines.keys()
+
+    def schedule(self, volume_id, deadline):
+        """ Set (or move) the deadline of a volume, in epoch seconds """
+        self._deadlines[volume_id] = deadline
+        heapq.heappush(self._queue, (deadline, volume_id))
+
+    def remove(self, volume_id):
+        self._deadlines.pop(volume_id, None)
+
+    def _drop_stale(self):
+        while self._queue:
+            deadline, volume_id = self._queue[0]
+            if self._deadlines.get(volume_id) == deadline:
+                return
+            heapq.heappop(self._queue)
+
+    def next_deadline(self):
+        """ Earliest deadline, or None if nothing is scheduled """
+        self._drop_stale()
+        return self._queue[0][0] if self._queue else None
+
+    def pop_due(self, now):
+        """ Remove and return the ids of all volumes whose deadline has passed """
+        due = []
+        self._drop_stale()
+        while self._queue and self._queue[0][0] <= now:
+            deadline, volume_id = heapq.heappop(self._queue)
+            del self._deadlines[volume_id]
+            due.append(volume_id)
+            self._drop_stale()
+        return due
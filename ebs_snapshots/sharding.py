@@ -0,0 +1,228 @@
+""" Split the configured volumes between daemon replicas by consistent hashing, with membership kept by leases """
+import bisect
+import calendar
+import datetime
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+from urlparse import urlparse
+import clients
+import kvlog
+import metrics
+
+""" Seconds a replica's lease lasts without renewal, and how long it waits before taking over volumes """
+DEFAULT_LEASE_TTL = 60
+
+""" Points per replica on the hash ring. More points spread volumes more evenly """
+DEFAULT_VNODES = 64
+
+S3_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def _hash(key):
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+def default_replica_id():
+    """ hostname:pid, unique among replicas unless set by REPLICA_ID """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class HashRing:
+
+    """
+    Consistent hash ring of replica ids. Adding or removing a replica only
+    moves the keys of the ring segments it gains or loses.
+    """
+
+    def __init__(self, members, vnodes=DEFAULT_VNODES):
+        self.members = frozenset(members)
+        self._points = sorted((_hash('{}#{}'.format(m, i)), m) for m in self.members for i in range(vnodes))
+        self._hashes = [h for h, _ in self._points]
+
+    def owner(self, key):
+        """ Replica id owning a key, or None if the ring is empty """
+        if not self._points:
+            return None
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._points)
+        return self._points[i][1]
+
+
+class LeaseStore:
+
+    """
+    Interface shared by lease stores: where replicas record that they are
+    alive. A lease lasts ttl seconds from its last renewal.
+    """
+
+    def renew(self, replica_id):
+        raise NotImplementedError()
+
+    def release(self, replica_id):
+        raise NotImplementedError()
+
+    def live(self):
+        """ Ids of replicas with unexpired leases """
+        raise NotImplementedError()
+
+
+class SQLiteLeaseStore(LeaseStore):
+
+    """ Leases in a SQLite file, for replicas on one host (or tests) """
+
+    def __init__(self, path, ttl=DEFAULT_LEASE_TTL, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self._clock = clock
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._execute("CREATE TABLE IF NOT EXISTS leases (replica TEXT PRIMARY KEY, expires REAL)")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            with self._db:
+                return self._db.execute(sql, params).fetchall()
+
+    def renew(self, replica_id):
+        self._execute("INSERT OR REPLACE INTO leases (replica, expires) VALUES (?, ?)",
+                      (replica_id, self._clock() + self.ttl))
+
+    def release(self, replica_id):
+        self._execute("DELETE FROM leases WHERE replica = ?", (replica_id,))
+
+    def live(self):
+        return [row[0] for row in self._execute("SELECT replica FROM leases WHERE expires > ?", (self._clock(),))]
+
+
+class S3LeaseStore(LeaseStore):
+
+    """
+    One object per replica under an S3 prefix, renewed by rewriting it. A
+    lease is live while its LastModified is less than ttl old, so replica
+    clocks need to be in sync to well within ttl.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_LEASE_TTL, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self._clock = clock
+        parsed = urlparse(path)
+        self._bucket_name = parsed.hostname
+        self._prefix = parsed.path[1:].rstrip('/') + '/' if parsed.path.strip('/') else ''
+        self._bucket = None
+
+    def _get_bucket(self):
+        if self._bucket is None:
+            self._bucket = clients.registry.s3_connection().get_bucket(self._bucket_name, validate=False)
+        return self._bucket
+
+    def renew(self, replica_id):
+        self._get_bucket().new_key(self._prefix + replica_id).set_contents_from_string(replica_id)
+
+    def release(self, replica_id):
+        self._get_bucket().delete_key(self._prefix + replica_id)
+
+    def live(self):
+        now = self._clock()
+        live = []
+        for key in self._get_bucket().list(prefix=self._prefix):
+            modified = datetime.datetime.strptime(key.last_modified, S3_TIME_FORMAT)
+            if calendar.timegm(modified.utctimetuple()) + self.ttl > now:
+                live.append(key.name[len(self._prefix):])
+        return live
+
+
+def get_lease_store(path, ttl=DEFAULT_LEASE_TTL):
+    """ Lease store for an s3://bucket/prefix or SQLite file path """
+    if path.startswith("s3://"):
+        return S3LeaseStore(path, ttl)
+    return SQLiteLeaseStore(path, ttl)
+
+
+class Shard(object):
+
+    """
+    The part of the volume set this replica owns
+
+    A heartbeat thread renews this replica's lease and rebuilds the hash
+    ring whenever the set of live replicas changes. Volumes a replica gains
+    are only taken over once every ring of the last ttl seconds agrees, so
+    the previous owner has had a heartbeat to see the change and let go,
+    and a replica that can't renew its lease gives up all its volumes
+    before the others take them.
+    """
+
+    def __init__(self, store, replica_id=None, ttl=DEFAULT_LEASE_TTL, vnodes=DEFAULT_VNODES, clock=time.time):
+        self.store = store
+        self.replica_id = replica_id or default_replica_id()
+        self.ttl = ttl
+        self.vnodes = vnodes
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._renewed = None
+        # (in effect since, ring), oldest first. An empty ring to start with,
+        # so a new replica takes nothing over until it has been up for ttl.
+        self._rings = [(clock(), HashRing([], vnodes))]
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def heartbeat(self):
+        """ Renew the lease and pick up membership changes """
+        try:
+            self.store.renew(self.replica_id)
+            renewed = self._clock()
+            members = set(self.store.live()) | set([self.replica_id])
+        except Exception as error:
+            # Not just AWS and SQLite errors: a socket or SSL error mustn't end the heartbeat thread
+            kvlog.warning("could not renew shard lease", {"replica": self.replica_id, "error": str(error)})
+            return
+        with self._lock:
+            self._renewed = renewed
+            if members != self._rings[-1][1].members:
+                self._rings.append((renewed, HashRing(members, self.vnodes)))
+                kvlog.info("shard membership changed", {"replica": self.replica_id, "replicas": sorted(members)})
+            # Drop rings superseded more than ttl ago
+            while len(self._rings) > 1 and self._rings[1][0] <= renewed - self.ttl:
+                self._rings.pop(0)
+        metrics.registry.set('shard_replicas', len(members))
+
+    def owns(self, key):
+        """ Whether this replica should process a volume (or instance) id """
+        now = self._clock()
+        with self._lock:
+            if self._renewed is None or now - self._renewed >= self.ttl:
+                return False
+            # Rings in effect at any point in the last ttl seconds
+            rings = [ring for (since, ring), (superseded, _) in zip(self._rings, self._rings[1:])
+                     if superseded > now - self.ttl]
+            rings.append(self._rings[-1][1])
+        return all(ring.owner(key) == self.replica_id for ring in rings)
+
+    def filter(self, config):
+        """ The config items this replica owns. An instance's volumes go by the instance id """
+        return dict((volume_id, params) for volume_id, params in config.iteritems()
+                    if self.owns(params.get('instance') or volume_id))
+
+    def start(self):
+        """ Heartbeat every third of ttl from a background thread """
+        self.heartbeat()
+
+        def run():
+            while not self._stopped.wait(self.ttl / 3.0):
+                self.heartbeat()
+        self._thread = threading.Thread(target=kvlog.with_current_summary(run), name='shard-heartbeat')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the heartbeat and release the lease, so the others take over without waiting for it to expire """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.store.release(self.replica_id)
+        except Exception as error:
+            kvlog.warning("could not release shard lease", {"replica": self.replica_id, "error": str(error)})
@@ -0,0 +1,119 @@
+""" Per-volume index of snapshots by start time, with each start time parsed once """
+import bisect
+import calendar
+import datetime
+from array import array
+
+START_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def parse_start_time(start_time):
+    """ Epoch seconds of a boto2 start_time string, e.g. "2018-01-01T00:00:00.000Z"
+
+    Slices the fields out rather than going through strptime, which is most
+    of the cost for volumes with thousands of snapshots.
+    """
+    try:
+        seconds = calendar.timegm((int(start_time[0:4]), int(start_time[5:7]), int(start_time[8:10]),
+                                   int(start_time[11:13]), int(start_time[14:16]), int(start_time[17:19])))
+        fraction = start_time[19:-1]
+        return seconds + float(fraction) if fraction else float(seconds)
+    except ValueError:
+        timestamp = datetime.datetime.strptime(start_time, START_TIME_FORMAT)
+        return calendar.timegm(timestamp.utctimetuple()) + timestamp.microsecond / 1e6
+
+
+def snapshot_start(snapshot):
+    """ Start of a boto2 Snapshot, in epoch seconds """
+    return parse_start_time(snapshot.start_time)
+
+
+def backup_snapshot_start(snapshot_info):
+    """ Start of a boto3 snapshot dict, in epoch seconds """
+    start_time = snapshot_info["StartTime"]
+    return calendar.timegm(start_time.utctimetuple()) + start_time.microsecond / 1e6
+
+
+class SnapshotIndex(object):
+
+    """
+    Snapshots of one volume, oldest first, with their start times in epoch
+    seconds in a parallel array. The newest snapshot is the last one, and
+    the newest completed one is found by walking back over the few pending
+    snapshots after it.
+    """
+
+    __slots__ = ('starts', 'snapshots', '_start', '_id', '_status')
+
+    def __init__(self, snapshots=(), start=snapshot_start, id=lambda snapshot: snapshot.id,
+                 status=lambda snapshot: snapshot.status):
+        """
+        :type start: function
+        :param start: returns a snapshot's start time in epoch seconds
+        :type id: function
+        :param id: returns a snapshot's id
+        :type status: function
+        :param status: returns a snapshot's state, "pending", "completed" or "error"
+        """
+        entries = sorted(((start(s), s) for s in snapshots), key=lambda entry: entry[0])
+        self.starts = array('d', (t for t, _ in entries))
+        self.snapshots = [s for _, s in entries]
+        self._start = start
+        self._id = id
+        self._status = status
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def __iter__(self):
+        return iter(self.snapshots)
+
+    def add(self, snapshot):
+        start = self._start(snapshot)
+        i = bisect.bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.snapshots.insert(i, snapshot)
+
+    def remove(self, snapshot_id):
+        for i in range(len(self.snapshots) - 1, -1, -1):
+            if self._id(self.snapshots[i]) == snapshot_id:
+                del self.starts[i]
+                del self.snapshots[i]
+                return
+
+    def newest(self):
+        """ (start, snapshot) of the newest snapshot, or None """
+        if not self.snapshots:
+            return None
+        return self.starts[-1], self.snapshots[-1]
+
+    def status(self, i):
+        """ State of the i-th oldest snapshot """
+        return self._status(self.snapshots[i])
+
+    def newest_where(self, condition):
+        """ (start, snapshot) of the newest snapshot condition holds for, or None """
+        for i in range(len(self.snapshots) - 1, -1, -1):
+            if condition(self.snapshots[i]):
+                return self.starts[i], self.snapshots[i]
+        return None
+
+    def newest_completed(self):
+        return self.newest_where(lambda snapshot: self._status(snapshot) == "completed")
+
+    def pending_since_completed(self):
+        """ The pending snapshots newer than the newest completed one, newest first """
+        pending = []
+        for i in range(len(self.snapshots) - 1, -1, -1):
+            status = self._status(self.snapshots[i])
+            if status == "completed":
+                break
+            if status == "pending":
+                pending.append(self.snapshots[i])
+        return pending
+
+    def all_but_newest(self, keep):
+        """ The snapshots older than the `keep` newest, oldest first (none if keep is 0) """
+        if keep <= 0 or keep >= len(self.snapshots):
+            return []
+        return self.snapshots[:-keep]
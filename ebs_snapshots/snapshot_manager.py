@@ -1,15 +1,12 @@
 """ Module handling the snapshots """
 import datetime
-import yaml
-import boto3
+import time
 from botocore.exceptions import ClientError
 from boto.exception import EC2ResponseError
-import kayvee
-import logging
-import os
-
-
-aws_backup_region = os.environ.get('AWS_BACKUP_REGION')
+from boto.ec2.snapshot import Snapshot
+from dateutil.tz import tzutc
+from inventory import build_inventory, get_tag, CREATOR
+import kvlog
 
 """ Configure the valid backup intervals """
 VALID_INTERVALS = [
@@ -19,8 +16,50 @@ VALID_INTERVALS = [
     u'monthly',
     u'yearly']
 
-
-def run(connection, backup_client, volume_id, interval='daily', max_snapshots=0, name=''):
+""" Length of each backup interval in seconds """
+INTERVAL_SECONDS = {
+    u'hourly': 3600,
+    u'daily': 3600*24,
+    u'weekly': 3600*24*7,
+    u'monthly': 3600*24*30,
+    u'yearly': 3600*24*365,
+}
+
+""" Tiers of a retention policy, finest first, in the order _retention_buckets returns their buckets """
+RETENTION_TIERS = (u'hourly', u'daily', u'weekly', u'monthly', u'yearly')
+
+""" Changed blocks per ListChangedBlocks page (AWS allows 100 to 10000) """
+CHANGED_BLOCKS_PAGE_SIZE = 10000
+
+
+class CopyLimitExceeded(Exception):
+    """ The backup region has as many snapshot copies in flight as AWS allows """
+    pass
+
+
+
+def log_aws_error(error):
+    """ Log an error reaching AWS and route it to the oncall channel """
+    message = getattr(error, "message", "") or str(error)
+    kvlog.count('failed')
+    kvlog.error("failed to connect to AWS", {
+        "msg": message,
+        "_kvmeta": {
+            "team": "eng-infra",
+            "kv_version": "2.0.2",
+            "kv_language": "python",
+            "routes": [ {
+                "type": "notifications",
+                "channel": "#oncall-infra",
+                "icon": ":camera_with_flash:",
+                "user": "ebs-snapshots",
+                "message": "ERROR: " + str(message),
+            } ]
+        }
+    })
+
+def run(connection, backup_client, volume_id, interval='daily', max_snapshots=0, name='', inventory=None,
+        copy_queue=None, completion_tracker=None, ebs_client=None, retention=None, stagger=None):
     """ Ensure that we have snapshots for a given volume
 
     :type connection: boto.ec2.connection.EC2Connection
@@ -31,32 +70,131 @@ def run(connection, backup_client, volume_id, interval='daily', max_snapshots=0,
     :param volume_id: identifier for boto.ec2.volume.Volume
     :type max_snapshots: int
     :param max_snapshots: number of snapshots to keep (0 means infinite)
+    :type inventory: ebs_snapshots.inventory.SnapshotInventory
+    :param inventory: volumes and snapshots fetched for this cycle. Fetched
+        for this volume alone if not given.
+    :type copy_queue: ebs_snapshots.copy_queue.CopyQueue
+    :param copy_queue: if given, backup copies are queued here instead of started directly
+    :type completion_tracker: ebs_snapshots.completion_tracker.CompletionTracker
+    :param completion_tracker: if given, new snapshots are watched so they can
+        be copied as soon as they complete
+    :type ebs_client: boto3.EBS.Client
+    :param ebs_client: EBS direct APIs client for the primary region. If
+        given, a completed snapshot with no changed blocks since the previous
+        backed up one isn't copied (see _reuse_unchanged_backup)
+    :type retention: dict
+    :param retention: tiered retention policy, tier -> count (see
+        _expired_snapshots). Overrides max_snapshots if given
+    :type stagger: ebs_snapshots.stagger.Stagger
+    :param stagger: if given, the volume is due at its own offset into the
+        interval, and creates and copies over the stagger's caps are deferred
     :returns: None
     """
-    try:
-        volumes = connection.get_all_volumes([volume_id])
-    except EC2ResponseError as error:
-        logging.error(kayvee.formatLog("ebs-snapshots", "error", "failed to connect to AWS", {
-            "msg": error.message,
-            "_kvmeta": {
-                "team": "eng-infra",
-                "kv_version": "2.0.2",
-                "kv_language": "python",
-                "routes": [ {
-                    "type": "notifications",
-                    "channel": "#oncall-infra",
-                    "icon": ":camera_with_flash:",
-                    "user": "ebs-snapshots",
-                    "message": "ERROR: " + str(error.message),
-                } ]
-            }
-        }))
-        return
-    logging.info(kayvee.formatLog("ebs-snapshots", "info", "run", {"volume": volume_id, "count": len(volumes)}))
+    if inventory is None:
+        try:
+            inventory = build_inventory(connection, backup_client, [volume_id])
+        except (EC2ResponseError, ClientError) as error:
+            log_aws_error(error)
+            return
+    volumes = [inventory.volumes[volume_id]] if volume_id in inventory.volumes else []
+    kvlog.debug("run", {"volume": volume_id, "count": len(volumes)})
     for volume in volumes:
-        _ensure_snapshot(connection, backup_client, volume, interval, name)
-        _remove_old_snapshots(connection, volume, max_snapshots)
-        _remove_old_snapshot_backups(backup_client, volume.id, max_snapshots)
+        # A failed call is counted and the cycle goes on with the other volumes
+        try:
+            _ensure_snapshot(connection, backup_client, volume, interval, name, inventory, copy_queue,
+                             completion_tracker, ebs_client, stagger)
+            _remove_old_snapshots(connection, volume, max_snapshots, inventory, retention)
+            _remove_old_snapshot_backups(backup_client, volume.id, max_snapshots, inventory, retention)
+        except (EC2ResponseError, ClientError) as error:
+            log_aws_error(error)
+
+def run_instance(connection, backup_client, instance_id, volume_ids, interval='daily', max_snapshots=0, name='',
+                 exclude_boot_volume=False, inventory=None, copy_queue=None, completion_tracker=None,
+                 ebs_client=None, retention=None, stagger=None):
+    """ Ensure that we have snapshots for the volumes of an instance, taken together
+
+    When any of the volumes is due, all of them are snapshotted at the same
+    moment with one CreateSnapshots call, so the set is crash-consistent.
+    Copies and retention are handled per volume, as in run. With a stagger,
+    the volumes share the instance's offset.
+
+    :type instance_id: str
+    :param instance_id: instance the volumes are attached to
+    :type volume_ids: list
+    :param volume_ids: ids of the instance's volumes, as discovered
+    :type exclude_boot_volume: bool
+    :param exclude_boot_volume: leave the instance's root volume out of the snapshot set
+    :returns: None
+    """
+    if inventory is None:
+        try:
+            inventory = build_inventory(connection, backup_client, volume_ids)
+        except (EC2ResponseError, ClientError) as error:
+            log_aws_error(error)
+            return
+    volumes = [inventory.volumes[v] for v in volume_ids if v in inventory.volumes]
+    kvlog.debug("run instance", {"instance": instance_id, "count": len(volumes)})
+    if not volumes:
+        return
+
+    # A failed call is counted and the cycle goes on with the other volumes and instances
+    try:
+        states = {}
+        for volume in volumes:
+            state = _check_snapshots(volume, interval, name, inventory, completion_tracker, stagger, instance_id)
+            if state is not None:
+                states[volume.id] = state
+        due = any(state[0] for state in states.values())
+        if due and stagger is not None and not stagger.take('create', instance_id):
+            due = False
+        if due:
+            _create_instance_snapshots(connection, instance_id, volumes, name, exclude_boot_volume, inventory,
+                                       completion_tracker)
+
+        for volume in volumes:
+            if volume.id not in states:
+                continue
+            if due:
+                _backup_snapshot(backup_client, volume, states[volume.id][1], name, inventory,
+                                 copy_queue, ebs_client, stagger)
+            else:
+                kvlog.count('skipped')
+                _catch_up_backup(backup_client, volume, states[volume.id][1], name, inventory,
+                                 copy_queue, completion_tracker, ebs_client, stagger)
+            _remove_old_snapshots(connection, volume, max_snapshots, inventory, retention)
+            _remove_old_snapshot_backups(backup_client, volume.id, max_snapshots, inventory, retention)
+    except (EC2ResponseError, ClientError) as error:
+        log_aws_error(error)
+
+def newest_start(index):
+    """ Start time of a volume's newest snapshot
+
+    :type index: ebs_snapshots.snapshot_index.SnapshotIndex
+    :param index: the volume's snapshots, see SnapshotInventory.snapshot_index
+    :returns: int -- epoch seconds, or None if there are no snapshots
+    """
+    newest = index.newest()
+    return None if newest is None else int(newest[0])
+
+def next_due(index, interval, stagger=None, key=None):
+    """ When a volume next needs a snapshot, per the rule in _check_snapshots
+
+    :type index: ebs_snapshots.snapshot_index.SnapshotIndex
+    :param index: the volume's snapshots, see SnapshotInventory.snapshot_index
+    :type interval: str
+    :param interval: one of VALID_INTERVALS
+    :type stagger: ebs_snapshots.stagger.Stagger
+    :param stagger: if given, the volume (or instance) id key is due at its own offset into the interval
+    :returns: float -- epoch seconds, or None if the volume is due now
+    """
+    newest = newest_start(index)
+    if newest is None:
+        return None
+    if stagger is not None:
+        return stagger.due_at(key, INTERVAL_SECONDS[interval], newest)
+    # _check_snapshots only creates once the newest is strictly older than the interval
+    return newest + INTERVAL_SECONDS[interval] + 1
+
 
 def _create_snapshot(connection, volume, name=''):
     """ Create a new snapshot
@@ -65,20 +203,88 @@ def _create_snapshot(connection, volume, name=''):
     :param volume: Volume to snapshot
     :returns: boto.ec2.snapshot.Snapshot -- The new snapshot
     """
-    logging.info(kayvee.formatLog("ebs-snapshots", "info", "creating new snapshot", {"volume": volume.id}))
-    snapshot = volume.create_snapshot(
-        description="automatic snapshot by ebs-snapshots")
+    kvlog.debug("creating new snapshot", {"volume": volume.id})
     if not name:
         name = '{}-snapshot'.format(volume.id)
-    connection.create_tags(
-        [snapshot.id], dict(Name=name, creator='ebs-snapshots'))
-    logging.info(kayvee.formatLog("ebs-snapshots", "info", "created snapshot successfully", {
+
+    # Tagged on creation, so the snapshot is never visible without its creator tag.
+    # boto2's create_snapshot doesn't take tags, so build the request ourselves.
+    params = {
+        'VolumeId': volume.id,
+        'Description': "automatic snapshot by ebs-snapshots",
+    }
+    params.update(_tag_specification_params(dict(Name=name, creator=CREATOR)))
+    snapshot = connection.get_object('CreateSnapshot', params, Snapshot, verb='POST')
+    kvlog.count('created')
+    kvlog.info("created snapshot successfully", {
         "name": name,
         "volume": volume.id,
         "snapshot": snapshot.id
-    }))
+    })
     return snapshot
 
+def _tag_specification_params(tags, resource_type='snapshot', index=1):
+    """ Query API params for a TagSpecification, for requests made through boto2
+
+    :type tags: dict
+    :param tags: tag key -> value
+    :returns: dict
+    """
+    prefix = 'TagSpecification.{}.'.format(index)
+    params = {prefix + 'ResourceType': resource_type}
+    for i, key in enumerate(sorted(tags), 1):
+        params['{}Tag.{}.Key'.format(prefix, i)] = key
+        params['{}Tag.{}.Value'.format(prefix, i)] = tags[key]
+    return params
+
+def _create_and_watch_snapshot(connection, volume, name, inventory, completion_tracker=None):
+    """ Create a snapshot, record it in the inventory and watch it until it completes """
+    snapshot = _create_snapshot(connection, volume, name)
+    inventory.add_snapshot(volume.id, snapshot)
+    if completion_tracker is not None:
+        completion_tracker.watch(snapshot.id, volume, name)
+
+def _create_instance_snapshots(connection, instance_id, volumes, name, exclude_boot_volume, inventory,
+                               completion_tracker=None):
+    """ Snapshot every volume attached to an instance with one CreateSnapshots call
+
+    :type volumes: list
+    :param volumes: boto.ec2.volume.Volume objects of the instance. Snapshots
+        of volumes not listed here (e.g. attached since discovery) are made
+        but not recorded in the inventory.
+    :returns: list -- the new boto.ec2.snapshot.Snapshot objects
+    """
+    kvlog.debug("creating new instance snapshots", {"instance": instance_id})
+    if not name:
+        name = '{}-snapshot'.format(instance_id)
+
+    # boto2 predates CreateSnapshots, so build the request ourselves
+    params = {
+        'InstanceSpecification.InstanceId': instance_id,
+        'InstanceSpecification.ExcludeBootVolume': 'true' if exclude_boot_volume else 'false',
+        'Description': "automatic snapshot by ebs-snapshots",
+    }
+    params.update(_tag_specification_params(dict(Name=name, creator=CREATOR)))
+    snapshots = connection.get_list('CreateSnapshots', params, [('item', Snapshot)], verb='POST')
+
+    by_id = dict((volume.id, volume) for volume in volumes)
+    for snapshot in snapshots:
+        # CreateSnapshots reports "state" rather than the "status" boto's Snapshot reads
+        snapshot.status = getattr(snapshot, 'state', None) or 'pending'
+        volume = by_id.get(snapshot.volume_id)
+        if volume is None:
+            continue
+        inventory.add_snapshot(volume.id, snapshot)
+        if completion_tracker is not None:
+            completion_tracker.watch(snapshot.id, volume, name)
+    kvlog.count('created', len(snapshots))
+    kvlog.info("created instance snapshots successfully", {
+        "name": name,
+        "instance": instance_id,
+        "snapshots": [snapshot.id for snapshot in snapshots]
+    })
+    return snapshots
+
 def _availability_zone_to_region_name(zone):
     """Get the region_name from an availability zone by removing last letter
 
@@ -88,7 +294,7 @@ def _availability_zone_to_region_name(zone):
     """
     return zone[:-1]
 
-def _copy_snapshot(backup_client, volume, snapshot_id, name):
+def _copy_snapshot(backup_client, volume, snapshot_id, name, raise_on_limit=False):
     """ Copy a snapshot to another region
 
     :type backup_client: boto3.EC2.Client
@@ -97,9 +303,12 @@ def _copy_snapshot(backup_client, volume, snapshot_id, name):
     :param volume: Volume that snapshot is of
     :type snapshot_id: str
     :param snapshot_id: identifier for boto.ec2.snapshot.Snapshot (the snapshot to copy)
+    :type raise_on_limit: bool
+    :param raise_on_limit: raise CopyLimitExceeded instead of dropping the copy
+        when the concurrent copy limit is hit
     :returns: str -- the id of the copy
     """
-    logging.info(kayvee.formatLog("ebs-snapshots", "info", "copying snapshot", {"volume": volume.id, "source_snapshot": snapshot_id}))
+    kvlog.debug("copying snapshot", {"volume": volume.id, "source_snapshot": snapshot_id})
     region = _availability_zone_to_region_name(volume.zone)
 
     try:
@@ -107,55 +316,54 @@ def _copy_snapshot(backup_client, volume, snapshot_id, name):
             SourceRegion=region,
             SourceSnapshotId=snapshot_id,
             Encrypted=True,
-            Description='copy of {}'.format(snapshot_id))
+            Description='copy of {}'.format(snapshot_id),
+            TagSpecifications=[{
+                "ResourceType": "snapshot",
+                "Tags": [
+                    {"Key":"Name", "Value":name},
+                    {"Key":"creator", "Value":CREATOR},
+                    {"Key":"source_snapshot", "Value":snapshot_id},
+                    {"Key":"volume-id", "Value":volume.id}
+                ]
+            }])
 
     except ClientError as error:
         if error.response["Error"]["Code"] == "ResourceLimitExceeded":
-            logging.info(kayvee.formatLog("ebs-snapshots", "info", "copying snapshot", {
+            kvlog.info("snapshot copy limit reached", {
                 "volume": volume.id,
                 "source_snapshot": snapshot_id,
                 "name": name
-            }))
+            })
+            if raise_on_limit:
+                raise CopyLimitExceeded()
         else:
-            logging.error(kayvee.formatLog("ebs-snapshots", "error", "snapshot copy error", {
+            kvlog.count('failed')
+            kvlog.error("snapshot copy error", {
                 "name": name,
                 "volume": volume.id,
                 "source_snapshot": snapshot_id,
                 "error": error.response["Error"]["Code"]
-            }))
+            })
         return None
 
-    try:
-        backup_client.create_tags(
-            Resources=[response["SnapshotId"]],
-            Tags=[
-                {"Key":"Name", "Value":name},
-                {"Key":"creator", "Value":"ebs-snapshots"},
-                {"Key":"source_snapshot", "Value":snapshot_id},
-                {"Key":"volume-id", "Value":volume.id}
-            ]
-        )
-    except ClientError as error:
-        logging.error(kayvee.formatLog("ebs-snapshots", "error", "unable to tag snapshot copy (error)", {
-            "name": name,
-            "volume": volume.id,
-            "source_snapshot": snapshot_id,
-            "error": error.response["Error"]["Code"]
-        }))
-        return response["SnapshotId"]
-
-    logging.info(kayvee.formatLog("ebs-snapshots", "info", "copied snapshot successfully", {
+    kvlog.count('copied')
+    kvlog.info("copied snapshot successfully", {
         "name": name,
         "volume": volume.id,
         "source_snapshot": snapshot_id,
         "snapshot_copy": response["SnapshotId"]
-    }))
+    })
 
     return response["SnapshotId"]
 
-def _ensure_snapshot(connection, backup_client, volume, interval, name):
+def _ensure_snapshot(connection, backup_client, volume, interval, name, inventory, copy_queue=None,
+                     completion_tracker=None, ebs_client=None, stagger=None):
     """ Ensure that a given volume has appropriate snapshot(s) and backup snapshot(s)
 
+    Whether or not the volume is due, its newest completed snapshot is
+    copied if it has no backup yet, e.g. because it completed while the
+    daemon was down or its copy failed.
+
     :type connection: boto.ec2.connection.EC2Connection
     :param connection: EC2 connection object
     :type backup_client: boto3.EC2.Client
@@ -164,154 +372,367 @@ def _ensure_snapshot(connection, backup_client, volume, interval, name):
     :param volume: Volume to check
     :type name: str
     :param name: a name to tag the snapshot(s) with
+    :type inventory: ebs_snapshots.inventory.SnapshotInventory
+    :param inventory: volumes and snapshots fetched for this cycle
+    :type copy_queue: ebs_snapshots.copy_queue.CopyQueue
+    :param copy_queue: if given, backup copies are queued here instead of started directly
+    :type completion_tracker: ebs_snapshots.completion_tracker.CompletionTracker
+    :param completion_tracker: if given, pending snapshots are watched so they
+        can be copied as soon as they complete
+    :type ebs_client: boto3.EBS.Client
+    :param ebs_client: if given, unchanged snapshots reuse the previous backup
+        copy. Snapshots completed since the last cycle are copied (or not) in
+        this one, so don't also pass a completion_tracker.
+    :type stagger: ebs_snapshots.stagger.Stagger
+    :param stagger: if given, decides when the volume is due and caps creates and copies
     :returns: None
     """
+    state = _check_snapshots(volume, interval, name, inventory, completion_tracker, stagger)
+    if state is None:
+        return
+    due, latest_complete_snapshot_id = state
+    if due and stagger is not None and not stagger.take('create', volume.id):
+        due = False
+    if not due:
+        kvlog.count('skipped')
+        _catch_up_backup(backup_client, volume, latest_complete_snapshot_id, name, inventory,
+                         copy_queue, completion_tracker, ebs_client, stagger)
+        return
+
+    _create_and_watch_snapshot(connection, volume, name, inventory, completion_tracker)
+    # copy the last completed one to backup region
+    _backup_snapshot(backup_client, volume, latest_complete_snapshot_id, name, inventory, copy_queue,
+                     ebs_client, stagger)
+
+def _check_snapshots(volume, interval, name, inventory, completion_tracker=None, stagger=None, key=None):
+    """ Whether a volume is due for a new snapshot, and its newest completed snapshot
+
+    A volume is due once its newest snapshot is older than the interval or,
+    with a stagger, once the volume's next offset point has passed. Pending
+    snapshots are handed to the completion tracker along the way.
+
+    :type volume: boto.ec2.volume.Volume
+    :param volume: Volume to check
+    :type inventory: ebs_snapshots.inventory.SnapshotInventory
+    :param inventory: volumes and snapshots fetched for this cycle
+    :type key: str
+    :param key: id whose offset the stagger uses, the volume id by default
+    :returns: tuple -- (due, id of the newest completed snapshot or None),
+        or None if the interval is invalid
+    """
     if interval not in VALID_INTERVALS:
-        logging.warning(kayvee.formatLog("ebs-snapshots", "warning", "invalid snapshotting interval", {
+        kvlog.count('failed')
+        kvlog.warning("invalid snapshotting interval", {
             "volume": volume.id,
             "interval": interval
-        }))
-        return
+        })
+        return None
+
+    index = inventory.snapshot_index(volume.id)
 
-    snapshots = connection.get_all_snapshots(filters={'volume-id': volume.id})
+    # Pick up snapshots still pending from before a restart
+    if completion_tracker is not None:
+        for snapshot in index.pending_since_completed():
+            completion_tracker.watch(snapshot.id, volume, name)
 
     # Create a snapshot if we don't have any
-    if not snapshots:
-        logging.info(kayvee.formatLog("ebs-snapshots", "info", "no snapshots found - creating snapshot", {"volume": volume.id}))
-        _create_snapshot(connection, volume, name)
+    newest = index.newest()
+    if newest is None:
+        kvlog.info("no snapshots found - creating snapshot", {"volume": volume.id})
+        return True, None
+
+    newest_start, latest_snapshot = newest
+    age = int(inventory.now - newest_start)
+    newest_completed = index.newest_completed()
+    latest_complete_snapshot_id = None if newest_completed is None else newest_completed[1].id
+
+    kvlog.debug("newest snapshot", {
+        "volume": volume.id,
+        "snapshot": latest_snapshot.id,
+        "age_seconds": age,
+        "completed_snapshot": latest_complete_snapshot_id,
+        "completed_age_seconds": None if newest_completed is None else int(inventory.now - newest_completed[0]),
+    })
+
+    # Due if latest is older than interval, or past its offset point
+    if stagger is not None:
+        due = inventory.now >= stagger.due_at(key or volume.id, INTERVAL_SECONDS[interval], newest_start)
+    else:
+        due = age > INTERVAL_SECONDS[interval]
+    if due:
+        return True, latest_complete_snapshot_id
+    kvlog.debug("no snapshot needed", {"volume": volume.id, "lastest_snapshot_id": latest_snapshot.id})
+    return False, latest_complete_snapshot_id
+
+def _backup_snapshot(backup_client, volume, snapshot_id, name, inventory, copy_queue=None,
+                     ebs_client=None, stagger=None):
+    """ Copy a completed snapshot to the backup region, unless it has been already
+
+    :type snapshot_id: str
+    :param snapshot_id: the snapshot to copy, or None if the volume has no completed snapshot yet
+    :type ebs_client: boto3.EBS.Client
+    :param ebs_client: if given, reuse the previous backup copy when no blocks changed
+    :type stagger: ebs_snapshots.stagger.Stagger
+    :param stagger: if given and there is no copy queue, copies over its cap
+        are left to a later cycle (a copy queue applies the cap itself)
+    :returns: None
+    """
+    if snapshot_id is None:
+        kvlog.debug("waiting to create backup snapshot until snapshot is complete", {"volume": volume.id})
+    elif inventory.has_backup(volume.id, snapshot_id):
+        kvlog.debug("backup snapshot already exists", {
+            "volume": volume.id,
+            "source_snapshot": snapshot_id
+        })
+    elif ebs_client is not None and _reuse_unchanged_backup(
+            backup_client, ebs_client, volume, snapshot_id, inventory):
+        return
+    elif copy_queue is not None:
+        copy_queue.enqueue(volume, snapshot_id, name)
+    elif stagger is not None and not stagger.take('copy', volume.id):
+        return
+    else:
+        copy_id = _copy_snapshot(backup_client, volume, snapshot_id, name)
+        if copy_id is not None:
+            inventory.add_backup_snapshot(volume.id, {
+                "SnapshotId": copy_id,
+                "StartTime": datetime.datetime.fromtimestamp(inventory.now, tzutc()),
+                "State": "pending",
+                "Tags": [{"Key": "source_snapshot", "Value": snapshot_id}],
+            })
+
+def _catch_up_backup(backup_client, volume, snapshot_id, name, inventory, copy_queue=None,
+                     completion_tracker=None, ebs_client=None, stagger=None):
+    """ Copy a volume's newest completed snapshot between its creations, if it has no backup
+
+    Snapshots the completion tracker is still watching are left to it, so
+    they aren't copied twice.
+    """
+    if snapshot_id is None or (completion_tracker is not None and snapshot_id in completion_tracker):
         return
+    _backup_snapshot(backup_client, volume, snapshot_id, name, inventory, copy_queue, ebs_client,
+                     stagger)
 
-    latest_snapshot_id = None
-    min_delta = 3600 * 24 * 365 * 10  # 10 years :)
+def _has_changed_blocks(ebs_client, first_snapshot_id, second_snapshot_id):
+    """ Whether any block of a volume differs between two of its snapshots
 
-    latest_complete_snapshot_id = None
-    min_complete_snapshot_delta = 3600 * 24 * 365 * 10
+    Stops at the first page that lists a changed block.
 
-    for snapshot in snapshots:
-        # Determine time since latest snapshot.
-        timestamp = datetime.datetime.strptime(
-            snapshot.start_time,
-            '%Y-%m-%dT%H:%M:%S.%fZ')
-        delta_seconds = int(
-            (datetime.datetime.utcnow() - timestamp).total_seconds())
-
-        if delta_seconds < min_delta:
-            latest_snapshot_id = snapshot.id
-            min_delta = delta_seconds
-
-        # Determine latest completed snapshot's id.
-        if snapshot.status == "completed" and delta_seconds < min_complete_snapshot_delta:
-            latest_complete_snapshot_id = snapshot.id
-            min_complete_snapshot_delta = delta_seconds
-
-    logging.info(kayvee.formatLog("ebs-snapshots", "info", 'The newest snapshot for {} is {} seconds old (snapshot {})'.format(volume.id, min_delta, latest_snapshot_id), data={"volume":volume.id}))
-    logging.info(kayvee.formatLog("ebs-snapshots", "info", 'The newest completed snapshot for {} is {} seconds old (snapshot {})'.format(volume.id, min_complete_snapshot_delta, latest_complete_snapshot_id), data={"volume":volume.id}))
-
-    # Create snapshot if latest is older than interval.
-    intervalToSeconds = {
-        u'hourly': 3600,
-        u'daily': 3600*24,
-        u'weekly': 3600*24*7,
-        u'monthly': 3600*24*30,
-        u'yearly': 3600*24*365,
+    :type ebs_client: boto3.EBS.Client
+    :param ebs_client: EBS direct APIs client for the snapshots' region
+    :returns: bool
+    """
+    params = {
+        "FirstSnapshotId": first_snapshot_id,
+        "SecondSnapshotId": second_snapshot_id,
+        "MaxResults": CHANGED_BLOCKS_PAGE_SIZE,
     }
-    if min_delta > intervalToSeconds[interval]:
-        _create_snapshot(connection, volume, name)
-        # copy the last one we created to backup region
-        if latest_complete_snapshot_id is None:
-            logging.info(kayvee.formatLog("ebs-snapshots", "info", "waiting to create backup snapshot until snapshot is complete", {"volume": volume.id}))
-        else:
-            _copy_snapshot(backup_client, volume, latest_complete_snapshot_id, name)
-    else:
-        logging.info(kayvee.formatLog("ebs-snapshots", "info", "no snapshot needed", {"volume": volume.id, "lastest_snapshot_id": latest_snapshot_id}))
+    while True:
+        page = ebs_client.list_changed_blocks(**params)
+        if page.get("ChangedBlocks"):
+            return True
+        if not page.get("NextToken"):
+            return False
+        params["NextToken"] = page["NextToken"]
+
+def _reuse_unchanged_backup(backup_client, ebs_client, volume, snapshot_id, inventory):
+    """ Make the backup copy of the previous snapshot the backup of snapshot_id if no blocks changed in between
+
+    ListChangedBlocks only compares snapshots, so an idle volume still gets
+    its scheduled (empty, incremental) snapshot. What it stops generating is
+    cross-region copies: the previous copy is re-tagged as the backup of the
+    new snapshot. Both snapshots are left to retention.
+
+    :type snapshot_id: str
+    :param snapshot_id: a completed snapshot without a backup copy
+    :returns: bool -- True if the previous copy was reused and there is nothing to copy
+    """
+    index = inventory.snapshot_index(volume.id)
+    current = index.newest_where(lambda snapshot: snapshot.id == snapshot_id)
+    copies = dict((get_tag(info.get("Tags"), "source_snapshot"), info)
+                  for info in inventory.get_backup_snapshots(volume.id) if info.get("State") == "completed")
+    previous = current and index.newest_where(
+        lambda snapshot: snapshot.status == "completed" and snapshot.id in copies
+        and snapshot.start_time < current[1].start_time)
+    if not previous:
+        return False
+    previous = previous[1]
 
-def _remove_old_snapshot_backups(client, volume_id, max_snapshots):
+    try:
+        if _has_changed_blocks(ebs_client, previous.id, snapshot_id):
+            return False
+    except ClientError as error:
+        kvlog.warning("could not check for changed blocks", {
+            "volume": volume.id,
+            "snapshot": snapshot_id,
+            "error": error.response["Error"]["Code"]
+        })
+        return False
+
+    copy = copies[previous.id]
+    try:
+        backup_client.create_tags(Resources=[copy["SnapshotId"]],
+                                  Tags=[{"Key": "source_snapshot", "Value": snapshot_id}])
+    except ClientError as error:
+        kvlog.warning("could not re-tag backup snapshot", {
+            "volume": volume.id,
+            "snapshot_copy": copy["SnapshotId"],
+            "error": error.response["Error"]["Code"]
+        })
+        return False
+    tags = [t for t in copy.get("Tags") or [] if t["Key"] != "source_snapshot"]
+    tags.append({"Key": "source_snapshot", "Value": snapshot_id})
+    inventory.remove_backup_snapshot(volume.id, copy["SnapshotId"])
+    inventory.add_backup_snapshot(volume.id, dict(copy, Tags=tags))
+    kvlog.count('unchanged')
+    kvlog.info("volume unchanged - reusing backup snapshot", {
+        "volume": volume.id,
+        "snapshot": snapshot_id,
+        "snapshot_copy": copy["SnapshotId"],
+        "previous_snapshot": previous.id
+    })
+    return True
+
+def _retention_buckets(start):
+    """ The hour, day, week (starting Monday), month and year a snapshot start, in epoch seconds, falls in """
+    t = time.gmtime(start)
+    day = int(start // 86400)
+    # 1970-01-01 was a Thursday
+    return (day, t.tm_hour), day, (day + 3) // 7, (t.tm_year, t.tm_mon), t.tm_year
+
+def _expired_snapshots(index, max_snapshots, retention=None):
+    """ The snapshots a retention policy no longer keeps, oldest first
+
+    Without a tiered policy, all but the max_snapshots newest (0 keeps all).
+    With one, e.g. {"hourly": 24, "daily": 14, "weekly": 8, "monthly": 12},
+    each tier keeps the newest snapshot of each of its most recent hours,
+    days, ... that have one, as many as its count. A snapshot is kept if any
+    tier keeps it, and the newest one always is. This takes one pass over
+    the snapshots, newest first.
+
+    Snapshots still pending after the newest completed one are kept on top
+    of the policy, and the newest completed one is always kept, so a volume
+    is never left without a usable snapshot while a new one is in progress.
+
+    :type index: ebs_snapshots.snapshot_index.SnapshotIndex
+    :param index: the volume's snapshots or backup snapshots
+    :returns: list
+    """
+    newest_completed = None
+    for i in range(len(index) - 1, -1, -1):
+        if index.status(i) == "completed":
+            newest_completed = i
+            break
+    remaining = [retention.get(tier, 0) for tier in RETENTION_TIERS] if retention else None
+    last = [None] * len(RETENTION_TIERS)
+    counted = 0
+    expired = []
+    for i in range(len(index) - 1, -1, -1):
+        if index.status(i) == "pending" and (newest_completed is None or i > newest_completed):
+            continue
+        if remaining is None:
+            keep = max_snapshots <= 0 or counted < max_snapshots
+        else:
+            keep = counted == 0
+            for tier, bucket in enumerate(_retention_buckets(index.starts[i])):
+                if remaining[tier] > 0 and bucket != last[tier]:
+                    last[tier] = bucket
+                    remaining[tier] -= 1
+                    keep = True
+        counted += 1
+        if not keep and i != newest_completed:
+            expired.append(index.snapshots[i])
+    expired.reverse()
+    return expired
+
+def _remove_old_snapshot_backups(client, volume_id, max_snapshots, inventory, retention=None):
     """ Remove old snapshot backups
 
     :type client: boto3.EC2.Client
     :param client: EC2 client object
     :type volume_id: str
     :param volume_id: ID of volume to check
+    :type inventory: ebs_snapshots.inventory.SnapshotInventory
+    :param inventory: volumes and snapshots fetched for this cycle
+    :type retention: dict
+    :param retention: tiered retention policy, overrides max_snapshots if given
     :returns: None
     """
-    logging.info(kayvee.formatLog("ebs-snapshots", "info", "removing old backup snapshots", data={"volume":volume_id}))
+    kvlog.debug("removing old backup snapshots", {"volume":volume_id})
 
-    retention = max_snapshots
-    if not type(retention) is int and retention >= 0:
-        logging.warning(kayvee.formatLog("ebs-snapshots", "warning", "invalid max_snapshots value", {
+    if not type(max_snapshots) is int and max_snapshots >= 0:
+        kvlog.count('failed')
+        kvlog.warning("invalid max_snapshots value", {
             "volume": volume_id,
-            "max_snapshots": retention
-        }))
+            "max_snapshots": max_snapshots
+        })
         return
 
-    response = client.describe_snapshots(
-        Filters=[{ "Name": "tag:volume-id", "Values":[volume_id] }]
-    )
-    snapshots = response["Snapshots"]
-
+    snapshots = _expired_snapshots(inventory.backup_snapshot_index(volume_id), max_snapshots, retention)
 
-    # Sort the list based on the start time
-    snapshots.sort(key=lambda x: x["StartTime"])
-
-    # Remove snapshots we want to keep
-    snapshots = snapshots[:-int(retention)]
-
-    if not snapshots:
-        logging.info(kayvee.formatLog("ebs-snapshots", "info", "no old backup snapshots to remove", data={"volume":volume_id}))
-        return
-
-    ec2 = boto3.resource('ec2', region_name=aws_backup_region)
+    deleted = 0
     for snapshotInfo in snapshots:
-        snapshot = ec2.Snapshot(snapshotInfo["SnapshotId"])
-        logging.info(kayvee.formatLog("ebs-snapshots", "info", "deleting backup snapshot", {"snapshot": snapshot.id}))
+        deleted += 1
+        snapshot_id = snapshotInfo["SnapshotId"]
+        kvlog.info("deleting backup snapshot", {"snapshot": snapshot_id})
         try:
-            snapshot.delete()
-        except Exception as e:  # @TODO: how to get exceptions for boto3 resource?
-            logging.error(kayvee.formatLog("ebs-snapshots", "error", "could not remove backup snapshot (error)", {
-                "snapshot": snapshot.id,
-                "error": str(e)
-            }))
+            client.delete_snapshot(SnapshotId=snapshot_id)
+            inventory.remove_backup_snapshot(volume_id, snapshot_id)
+            kvlog.count('deleted')
+        except ClientError as error:
+            kvlog.count('failed')
+            kvlog.error("could not remove backup snapshot (error)", {
+                "snapshot": snapshot_id,
+                "error": error.response["Error"]["Code"]
+            })
 
-    logging.info(kayvee.formatLog("ebs-snapshots", "info", "done deleting snapshot backups", data={"volume":volume_id}))
+    if not deleted:
+        kvlog.debug("no old backup snapshots to remove", {"volume":volume_id})
+        return
+
+    kvlog.debug("done deleting snapshot backups", {"volume":volume_id})
 
-def _remove_old_snapshots(connection, volume, max_snapshots):
+def _remove_old_snapshots(connection, volume, max_snapshots, inventory, retention=None):
     """ Remove old snapshots
 
     :type connection: boto.ec2.connection.EC2Connection
     :param connection: EC2 connection object
     :type volume: boto.ec2.volume.Volume
     :param volume: Volume to check
+    :type inventory: ebs_snapshots.inventory.SnapshotInventory
+    :param inventory: volumes and snapshots fetched for this cycle
+    :type retention: dict
+    :param retention: tiered retention policy, overrides max_snapshots if given
     :returns: None
     """
-    logging.info(kayvee.formatLog("ebs-snapshots", "info", "removing old snapshots", data={"volume":volume.id}))
+    kvlog.debug("removing old snapshots", {"volume":volume.id})
 
-    retention = max_snapshots
-    if not type(retention) is int and retention >= 0:
-        logging.warning(kayvee.formatLog("ebs-snapshots", "warning", "invalid max_snapshots value", {
+    if not type(max_snapshots) is int and max_snapshots >= 0:
+        kvlog.count('failed')
+        kvlog.warning("invalid max_snapshots value", {
             "volume": volume.id,
-            "max_snapshots": retention
-        }))
-        return
-    snapshots = connection.get_all_snapshots(filters={'volume-id': volume.id})
-
-    # Sort the list based on the start time
-    snapshots.sort(key=lambda x: x.start_time)
-
-    # Remove snapshots we want to keep
-    snapshots = snapshots[:-int(retention)]
-
-    if not snapshots:
-        logging.info(kayvee.formatLog("ebs-snapshots", "info", "no old snapshots to remove", data={"volume":volume.id}))
+            "max_snapshots": max_snapshots
+        })
         return
+    snapshots = _expired_snapshots(inventory.snapshot_index(volume.id), max_snapshots, retention)
 
+    deleted = 0
     for snapshot in snapshots:
-        logging.info(kayvee.formatLog("ebs-snapshots", "info", "deleting snapshot", {"snapshot": snapshot.id}))
+        deleted += 1
+        kvlog.info("deleting snapshot", {"snapshot": snapshot.id})
         try:
-            snapshot.delete()
+            connection.delete_snapshot(snapshot.id)
+            inventory.remove_snapshot(volume.id, snapshot.id)
+            kvlog.count('deleted')
         except EC2ResponseError as error:
-            logging.warning(kayvee.formatLog("ebs-snapshots", "warning", "could not remove snapshot", {
+            kvlog.count('failed')
+            kvlog.warning("could not remove snapshot", {
                 "snapshot": snapshot.id,
                 "msg": error.message
-            }))
+            })
+
+    if not deleted:
+        kvlog.debug("no old snapshots to remove", {"volume":volume.id})
+        return
 
-    logging.info(kayvee.formatLog("ebs-snapshots", "info", "done deleting snapshots", data={"volume":volume.id}))
+    kvlog.debug("done deleting snapshots", {"volume":volume.id})
@@ -0,0 +1,83 @@
+""" Spread snapshot creation over each interval instead of bunching it where the daemon started """
+import hashlib
+import threading
+import time
+import kvlog
+import metrics
+
+""" Length of the time slices creates and copies are counted in, at least """
+SLICE_SECONDS = 60
+
+
+def offset(key, interval_seconds):
+    """ Stable offset of a volume (or instance) id within an interval, in seconds """
+    return int(hashlib.md5(key).hexdigest()[:12], 16) % interval_seconds
+
+
+class Stagger(object):
+
+    """
+    Staggered scheduling: each volume is due once per interval, at its own
+    offset into the interval (see due_at), so creates are spread evenly
+    rather than all happening in the cycle after a restart and again at
+    the same time every day. On top of that, creates and copies are capped
+    per minute, counted over slices of slice_seconds. Work over a cap is
+    deferred to a later cycle.
+
+    A cycle takes what its slice allows in one go, so with one cycle every
+    few minutes the slice should be as long as the cycle, or only one
+    minute's worth would be used per cycle (see ebs_snapshots_daemon.load_targets).
+
+    :type creates_per_minute: int
+    :param creates_per_minute: snapshots created per minute (0 for no cap)
+    :type copies_per_minute: int
+    :param copies_per_minute: copies started per minute (0 for no cap)
+    :type slice_seconds: int
+    :param slice_seconds: length of the slices the caps are counted over
+    """
+
+    def __init__(self, creates_per_minute=0, copies_per_minute=0, slice_seconds=SLICE_SECONDS, clock=time.time):
+        self.rates = {'create': creates_per_minute, 'copy': copies_per_minute}
+        self.slice_seconds = slice_seconds
+        self._clock = clock
+        self._slice = None
+        self._used = {}
+        self._lock = threading.Lock()
+
+    def due_at(self, key, interval_seconds, newest_start):
+        """ When a volume is next due: its first offset point after its newest snapshot started
+
+        That is never more than an interval after the newest snapshot, so
+        every volume still gets a snapshot at least once per interval.
+        """
+        start = offset(key, interval_seconds)
+        return newest_start - (newest_start - start) % interval_seconds + interval_seconds
+
+    def next_slice(self, now):
+        """ When the slice after the one now falls in starts, and work deferred by a cap can go ahead """
+        return (int(now // self.slice_seconds) + 1) * self.slice_seconds
+
+    def take(self, kind, key):
+        """ Whether one more create or copy fits in the current slice. Counts it if it does
+
+        :type kind: str
+        :param kind: 'create' or 'copy'
+        :type key: str
+        :param key: the volume or instance, for logging
+        :returns: bool
+        """
+        rate = self.rates[kind]
+        if not rate:
+            return True
+        limit = max(int(rate * self.slice_seconds / 60), 1)
+        with self._lock:
+            current = int(self._clock() // self.slice_seconds)
+            if current != self._slice:
+                self._slice, self._used = current, {}
+            used = self._used.get(kind, 0)
+            if used < limit:
+                self._used[kind] = used + 1
+                return True
+        metrics.registry.inc('snapshots_deferred_total', kind=kind)
+        kvlog.debug("deferred to spread load", {"kind": kind, "key": key})
+        return False
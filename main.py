@@ -1,12 +1,37 @@
+import time
+started = time.time()
+
+import argparse
 from ebs_snapshots import ebs_snapshots_daemon
+from ebs_snapshots import kvlog
+import os
 import sys
 import kayvee
 import logging
 import traceback
-logging.basicConfig(level=logging.INFO)
+log_level = getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), None)
+logging.basicConfig(level=log_level if isinstance(log_level, int) else logging.INFO)
+if not isinstance(log_level, int):
+    kvlog.warning("unknown LOG_LEVEL, logging at INFO", {"log_level": os.environ.get('LOG_LEVEL')})
+if os.environ.get('ASYNC_LOGGING'):
+    kvlog.use_queue()
+
+
+def handler(event, context):
+    """ AWS Lambda entry point: one cycle, failing the invocation if anything failed """
+    if ebs_snapshots_daemon.run_once() != 0:
+        raise RuntimeError("snapshot cycle failed, see the cycle summary")
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Automated EBS snapshots")
+    parser.add_argument('--once', action='store_true',
+                        help='run one cycle and exit, with status 1 if anything failed (for cron)')
+    args = parser.parse_args()
     try:
+        if args.once:
+            kvlog.info("started", {"startup_seconds": round(time.time() - started, 3)})
+            sys.exit(ebs_snapshots_daemon.run_once())
         ebs_snapshots_daemon.snapshot_timer()
     except Exception as e:
         logging.error(kayvee.formatLog("ebs-snapshots", "error", "unknown exception", {
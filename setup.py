@@ -30,7 +30,7 @@ setup(name='ebs-snapshots',
       author_email='tech-notify@getclever.com',
       url='https://github.com/Clever/ebs-snapshots/',
       long_description=README + '\n\n' + CHANGES,
-      packages=find_packages(exclude=['*.tests']),
+      packages=find_packages(exclude=['*.tests', 'simulation']),
       install_requires=[str(ir.req) for ir in install_reqs],
       setup_requires=['nose>=1.0'],
       test_suite='test',
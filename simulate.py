@@ -0,0 +1,118 @@
+""" Simulate months of the daemon's scheduling, copies and retention against a synthetic fleet
+
+Time is virtual, so only the daemon's own work takes time: a month of 100
+volumes, a tenth of them hourly, runs in under a minute, and a year of
+thousands of volumes in tens of minutes. Reports snapshots
+created, copied and deleted, API calls and recovery points over time.
+
+    python simulate.py --volumes 500 --days 365 --retention '{"daily": 7, "weekly": 4, "monthly": 12}'
+"""
+import argparse
+import json
+import logging
+import os
+
+# boto wants credentials even though no request leaves the process
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'simulation')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'simulation')
+
+from simulation.fake_ec2 import FakeRegion, generate_fleet
+from simulation.simulator import Simulation, VirtualClock
+from ebs_snapshots.stagger import Stagger
+
+DAY = 24 * 3600
+
+
+def _hours(seconds):
+    return round(seconds / 3600.0, 1)
+
+
+def simulate(args):
+    """ Generate a fleet and run args.days of simulated time over it
+
+    :returns: list -- one sample per args.sample_hours, see Simulation.sample
+    """
+    clock = VirtualClock(args.start)
+    primary = FakeRegion('us-west-1', completion_seconds=args.snapshot_seconds, copy_limit=args.copy_limit,
+                         seed=args.seed, clock=clock, sleep=clock.sleep)
+    backup = FakeRegion('us-east-1', completion_seconds=args.copy_seconds, copy_limit=args.copy_limit,
+                        seed=args.seed, clock=clock, sleep=clock.sleep)
+    config = generate_fleet(primary, backup, args.volumes, seed=args.seed, now=clock())
+    for params in config.values():
+        if args.max_snapshots is not None:
+            params['max_snapshots'] = args.max_snapshots
+        if args.retention:
+            params['retention'] = json.loads(args.retention)
+
+    stagger = None
+    if args.stagger:
+        stagger = Stagger(args.creates_per_minute, args.copies_per_minute, clock=clock)
+    simulation = Simulation(config, primary, backup, clock, copy_limit=args.copy_limit, stagger=stagger,
+                            sample_interval=args.sample_hours * 3600)
+    return simulation.run(args.days * DAY)
+
+
+def report(samples, start, period_days):
+    """ Print one line per period: what happened in it and its worst recovery points """
+    print "{:>5} {:>8} {:>8} {:>8} {:>7} {:>10} {:>8} {:>9} {:>9} {:>8} {:>7}".format(
+        "day", "created", "copied", "deleted", "failed", "API calls", "RPO (h)", "RPO/intv", "copy RPO",
+        "overdue", "queued")
+    previous = dict.fromkeys(("created", "copied", "deleted", "failed", "api_calls"), 0)
+    period, period_end = [], start + period_days * DAY
+    for sample in samples:
+        period.append(sample)
+        if sample["time"] < period_end and sample is not samples[-1]:
+            continue
+        period_end += period_days * DAY
+        print "{:>5} {:>8} {:>8} {:>8} {:>7} {:>10} {:>8} {:>9} {:>9} {:>8} {:>7}".format(
+            int(round((sample["time"] - start) / DAY)),
+            sample["created"] - previous["created"],
+            sample["copied"] - previous["copied"],
+            sample["deleted"] - previous["deleted"],
+            sample["failed"] - previous["failed"],
+            sample["api_calls"] - previous["api_calls"],
+            _hours(max(s["max_rpo_seconds"] for s in period)),
+            round(max(s["max_rpo_intervals"] for s in period), 2),
+            _hours(max(s["max_backup_rpo_seconds"] for s in period)),
+            max(s["overdue"] for s in period),
+            sample["copies_queued"])
+        previous, period = sample, []
+    last = samples[-1]
+    print "{} snapshots and {} copies retained".format(last["snapshots"], last["copies"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--volumes', type=int, default=100, help='fleet size (default: %(default)s)')
+    parser.add_argument('--days', type=int, default=30, help='simulated days (default: %(default)s)')
+    parser.add_argument('--start', type=float, default=1514764800,
+                        help='simulated start, epoch seconds (default: 2018-01-01)')
+    parser.add_argument('--max-snapshots', type=int, help='max_snapshots for every volume')
+    parser.add_argument('--retention', help='tiered retention policy for every volume, as JSON')
+    parser.add_argument('--snapshot-seconds', type=float, default=600,
+                        help='seconds new snapshots stay pending (default: %(default)s)')
+    parser.add_argument('--copy-seconds', type=float, default=900,
+                        help='seconds copies stay pending (default: %(default)s)')
+    parser.add_argument('--copy-limit', type=int, default=20, help='concurrent copies into the backup region')
+    parser.add_argument('--stagger', action='store_true', help='staggered scheduling, as with STAGGER')
+    parser.add_argument('--creates-per-minute', type=int, default=0, help='with --stagger, as CREATES_PER_MINUTE')
+    parser.add_argument('--copies-per-minute', type=int, default=0, help='with --stagger, as COPIES_PER_MINUTE')
+    parser.add_argument('--sample-hours', type=int, default=1, help='hours between samples (default: %(default)s)')
+    parser.add_argument('--report-days', type=int, default=7, help='days per report line (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per sample')
+    parser.add_argument('--log', action='store_true', help="show the daemon's logs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.log else logging.CRITICAL)
+
+    samples = simulate(args)
+    if args.json:
+        for sample in samples:
+            print json.dumps(sample, sort_keys=True)
+    else:
+        report(samples, args.start, args.report_days)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+""" Fake EC2 and virtual-time simulation of the daemon, for benchmarks, simulations and tests. Not installed """
@@ -0,0 +1,659 @@
+""" In-process stand-in for EC2, for benchmarks and simulations
+
+Implements the slice of the boto2 connection and boto3 client APIs the daemon
+uses (EC2 and the EBS direct APIs' ListChangedBlocks), over a synthetic fleet, and can inject latency, throttling and
+snapshot copy limit errors. Every request is counted.
+"""
+import datetime
+import fnmatch
+import itertools
+import random
+import threading
+import time
+from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
+from boto.ec2.instance import Instance
+from boto.ec2.snapshot import Snapshot
+from boto.ec2.volume import Volume
+from boto.exception import EC2ResponseError
+from boto.resultset import ResultSet
+from botocore.exceptions import ClientError
+from dateutil.tz import tzutc
+from ebs_snapshots.clients import ClientRegistry
+from ebs_snapshots.inventory import CREATOR
+
+START_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+""" Block size reported by ListChangedBlocks """
+BLOCK_SIZE = 524288
+
+""" Share of volumes on each interval in a generated fleet """
+FLEET_INTERVALS = [(u'hourly', 0.1), (u'daily', 0.7), (u'weekly', 0.2)]
+
+INTERVAL_SECONDS = {u'hourly': 3600, u'daily': 3600 * 24, u'weekly': 3600 * 24 * 7}
+
+_ids = itertools.count(1)
+
+
+def _new_id(prefix):
+    return '{}-{:017x}'.format(prefix, next(_ids))
+
+
+def _start_time(epoch):
+    return datetime.datetime.utcfromtimestamp(epoch).strftime(START_TIME_FORMAT)
+
+
+class _Throttled(Exception):
+
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+
+class _FakeSnapshot(object):
+
+    """ A snapshot as stored by FakeRegion. Materialised into boto objects on describe """
+
+    __slots__ = ('id', 'volume_id', 'created', 'start_time', 'start_datetime', 'tags', 'completes', 'generation')
+
+    def __init__(self, id, volume_id, created, tags, completes, generation=0):
+        self.id = id
+        self.volume_id = volume_id
+        self.created = created
+        # As boto2 and boto3 report it, formatted once rather than on every describe
+        self.start_time = _start_time(created)
+        self.start_datetime = datetime.datetime.fromtimestamp(created, tzutc())
+        self.tags = tags
+        self.completes = completes
+        # Writes to the volume it includes, see FakeRegion.write
+        self.generation = generation
+
+    def state(self, now):
+        return 'completed' if now >= self.completes else 'pending'
+
+
+class FakeRegion(object):
+
+    """
+    Volumes and snapshots of one region, plus request accounting
+
+    :type latency: float
+    :param latency: seconds every request takes
+    :type throttle_rate: float
+    :param throttle_rate: probability that a request fails with RequestLimitExceeded
+    :type max_rps: int
+    :param max_rps: requests per second above which requests fail with
+        RequestLimitExceeded (0 for no limit)
+    :type copy_limit: int
+    :param copy_limit: concurrent pending copies into this region before
+        CopySnapshot fails with ResourceLimitExceeded
+    :type completion_seconds: float
+    :param completion_seconds: seconds a new snapshot or copy stays pending
+    """
+
+    def __init__(self, name, latency=0.0, throttle_rate=0.0, max_rps=0, copy_limit=20,
+                 completion_seconds=0.0, seed=None, clock=time.time, sleep=time.sleep):
+        self.name = name
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.max_rps = max_rps
+        self.copy_limit = copy_limit
+        self.completion_seconds = completion_seconds
+        self._clock = clock
+        self._sleep = sleep
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._second = None
+        self._second_requests = 0
+
+        self.volumes = {}  # volume id -> zone
+        self.volume_tags = {}  # volume id -> tag dict
+        self.instances = {}  # instance id -> attached volume ids, root volume first
+        self.snapshots = {}  # snapshot id -> _FakeSnapshot
+        self._volume_snapshots = {}  # volume id -> {snapshot id: _FakeSnapshot}
+        self._pending = {}  # snapshot id -> _FakeSnapshot, for the ones that may still be pending
+        self.writes = {}  # volume id -> [(generation, block index)], oldest first
+        self._listings = {}  # pagination token prefix -> remaining listing
+        # Called with ("added", "deleted" or "tagged", _FakeSnapshot) as snapshots change
+        self.observers = []
+
+        self.calls = {}  # operation -> count
+        self.throttles = 0
+        self.copy_limit_errors = 0
+        self.created = 0  # snapshots (or copies) added
+        self.deleted = 0
+
+    def request(self, operation):
+        """ Account for a request, raising _Throttled if it should fail """
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            second = int(self._clock())
+            if second != self._second:
+                self._second, self._second_requests = second, 0
+            self._second_requests += 1
+            throttled = (self.max_rps and self._second_requests > self.max_rps) or \
+                self._random.random() < self.throttle_rate
+            if throttled:
+                self.throttles += 1
+        if self.latency:
+            self._sleep(self.latency)
+        if throttled:
+            raise _Throttled('RequestLimitExceeded')
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = {}
+            self.throttles = 0
+            self.copy_limit_errors = 0
+            self.created = 0
+            self.deleted = 0
+
+    def add_volume(self, zone, volume_id=None, tags=None):
+        volume_id = volume_id or _new_id('vol')
+        self.volumes[volume_id] = zone
+        self.volume_tags[volume_id] = dict(tags or {})
+        return volume_id
+
+    def add_instance(self, volume_ids, instance_id=None):
+        """ Store an instance with the given volumes attached, the first one as its root volume """
+        instance_id = instance_id or _new_id('i')
+        self.instances[instance_id] = list(volume_ids)
+        return instance_id
+
+    def write(self, volume_id, block_indexes):
+        """ Record a write to some blocks of a volume. Snapshots created after it include it """
+        with self._lock:
+            writes = self.writes.setdefault(volume_id, [])
+            generation = writes[-1][0] + 1 if writes else 1
+            writes.extend((generation, i) for i in block_indexes)
+
+    def changed_blocks(self, first, second):
+        """ Sorted indexes of the blocks written between two snapshots of a volume """
+        with self._lock:
+            writes = list(self.writes.get(first.volume_id, []))
+        return sorted(set(i for generation, i in writes
+                          if first.generation < generation <= second.generation))
+
+    def find_volumes(self, filters):
+        """ Ids of volumes matching volume-id, availability-zone and tag:<key> filters """
+        volume_ids = sorted(self.volumes)
+        for name, values in filters.items():
+            values = set(values)
+            if name == 'volume-id':
+                volume_ids = [v for v in volume_ids if v in values]
+            elif name == 'availability-zone':
+                volume_ids = [v for v in volume_ids if self.volumes[v] in values]
+            elif name.startswith('tag:'):
+                volume_ids = [v for v in volume_ids if self.volume_tags[v].get(name[4:]) in values]
+        return volume_ids
+
+    def add_snapshot(self, volume_id, tags, created=None, completes=None):
+        """ Store a snapshot. By default it starts now and completes after completion_seconds """
+        now = self._clock()
+        created = now if created is None else created
+        if completes is None:
+            completes = now + self.completion_seconds
+        with self._lock:
+            writes = self.writes.get(volume_id)
+            generation = writes[-1][0] if writes else 0
+            snapshot = _FakeSnapshot(_new_id('snap'), volume_id, created, tags, completes, generation)
+            self.snapshots[snapshot.id] = snapshot
+            self._volume_snapshots.setdefault(volume_id, {})[snapshot.id] = snapshot
+            if completes > now:
+                self._pending[snapshot.id] = snapshot
+            self.created += 1
+        self._notify("added", snapshot)
+        return snapshot
+
+    def delete_snapshot(self, snapshot_id):
+        with self._lock:
+            snapshot = self.snapshots.pop(snapshot_id, None)
+            if snapshot is None:
+                return False
+            del self._volume_snapshots[snapshot.volume_id][snapshot_id]
+            self._pending.pop(snapshot_id, None)
+            self.deleted += 1
+        self._notify("deleted", snapshot)
+        return True
+
+    def tag_snapshot(self, snapshot_id, tags):
+        """ Add or overwrite tags of a snapshot. No-op if it doesn't exist """
+        with self._lock:
+            snapshot = self.snapshots.get(snapshot_id)
+            if snapshot is None:
+                return
+            snapshot.tags.update(tags)
+        self._notify("tagged", snapshot)
+
+    def _notify(self, event, snapshot):
+        for observer in self.observers:
+            observer(event, snapshot)
+
+    def volume_snapshots(self, volume_id):
+        """ The snapshots (or copies) of a volume """
+        with self._lock:
+            return list(self._volume_snapshots.get(volume_id, {}).values())
+
+    def pending_count(self):
+        now = self._clock()
+        with self._lock:
+            for snapshot_id, snapshot in self._pending.items():
+                if snapshot.state(now) != 'pending':
+                    del self._pending[snapshot_id]
+            return len(self._pending)
+
+    def find_snapshots(self, filters):
+        """ Snapshots matching EC2-style filters
+
+        :type filters: dict
+        :param filters: filter name -> list of values. Supports snapshot-id,
+            volume-id, status, start-time (with wildcards) and tag:<key>.
+            Copies are stored under their source volume, which their
+            volume-id tag is assumed to match
+        """
+        now = self._clock()
+        with self._lock:
+            volume_ids = filters.get('volume-id') or filters.get('tag:volume-id')
+            if 'snapshot-id' in filters:
+                snapshots = [self.snapshots[i] for i in filters['snapshot-id'] if i in self.snapshots]
+            elif volume_ids:
+                snapshots = [s for volume_id in set(volume_ids)
+                             for s in self._volume_snapshots.get(volume_id, {}).itervalues()]
+            else:
+                snapshots = list(self.snapshots.values())
+        for name, values in filters.items():
+            if name == 'volume-id':
+                values = set(values)
+                snapshots = [s for s in snapshots if s.volume_id in values]
+            elif name == 'status':
+                snapshots = [s for s in snapshots if s.state(now) in values]
+            elif name == 'start-time':
+                snapshots = [s for s in snapshots
+                             if any(fnmatch.fnmatch(s.start_time, v) for v in values)]
+            elif name.startswith('tag:'):
+                key, values = name[4:], set(values)
+                snapshots = [s for s in snapshots if s.tags.get(key) in values]
+        return snapshots
+
+    def page_snapshots(self, filters, next_token=None, page_size=1000):
+        """ One page of find_snapshots(filters)
+
+        The full listing is taken on the first page and served from memory
+        after, so paging through a large region stays linear.
+
+        :returns: tuple -- (list of _FakeSnapshot, next token or None)
+        """
+        if next_token:
+            listing, offset = next_token.split(':')
+            offset = int(offset)
+            with self._lock:
+                snapshots = self._listings.pop(listing)
+        else:
+            offset, listing = 0, _new_id('listing')
+            snapshots = self.find_snapshots(filters)
+        end = offset + page_size
+        if end >= len(snapshots):
+            return snapshots[offset:], None
+        with self._lock:
+            self._listings[listing] = snapshots
+        return snapshots[offset:end], '{}:{}'.format(listing, end)
+
+
+def _parse_filters(params):
+    """ Turn boto2 Filter.N.Name / Filter.N.Value.M query params back into a dict """
+    filters = {}
+    i = 1
+    while 'Filter.{}.Name'.format(i) in params:
+        values = []
+        j = 1
+        while 'Filter.{}.Value.{}'.format(i, j) in params:
+            values.append(params['Filter.{}.Value.{}'.format(i, j)])
+            j += 1
+        filters[params['Filter.{}.Name'.format(i)]] = values
+        i += 1
+    return filters
+
+
+def _parse_tag_specification(params):
+    tags = {}
+    i = 1
+    while 'TagSpecification.1.Tag.{}.Key'.format(i) in params:
+        tags[params['TagSpecification.1.Tag.{}.Key'.format(i)]] = \
+            params['TagSpecification.1.Tag.{}.Value'.format(i)]
+        i += 1
+    return tags
+
+
+class FakeEC2Connection(object):
+
+    """ The boto2 EC2Connection methods used by the daemon, backed by a FakeRegion """
+
+    def __init__(self, region):
+        self.region = region
+
+    def _request(self, action):
+        try:
+            self.region.request(action)
+        except _Throttled as throttled:
+            error = EC2ResponseError(503, 'Service Unavailable')
+            error.error_code = throttled.code
+            raise error
+
+    def _snapshot(self, fake):
+        snapshot = Snapshot(self)
+        snapshot.id = fake.id
+        snapshot.volume_id = fake.volume_id
+        snapshot.start_time = fake.start_time
+        snapshot.status = fake.state(self.region._clock())
+        snapshot.tags = dict(fake.tags)
+        return snapshot
+
+    def build_list_params(self, params, items, label):
+        for i, item in enumerate(items, 1):
+            params['{}.{}'.format(label, i)] = item
+
+    def build_filter_params(self, params, filters):
+        for i, name in enumerate(sorted(filters), 1):
+            params['Filter.{}.Name'.format(i)] = name
+            values = filters[name]
+            if not isinstance(values, list):
+                values = [values]
+            for j, value in enumerate(values, 1):
+                params['Filter.{}.Value.{}'.format(i, j)] = value
+
+    def get_all_volumes(self, volume_ids=None, filters=None):
+        self._request('DescribeVolumes')
+        ids = (filters or {}).get('volume-id', volume_ids)
+        if ids is None:
+            ids = self.region.volumes.keys()
+        return [self._volume(v) for v in ids if v in self.region.volumes]
+
+    def get_all_snapshots(self, snapshot_ids=None, owner=None, filters=None):
+        self._request('DescribeSnapshots')
+        filters = dict(filters or {})
+        if snapshot_ids:
+            filters['snapshot-id'] = snapshot_ids
+        return [self._snapshot(s) for s in self.region.find_snapshots(filters)]
+
+    def get_only_instances(self, instance_ids=None, filters=None):
+        self._request('DescribeInstances')
+        ids = (filters or {}).get('instance-id', instance_ids)
+        if ids is None:
+            ids = self.region.instances.keys()
+        return [self._instance(i) for i in ids if i in self.region.instances]
+
+    def _instance(self, instance_id):
+        instance = Instance(self)
+        instance.id = instance_id
+        instance.root_device_name = '/dev/xvda'
+        instance.block_device_mapping = BlockDeviceMapping()
+        for i, volume_id in enumerate(self.region.instances[instance_id]):
+            instance.block_device_mapping['/dev/xvd' + chr(ord('a') + i)] = BlockDeviceType(volume_id=volume_id)
+        return instance
+
+    def _volume(self, volume_id):
+        volume = Volume(self)
+        volume.id = volume_id
+        volume.zone = self.region.volumes[volume_id]
+        volume.status = 'in-use'
+        volume.tags = dict(self.region.volume_tags[volume_id])
+        return volume
+
+    def get_list(self, action, params, markers, verb='GET'):
+        if action == 'DescribeVolumes':
+            self._request(action)
+            volume_ids = self.region.find_volumes(_parse_filters(params))
+            start = int(params.get('NextToken') or 0)
+            end = start + int(params.get('MaxResults', 500))
+            page = ResultSet(markers)
+            page.extend(self._volume(v) for v in volume_ids[start:end])
+            page.next_token = str(end) if end < len(volume_ids) else None
+            return page
+        if action == 'CreateSnapshots':
+            return self._create_snapshots(params, markers)
+        if action != 'DescribeSnapshots':
+            raise NotImplementedError(action)
+        self._request(action)
+        snapshots, next_token = self.region.page_snapshots(
+            _parse_filters(params), params.get('NextToken'), int(params.get('MaxResults', 1000)))
+        page = ResultSet(markers)
+        page.extend(self._snapshot(s) for s in snapshots)
+        page.next_token = next_token
+        return page
+
+    def _create_snapshots(self, params, markers):
+        self._request('CreateSnapshots')
+        volume_ids = self.region.instances.get(params['InstanceSpecification.InstanceId'])
+        if volume_ids is None:
+            raise EC2ResponseError(400, 'Bad Request')
+        if params.get('InstanceSpecification.ExcludeBootVolume') == 'true':
+            volume_ids = volume_ids[1:]
+        tags = _parse_tag_specification(params)
+        snapshots = ResultSet(markers)
+        for volume_id in volume_ids:
+            snapshot = self._snapshot(self.region.add_snapshot(volume_id, dict(tags)))
+            # Like the real response, which reports "state" rather than "status"
+            snapshot.state, snapshot.status = snapshot.status, None
+            snapshots.append(snapshot)
+        return snapshots
+
+    def get_object(self, action, params, cls, verb='GET'):
+        if action != 'CreateSnapshot':
+            raise NotImplementedError(action)
+        self._request(action)
+        if params['VolumeId'] not in self.region.volumes:
+            raise EC2ResponseError(400, 'Bad Request')
+        fake = self.region.add_snapshot(params['VolumeId'], _parse_tag_specification(params))
+        return self._snapshot(fake)
+
+    def create_tags(self, resource_ids, tags):
+        self._request('CreateTags')
+        for resource_id in resource_ids:
+            self.region.tag_snapshot(resource_id, tags)
+        return True
+
+    def delete_snapshot(self, snapshot_id):
+        self._request('DeleteSnapshot')
+        if not self.region.delete_snapshot(snapshot_id):
+            error = EC2ResponseError(400, 'Bad Request')
+            error.error_code = 'InvalidSnapshot.NotFound'
+            raise error
+        return True
+
+
+class _FakePaginator(object):
+
+    def __init__(self, client, operation):
+        self._client = client
+        self._operation = operation
+
+    def paginate(self, **kwargs):
+        config = kwargs.pop('PaginationConfig', {})
+        page_size = config.get('PageSize', 1000)
+        token = config.get('StartingToken')
+        while True:
+            if token:
+                kwargs['NextToken'] = token
+            page = self._client.describe_snapshots(MaxResults=page_size, **kwargs)
+            yield page
+            token = page.get('NextToken')
+            if not token:
+                return
+
+
+class FakeEC2Client(object):
+
+    """ The boto3 EC2 client methods used by the daemon, backed by a FakeRegion """
+
+    def __init__(self, region, source_regions=None):
+        self.region = region
+        # region name -> FakeRegion that copies can be made from
+        self.source_regions = source_regions or {}
+
+    def _request(self, operation):
+        try:
+            self.region.request(operation)
+        except _Throttled as throttled:
+            raise ClientError({"Error": {"Code": throttled.code, "Message": "Request limit exceeded."}},
+                              operation)
+
+    def _snapshot_info(self, fake):
+        return {
+            "SnapshotId": fake.id,
+            "VolumeId": "vol-ffffffff",
+            "StartTime": fake.start_datetime,
+            "State": fake.state(self.region._clock()),
+            "Tags": [{"Key": k, "Value": v} for k, v in fake.tags.items()],
+        }
+
+    def get_paginator(self, operation):
+        if operation != 'describe_snapshots':
+            raise NotImplementedError(operation)
+        return _FakePaginator(self, operation)
+
+    def describe_snapshots(self, Filters=None, SnapshotIds=None, OwnerIds=None, MaxResults=None, NextToken=None):
+        self._request('DescribeSnapshots')
+        filters = dict((f["Name"], f["Values"]) for f in Filters or [])
+        if SnapshotIds:
+            filters['snapshot-id'] = SnapshotIds
+        if MaxResults:
+            snapshots, next_token = self.region.page_snapshots(filters, NextToken, MaxResults)
+        else:
+            snapshots, next_token = self.region.find_snapshots(filters), None
+        response = {"Snapshots": [self._snapshot_info(s) for s in snapshots]}
+        if next_token:
+            response["NextToken"] = next_token
+        return response
+
+    def copy_snapshot(self, SourceRegion, SourceSnapshotId, Description='', Encrypted=False,
+                      TagSpecifications=None, **kwargs):
+        self._request('CopySnapshot')
+        source = self.source_regions.get(SourceRegion)
+        if source is None or SourceSnapshotId not in source.snapshots:
+            raise ClientError({"Error": {"Code": "InvalidSnapshot.NotFound", "Message": ""}}, 'CopySnapshot')
+        if self.region.pending_count() >= self.region.copy_limit:
+            with self.region._lock:
+                self.region.copy_limit_errors += 1
+            raise ClientError({"Error": {"Code": "ResourceLimitExceeded", "Message": ""}}, 'CopySnapshot')
+        tags = {}
+        for spec in TagSpecifications or []:
+            tags.update((t["Key"], t["Value"]) for t in spec["Tags"])
+        fake = self.region.add_snapshot(source.snapshots[SourceSnapshotId].volume_id, tags)
+        return {"SnapshotId": fake.id}
+
+    def create_tags(self, Resources, Tags):
+        self._request('CreateTags')
+        for resource_id in Resources:
+            self.region.tag_snapshot(resource_id, dict((t["Key"], t["Value"]) for t in Tags))
+        return {}
+
+    def delete_snapshot(self, SnapshotId):
+        self._request('DeleteSnapshot')
+        if not self.region.delete_snapshot(SnapshotId):
+            raise ClientError({"Error": {"Code": "InvalidSnapshot.NotFound", "Message": ""}}, 'DeleteSnapshot')
+        return {}
+
+
+class FakeEBSClient(object):
+
+    """ The boto3 EBS direct APIs client methods used by the daemon, backed by a FakeRegion """
+
+    def __init__(self, region):
+        self.region = region
+
+    def list_changed_blocks(self, SecondSnapshotId, FirstSnapshotId=None, MaxResults=10000, NextToken=None,
+                            StartingBlockIndex=None):
+        try:
+            self.region.request('ListChangedBlocks')
+        except _Throttled:
+            raise ClientError({"Error": {"Code": "ThrottlingException", "Message": ""}}, 'ListChangedBlocks')
+        snapshots = [self.region.snapshots.get(i) for i in (FirstSnapshotId, SecondSnapshotId)]
+        if None in snapshots or snapshots[0].volume_id != snapshots[1].volume_id:
+            raise ClientError({"Error": {"Code": "ValidationException", "Message": ""}}, 'ListChangedBlocks')
+        blocks = self.region.changed_blocks(*snapshots)
+        offset = int(NextToken or 0)
+        response = {
+            "ChangedBlocks": [{
+                "BlockIndex": i,
+                "FirstBlockToken": "{}:{}".format(FirstSnapshotId, i),
+                "SecondBlockToken": "{}:{}".format(SecondSnapshotId, i),
+            } for i in blocks[offset:offset + MaxResults]],
+            "BlockSize": BLOCK_SIZE,
+        }
+        if offset + MaxResults < len(blocks):
+            response["NextToken"] = str(offset + MaxResults)
+        return response
+
+
+class FakeClientRegistry(ClientRegistry):
+
+    """ ClientRegistry handing out fakes for the given regions, rate limited like the real ones """
+
+    def __init__(self, regions, limiter=None):
+        ClientRegistry.__init__(self, limiter=limiter)
+        self.regions = regions
+
+    def ec2_connection(self, region, profile=None):
+        return self._get(('boto-ec2', region, profile), lambda: self._rate_limited(
+            FakeEC2Connection(self.regions[region]), region, profile))
+
+    def ec2_client(self, region, profile=None):
+        return self._get(('ec2', region, profile), lambda: self._rate_limited(
+            FakeEC2Client(self.regions[region], self.regions), region, profile))
+
+    def ebs_client(self, region, profile=None):
+        return self._get(('ebs', region, profile), lambda: FakeEBSClient(self.regions[region]))
+
+
+def generate_fleet(primary, backup, count, seed=None, now=None):
+    """ Populate a primary and backup region with volumes and snapshot histories
+
+    Volumes are mostly daily, some hourly or weekly, keep 0-14 snapshots and
+    have up to two more than they keep, so some are due for pruning. The
+    newest snapshot is up to 1.2 intervals old, so some volumes are due for a
+    new one. Most completed snapshots have a copy in the backup region. One in
+    a hundred configured volumes no longer exists.
+
+    :type primary: FakeRegion
+    :type backup: FakeRegion
+    :type count: int
+    :param count: number of configured volumes
+    :returns: dict -- backup config, volume id -> backup parameters
+    """
+    rand = random.Random(seed)
+    now = time.time() if now is None else now
+    zones = [primary.name + z for z in 'abc']
+    config = {}
+    for n in range(count):
+        roll, interval = rand.random(), FLEET_INTERVALS[-1][0]
+        for name, share in FLEET_INTERVALS:
+            if roll < share:
+                interval = name
+                break
+            roll -= share
+        max_snapshots = rand.randint(0, 14)
+        name = 'bench-{}'.format(n)
+        if rand.random() < 0.01:
+            config[_new_id('vol')] = {"interval": interval, "max_snapshots": max_snapshots, "name": name}
+            continue
+
+        volume_id = primary.add_volume(rand.choice(zones))
+        config[volume_id] = {"interval": interval, "max_snapshots": max_snapshots, "name": name}
+        period = INTERVAL_SECONDS[interval]
+        history = (max_snapshots or rand.randint(3, 20)) + rand.randint(0, 2)
+        newest = now - rand.uniform(0, 1.2 * period)
+        for i in range(history):
+            created = newest - i * period
+            snapshot = primary.add_snapshot(
+                volume_id, {"Name": name, "creator": CREATOR}, created=created, completes=created)
+            if rand.random() < 0.9:
+                backup.add_snapshot(volume_id, {
+                    "Name": name,
+                    "creator": CREATOR,
+                    "source_snapshot": snapshot.id,
+                    "volume-id": volume_id,
+                }, created=created + 60, completes=created + 60)
+    return config
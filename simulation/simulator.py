@@ -0,0 +1,261 @@
+""" Replay the daemon's scheduling, copies and retention over months of simulated time
+
+The daemon's own deadline loop (run_scheduled) runs against the in-process
+fake EC2, with a virtual clock that jumps from one event to the next: a
+volume coming due, a completion or copy poll, or a sample. Nothing of the
+daemon's decision logic is stubbed out, and idle time costs nothing.
+"""
+import heapq
+import time
+from ebs_snapshots import clients, ebs_snapshots_daemon, kvlog, snapshot_manager
+from ebs_snapshots.backup_config import BackupConfig
+from ebs_snapshots.completion_tracker import CompletionTracker
+from ebs_snapshots.copy_queue import CopyQueue, DEFAULT_COPY_LIMIT
+from simulation.fake_ec2 import FakeClientRegistry
+
+""" Seconds between polls of in-flight copies, as in CopyQueue.run_forever """
+COPY_POLL_INTERVAL = 30
+
+
+class StaticConfig(BackupConfig):
+
+    """ Backup config that never changes """
+
+    def __init__(self, config):
+        self.config = config
+
+    def get(self):
+        return self.config
+
+
+class VirtualClock(object):
+
+    """ Epoch seconds that only move when slept through """
+
+    def __init__(self, now=None):
+        self.now = time.time() if now is None else now
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+
+class _NewestSnapshots(object):
+
+    """
+    Start of the newest snapshot, and of the newest completed one, of each
+    volume of a FakeRegion, kept up to date from the region's events rather
+    than by looking at every snapshot
+
+    :type start: function
+    :param start: the start a snapshot counts for, e.g. its source's for a copy
+    """
+
+    def __init__(self, region, start=lambda snapshot: snapshot.created):
+        self.region = region
+        self.start = start
+        self.newest = {}  # volume id -> start
+        self.newest_completed = {}  # volume id -> start
+        self._completions = []  # heap of (completes, snapshot id, snapshot) not counted as completed yet
+        for snapshot in region.snapshots.values():
+            self._added(snapshot)
+        region.observers.append(self._observe)
+
+    def _observe(self, event, snapshot):
+        if event == "added":
+            self._added(snapshot)
+        else:
+            self._recount(snapshot.volume_id)
+
+    def _added(self, snapshot):
+        start = self.start(snapshot)
+        if start > self.newest.get(snapshot.volume_id, 0):
+            self.newest[snapshot.volume_id] = start
+        heapq.heappush(self._completions, (snapshot.completes, snapshot.id, snapshot))
+
+    def _recount(self, volume_id):
+        """ Look at a volume's own snapshots again, after one was deleted or re-tagged """
+        now = self.region._clock()
+        snapshots = self.region.volume_snapshots(volume_id)
+        for counts, counted in ((self.newest, snapshots), (self.newest_completed,
+                                                           [s for s in snapshots if s.completes <= now])):
+            if counted:
+                counts[volume_id] = max(self.start(s) for s in counted)
+            else:
+                counts.pop(volume_id, None)
+
+    def advance(self, now):
+        """ Count the snapshots completed by now """
+        while self._completions and self._completions[0][0] <= now:
+            _, snapshot_id, snapshot = heapq.heappop(self._completions)
+            if snapshot_id not in self.region.snapshots:
+                continue
+            start = self.start(snapshot)
+            if start > self.newest_completed.get(snapshot.volume_id, 0):
+                self.newest_completed[snapshot.volume_id] = start
+
+
+class _End(Exception):
+    """ Raised from the virtual sleep to leave the daemon's loop once the simulation is over """
+
+
+class Simulation(object):
+
+    """
+    The daemon's deadline scheduler over a fake primary and backup region
+
+    Completions and copies, which the daemon handles on background threads,
+    are polled when they fall due as the clock moves. Every sample_interval
+    the simulation records cumulative counts and the recovery point of every
+    configured volume: the age of its newest completed snapshot and of the
+    newest snapshot copied to the backup region.
+
+    :type config: dict
+    :param config: backup config, volume id -> backup parameters
+    :type primary: simulation.fake_ec2.FakeRegion
+    :type backup: simulation.fake_ec2.FakeRegion
+    :type clock: VirtualClock
+    :param clock: the clock both regions were created with
+    :type stagger: ebs_snapshots.stagger.Stagger
+    :param stagger: staggered scheduling, as with STAGGER
+    :type sample_interval: int
+    :param sample_interval: seconds between samples
+    """
+
+    def __init__(self, config, primary, backup, clock, copy_limit=DEFAULT_COPY_LIMIT, stagger=None,
+                 max_sleep=300, sample_interval=3600):
+        self.config = config
+        self.primary = primary
+        self.backup = backup
+        self.clock = clock
+        self.max_sleep = max_sleep
+        self.sample_interval = sample_interval
+        self.samples = []
+
+        self.target = ebs_snapshots_daemon.Target(primary.name, backup.name, StaticConfig(config))
+        self.target.clock = clock
+        self.target.stagger = stagger
+        self.registry = FakeClientRegistry({primary.name: primary, backup.name: backup})
+        self.target.copy_queue = CopyQueue(self.registry.ec2_client(backup.name), max_in_flight=copy_limit,
+                                          stagger=stagger)
+        self.target.completion_tracker = CompletionTracker(
+            self.registry.ec2_connection(primary.name), self.target.copy_queue.enqueue, clock=clock)
+
+        # Counts are from the start of the simulation, not from generating the fleet
+        primary.reset_stats()
+        backup.reset_stats()
+        self.started = clock()
+        self._end = None
+        self._next_sample = None
+        self._next_copy_poll = None
+        self._intervals = dict(
+            (volume_id, snapshot_manager.INTERVAL_SECONDS.get(params.get('interval', 'daily')))
+            for volume_id, params in config.iteritems() if volume_id in primary.volumes)
+        # primary snapshot id -> start, kept after the snapshot is deleted
+        self._source_starts = dict((s.id, s.created) for s in primary.snapshots.values())
+        primary.observers.append(self._record_source_start)
+        self._snapshots = _NewestSnapshots(primary)
+        self._copies = _NewestSnapshots(backup, lambda copy: self._source_starts.get(
+            copy.tags.get('source_snapshot'), copy.created))
+        # Sum of the daemon's cycle summaries, see kvlog.SUMMARY_EVENTS
+        self.counts = dict.fromkeys(kvlog.SUMMARY_EVENTS, 0)
+        self._counted = None
+
+    def run(self, seconds):
+        """ Simulate the next seconds of the daemon's life
+
+        :returns: list -- the samples taken so far, see sample
+        """
+        previous, clients.registry = clients.registry, self.registry
+        self._end = self.clock() + seconds
+        if self._next_sample is None:
+            self._next_sample = self.started
+        try:
+            ebs_snapshots_daemon.run_scheduled(self.target, self.max_sleep, self.clock, self._sleep)
+        except _End:
+            pass
+        finally:
+            clients.registry = previous
+        return self.samples
+
+    def _sleep(self, seconds):
+        """ Move the clock forward, doing the background work that falls due on the way """
+        if self.target.last_counts is not self._counted:
+            self._counted = self.target.last_counts
+            for event, n in self._counted.iteritems():
+                self.counts[event] += n
+        until = self.clock() + seconds
+        while True:
+            events = [until, self._end, self._next_sample, self.target.completion_tracker.next_poll_time()]
+            if len(self.target.copy_queue):
+                if self._next_copy_poll is None:
+                    self._next_copy_poll = self.clock() + COPY_POLL_INTERVAL
+                events.append(self._next_copy_poll)
+            else:
+                self._next_copy_poll = None
+            self.clock.now = max(self.clock(), min(e for e in events if e is not None))
+            now = self.clock()
+
+            if now >= self._next_sample:
+                self.samples.append(self.sample())
+                self._next_sample += self.sample_interval
+            if now >= self._end:
+                raise _End()
+            tracker_poll = self.target.completion_tracker.next_poll_time()
+            if tracker_poll is not None and tracker_poll <= now:
+                self.target.completion_tracker.poll()
+            if self._next_copy_poll is not None and self._next_copy_poll <= now:
+                self.target.copy_queue.poll()
+                self._next_copy_poll = now + COPY_POLL_INTERVAL
+            if now >= until:
+                return
+
+    def _record_source_start(self, event, snapshot):
+        if event == "added":
+            self._source_starts[snapshot.id] = snapshot.created
+
+    def sample(self):
+        """ Cumulative counts and the recovery point of every configured volume, as of now
+
+        Volumes without any snapshot (or copy) count from the start of the
+        simulation. max_rpo_intervals is the worst recovery point measured in
+        the volume's own interval, so hourly volumes aren't hidden behind
+        weekly ones. A volume is overdue when its newest snapshot, complete
+        or not, is older than its interval, as in the volumes_overdue metric.
+
+        :returns: dict
+        """
+        now = self.clock()
+        intervals = self._intervals
+        self._snapshots.advance(now)
+        self._copies.advance(now)
+        newest, newest_completed = self._snapshots.newest, self._snapshots.newest_completed
+        newest_copied = self._copies.newest_completed
+
+        def recovery_points(newest_by_volume):
+            return [now - newest_by_volume.get(volume_id, self.started) for volume_id in intervals]
+
+        rpo = recovery_points(newest_completed) or [0]
+        intervals_behind = [float(seconds) / interval for seconds, interval in zip(rpo, intervals.values())] or [0]
+        backup_rpo = recovery_points(newest_copied) or [0]
+        return {
+            "time": now,
+            "volumes": len(intervals),
+            "created": self.primary.created,
+            "copied": self.backup.created,
+            "deleted": self.primary.deleted,
+            "deleted_copies": self.backup.deleted,
+            "failed": self.counts['failed'],
+            "snapshots": len(self.primary.snapshots),
+            "copies": len(self.backup.snapshots),
+            "api_calls": self.primary.total_calls() + self.backup.total_calls(),
+            "max_rpo_seconds": max(rpo),
+            "mean_rpo_seconds": sum(rpo) / len(rpo),
+            "max_rpo_intervals": max(intervals_behind),
+            "max_backup_rpo_seconds": max(backup_rpo),
+            "overdue": sum(1 for volume_id, interval in intervals.iteritems()
+                           if now - newest.get(volume_id, self.started) > interval),
+            "copies_queued": len(self.target.copy_queue),
+        }
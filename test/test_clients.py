@@ -0,0 +1,28 @@
+from ebs_snapshots.clients import ClientRegistry
+from ebs_snapshots.rate_limiter import RateLimiter, RateLimitedClient
+from ebs_snapshots.metrics import MetricsRegistry, InstrumentedClient
+import unittest
+
+
+class TestClientRegistry(unittest.TestCase):
+
+    def test_reuses_clients_per_region(self):
+        registry = ClientRegistry()
+        self.assertIs(registry.ec2_client('us-west-1'), registry.ec2_client('us-west-1'))
+        self.assertIsNot(registry.ec2_client('us-west-1'), registry.ec2_client('us-west-2'))
+        self.assertIs(registry.ec2_connection('us-west-1'), registry.ec2_connection('us-west-1'))
+
+    def test_sizes_connection_pool(self):
+        registry = ClientRegistry(max_pool_connections=32)
+        client = registry.ec2_client('us-west-1')
+        self.assertEqual(32, client.meta.config.max_pool_connections)
+
+    def test_wraps_ec2_clients_with_limiter(self):
+        registry = ClientRegistry(limiter=RateLimiter())
+        self.assertTrue(isinstance(registry.ec2_client('us-west-1'), RateLimitedClient))
+        self.assertTrue(isinstance(registry.ec2_connection('us-west-1'), RateLimitedClient))
+
+    def test_instruments_clients(self):
+        registry = ClientRegistry(limiter=RateLimiter(), metrics=MetricsRegistry())
+        self.assertTrue(isinstance(registry.ec2_client('us-west-1')._client, InstrumentedClient))
+        self.assertTrue(isinstance(registry.ec2_connection('us-west-1')._client, InstrumentedClient))
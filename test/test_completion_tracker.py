@@ -0,0 +1,77 @@
+from ebs_snapshots.completion_tracker import CompletionTracker, INITIAL_POLL_INTERVAL
+import unittest
+from mock import MagicMock
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def snapshot(id, status):
+    return MagicMock(id=id, status=status)
+
+
+class TestCompletionTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.connection = MagicMock()
+        self.on_complete = MagicMock()
+        self.tracker = CompletionTracker(self.connection, self.on_complete, clock=self.clock.time)
+        self.volume = MagicMock(id="vol-1")
+
+    def test_polls_due_snapshots_in_one_batch(self):
+        self.tracker.watch("snap-1", self.volume, "name")
+        self.tracker.watch("snap-2", self.volume, "name")
+        self.tracker.poll()
+        self.assertEqual(0, self.connection.get_all_snapshots.call_count)
+
+        self.clock.now += INITIAL_POLL_INTERVAL
+        self.connection.get_all_snapshots.return_value = [
+            snapshot("snap-1", "completed"), snapshot("snap-2", "pending")]
+        self.tracker.poll()
+        self.assertEqual(1, self.connection.get_all_snapshots.call_count)
+        ids = self.connection.get_all_snapshots.call_args[1]["filters"]["snapshot-id"]
+        self.assertEqual(["snap-1", "snap-2"], sorted(ids))
+        self.on_complete.assert_called_once_with(self.volume, "snap-1", "name")
+        self.assertFalse("snap-1" in self.tracker)
+        self.assertTrue("snap-2" in self.tracker)
+
+    def test_backs_off_exponentially(self):
+        self.connection.get_all_snapshots.return_value = [snapshot("snap-1", "pending")]
+        self.tracker.watch("snap-1", self.volume, "name")
+        start = self.clock.now
+        polls = []
+        for _ in range(3):
+            self.clock.now = self.tracker.next_poll_time()
+            polls.append(self.clock.now - start)
+            self.tracker.poll()
+        self.assertEqual([INITIAL_POLL_INTERVAL, INITIAL_POLL_INTERVAL * 3, INITIAL_POLL_INTERVAL * 7], polls)
+
+    def test_drops_failed_or_missing_snapshots(self):
+        self.tracker.watch("snap-1", self.volume, "name")
+        self.tracker.watch("snap-2", self.volume, "name")
+        self.clock.now += INITIAL_POLL_INTERVAL
+        self.connection.get_all_snapshots.return_value = [snapshot("snap-1", "error")]
+        self.tracker.poll()
+        self.assertEqual(0, self.on_complete.call_count)
+        self.assertEqual(0, len(self.tracker))
+
+    def test_failed_poll_keeps_snapshots_due(self):
+        self.tracker.watch("snap-1", self.volume, "name")
+        self.clock.now += INITIAL_POLL_INTERVAL
+        self.connection.get_all_snapshots.side_effect = IOError("connection reset")
+        with self.assertRaises(IOError):
+            self.tracker.poll()
+        self.assertEqual(self.clock.now, self.tracker.next_poll_time())
+
+        self.connection.get_all_snapshots.side_effect = None
+        self.connection.get_all_snapshots.return_value = [snapshot("snap-1", "completed")]
+        self.tracker.poll()
+        self.on_complete.assert_called_once_with(self.volume, "snap-1", "name")
+        self.assertIsNone(self.tracker.next_poll_time())
@@ -0,0 +1,27 @@
+from ebs_snapshots.config_diff import diff
+import unittest
+
+
+class TestConfigDiff(unittest.TestCase):
+
+    def test_reports_added_removed_and_changed_volumes(self):
+        old = {
+            "vol-1": {"interval": "daily", "max_snapshots": 7},
+            "vol-2": {"interval": "daily"},
+            "vol-3": {"interval": "hourly", "name": "db"},
+        }
+        new = {
+            "vol-1": {"interval": "daily", "max_snapshots": 7},
+            "vol-3": {"interval": "daily", "max_snapshots": 2, "name": "db"},
+            "vol-4": {},
+        }
+        changes = diff(old, new)
+        self.assertEqual(["vol-4"], changes.added)
+        self.assertEqual(["vol-2"], changes.removed)
+        self.assertEqual({"vol-3": ["interval", "max_snapshots"]}, changes.changed)
+        self.assertEqual(3, len(changes))
+
+    def test_same_config_has_no_changes(self):
+        config = {"vol-1": {"interval": "daily"}}
+        self.assertEqual(0, len(diff(config, config)))
+        self.assertEqual(0, len(diff(config, {"vol-1": {"interval": "daily"}})))
@@ -0,0 +1,87 @@
+from ebs_snapshots.copy_queue import CopyQueue
+from ebs_snapshots.inventory import SnapshotInventory
+from ebs_snapshots.stagger import Stagger
+import unittest
+from mock import MagicMock
+from botocore.exceptions import ClientError
+
+
+def limit_error():
+    return ClientError({"Error": {"Code": "ResourceLimitExceeded", "Message": ""}}, "CopySnapshot")
+
+
+class TestCopyQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MagicMock()
+        self.copies = iter("copy-{}".format(i) for i in range(100))
+        self.client.copy_snapshot.side_effect = lambda **kwargs: {"SnapshotId": next(self.copies)}
+        self.volume = MagicMock(id="vol-1", zone="us-west-1a")
+
+    def test_starts_copies_up_to_window(self):
+        queue = CopyQueue(self.client, max_in_flight=2)
+        for snapshot_id in ["snap-1", "snap-2", "snap-3"]:
+            queue.enqueue(self.volume, snapshot_id, "name")
+        self.assertEqual(2, self.client.copy_snapshot.call_count)
+        self.assertEqual(2, queue.in_flight())
+        self.assertEqual(3, len(queue))
+
+    def test_ignores_duplicates(self):
+        queue = CopyQueue(self.client, max_in_flight=1)
+        queue.enqueue(self.volume, "snap-1", "name")
+        queue.enqueue(self.volume, "snap-1", "name")
+        queue.enqueue(self.volume, "snap-2", "name")
+        queue.enqueue(self.volume, "snap-2", "name")
+        self.assertEqual(2, len(queue))
+
+    def test_poll_frees_slots_for_queued_copies(self):
+        queue = CopyQueue(self.client, max_in_flight=2)
+        for snapshot_id in ["snap-1", "snap-2", "snap-3"]:
+            queue.enqueue(self.volume, snapshot_id, "name")
+        self.client.describe_snapshots.return_value = {"Snapshots": [
+            {"SnapshotId": "copy-0", "State": "completed"},
+            {"SnapshotId": "copy-1", "State": "pending"},
+        ]}
+        queue.poll()
+        self.assertEqual(1, self.client.describe_snapshots.call_count)
+        self.assertEqual(3, self.client.copy_snapshot.call_count)
+        self.assertEqual("snap-3", self.client.copy_snapshot.call_args[1]["SourceSnapshotId"])
+        self.assertEqual(2, queue.in_flight())
+
+    def test_requeues_on_copy_limit(self):
+        queue = CopyQueue(self.client, max_in_flight=5)
+        self.client.copy_snapshot.side_effect = limit_error()
+        queue.enqueue(self.volume, "snap-1", "name")
+        queue.enqueue(self.volume, "snap-2", "name")
+        self.assertEqual(0, queue.in_flight())
+        self.assertEqual(2, len(queue))
+
+        self.client.copy_snapshot.side_effect = lambda **kwargs: {"SnapshotId": next(self.copies)}
+        queue.poll()
+        self.assertEqual(
+            ["snap-1", "snap-2"],
+            [c[1]["SourceSnapshotId"] for c in self.client.copy_snapshot.call_args_list[-2:]])
+        self.assertEqual(2, queue.in_flight())
+
+    def test_pending_copies_count_against_window(self):
+        inventory = SnapshotInventory()
+        inventory.add_backup_snapshot("vol-1", {"SnapshotId": "copy-a", "State": "pending"})
+        inventory.add_backup_snapshot("vol-1", {"SnapshotId": "copy-b", "State": "completed"})
+        queue = CopyQueue(self.client, max_in_flight=1)
+        queue.track_pending(inventory)
+        queue.enqueue(self.volume, "snap-1", "name")
+        self.assertEqual(0, self.client.copy_snapshot.call_count)
+
+    def test_copies_over_stagger_cap_stay_queued(self):
+        now = [0]
+        queue = CopyQueue(self.client, max_in_flight=5,
+                          stagger=Stagger(copies_per_minute=1, clock=lambda: now[0]))
+        queue.enqueue(self.volume, "snap-1", "name")
+        queue.enqueue(self.volume, "snap-2", "name")
+        self.assertEqual(1, self.client.copy_snapshot.call_count)
+        self.assertEqual(2, len(queue))
+
+        now[0] = 60
+        queue.start_queued()
+        self.assertEqual("snap-2", self.client.copy_snapshot.call_args[1]["SourceSnapshotId"])
+        self.assertEqual(2, queue.in_flight())
@@ -0,0 +1,97 @@
+from ebs_snapshots.discovery import DiscoveryIndex, parse_selector, is_selector
+from ebs_snapshots import discovery
+from simulation.fake_ec2 import FakeRegion, FakeEC2Connection
+import unittest
+
+
+class FakeClock:
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class TestDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.region = FakeRegion('us-west-1')
+        self.daily = [self.region.add_volume('us-west-1a', tags={'backup': 'daily'}) for _ in range(3)]
+        self.hourly = self.region.add_volume('us-west-1b', tags={'backup': 'hourly'})
+        self.region.add_volume('us-west-1a')
+        self.clock = FakeClock(1000)
+        self.index = DiscoveryIndex(FakeEC2Connection(self.region), refresh_interval=900, clock=self.clock.time)
+
+    def test_parse_selector(self):
+        self.assertTrue(is_selector('tag:backup=daily'))
+        self.assertFalse(is_selector('vol-1'))
+        self.assertEqual({'tag:backup': ['daily'], 'availability-zone': ['us-west-1a']},
+                         parse_selector('tag:backup=daily, availability-zone=us-west-1a'))
+        with self.assertRaises(ValueError):
+            parse_selector('tag:backup')
+
+    def test_resolve(self):
+        config = {
+            'tag:backup=daily': {'interval': 'daily'},
+            'tag:backup=hourly': {'interval': 'hourly'},
+            self.daily[0]: {'interval': 'weekly'},
+        }
+        resolved = self.index.resolve(config)
+        self.assertEqual(sorted(self.daily + [self.hourly]), sorted(resolved))
+        self.assertEqual({'interval': 'weekly'}, resolved[self.daily[0]])
+        self.assertEqual({'interval': 'daily'}, resolved[self.daily[1]])
+        self.assertEqual({'interval': 'hourly'}, resolved[self.hourly])
+
+    def test_paginates(self):
+        discovery.PAGE_SIZE, page_size = 2, discovery.PAGE_SIZE
+        try:
+            self.assertEqual(3, len(self.index.matches('tag:backup=daily')))
+        finally:
+            discovery.PAGE_SIZE = page_size
+        self.assertEqual(2, self.region.calls['DescribeVolumes'])
+
+    def test_refreshes_each_selector_after_interval(self):
+        config = {'tag:backup=daily': {}}
+        self.index.resolve(config)
+        new_volume = self.region.add_volume('us-west-1a', tags={'backup': 'daily'})
+        self.clock.now += 899
+        self.assertNotIn(new_volume, self.index.resolve(config))
+        self.assertEqual(1, self.region.calls['DescribeVolumes'])
+
+        # a new selector is described right away, without refreshing the others
+        config['tag:backup=hourly'] = {}
+        self.assertIn(self.hourly, self.index.resolve(config))
+        self.assertEqual(2, self.region.calls['DescribeVolumes'])
+
+        self.clock.now += 1
+        self.assertIn(new_volume, self.index.resolve(config))
+        self.assertEqual(3, self.region.calls['DescribeVolumes'])
+
+    def test_keeps_matches_if_refresh_fails(self):
+        config = {'tag:backup=daily': {}}
+        self.index.resolve(config)
+        self.region.throttle_rate = 1.0
+        self.clock.now += 900
+        self.assertEqual(sorted(self.daily), sorted(self.index.resolve(config)))
+
+    def test_config_without_selectors_is_unchanged(self):
+        config = {'vol-1': {}}
+        self.assertIs(config, self.index.resolve(config))
+        self.assertEqual({}, self.region.calls)
+
+    def test_resolves_instance_volumes(self):
+        root, data = self.region.add_volume('us-west-1a'), self.region.add_volume('us-west-1a')
+        instance = self.region.add_instance([root, data])
+        other = self.region.add_instance([self.region.add_volume('us-west-1a')])
+        config = {
+            instance: {'interval': 'daily', 'exclude_boot_volume': True},
+            other: {'interval': 'hourly'},
+        }
+        resolved = self.index.resolve(config)
+        self.assertEqual({'interval': 'daily', 'exclude_boot_volume': True, 'instance': instance}, resolved[data])
+        self.assertNotIn(root, resolved)
+        self.assertEqual(2, len(resolved))
+        # both instances in one call, then cached
+        self.index.resolve(config)
+        self.assertEqual(1, self.region.calls['DescribeInstances'])
@@ -0,0 +1,321 @@
+import os
+os.environ.setdefault('AWS_REGION', 'us-west-1')
+os.environ.setdefault('AWS_BACKUP_REGION', 'us-west-2')
+os.environ.setdefault('BACKUP_CONFIG', 'test/example-volumes.yml')
+
+from ebs_snapshots import ebs_snapshots_daemon
+from ebs_snapshots.inventory import SnapshotInventory
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from mock import MagicMock, patch
+
+
+class StopLoop(Exception):
+    pass
+
+
+class FakeClock:
+
+    def __init__(self, now, max_sleeps):
+        self.now = now
+        self.sleeps = []
+        self.max_sleeps = max_sleeps
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        if len(self.sleeps) >= self.max_sleeps:
+            raise StopLoop()
+        self.now += seconds
+
+
+def inventory_with(volume_id, start_time):
+    inventory = SnapshotInventory()
+    inventory.volumes[volume_id] = MagicMock(id=volume_id)
+    inventory.add_snapshot(volume_id, MagicMock(start_time=start_time))
+    return inventory
+
+
+def target_with(config):
+    backup_conf = MagicMock()
+    backup_conf.get.return_value = config
+    target = ebs_snapshots_daemon.Target('us-west-1', 'us-west-2', backup_conf)
+    target.discovery_index = MagicMock()
+    target.discovery_index.resolve.side_effect = lambda c: c
+    return target
+
+
+class TestDaemon(unittest.TestCase):
+
+    def test_run_scheduled_sleeps_until_next_deadline(self):
+        # 2018-01-01T00:00:00Z
+        start = 1514764800
+        target = target_with({"vol-1": {"interval": "hourly"}})
+        clock = FakeClock(start + 60, 2)
+        processed = []
+
+        def process(target, config):
+            processed.append((clock.now, sorted(config.keys())))
+            return inventory_with("vol-1", "2018-01-01T00:00:30.000Z" if len(processed) == 1 else "2018-01-01T01:00:31.000Z")
+
+        with patch.object(ebs_snapshots_daemon, '_process_volumes', side_effect=process):
+            with self.assertRaises(StopLoop):
+                ebs_snapshots_daemon.run_scheduled(
+                    target, max_sleep=7200, clock=clock.time, sleep=clock.sleep)
+
+        # processed right away, then once the newest snapshot was an hour old
+        self.assertEqual([(start + 60, ["vol-1"]), (start + 3631, ["vol-1"])], processed)
+        self.assertEqual([3571, 3601], clock.sleeps)
+
+    def test_run_scheduled_retries_missing_volumes(self):
+        target = target_with({"vol-1": {"interval": "daily"}})
+        clock = FakeClock(1000, 2)
+        with patch.object(ebs_snapshots_daemon, '_process_volumes', return_value=SnapshotInventory()) as process:
+            with self.assertRaises(StopLoop):
+                ebs_snapshots_daemon.run_scheduled(
+                    target, max_sleep=300, clock=clock.time, sleep=clock.sleep)
+        self.assertEqual(2, process.call_count)
+        self.assertEqual([300, 300], clock.sleeps)
+
+    def test_next_deadline_rechecks_pending_skip_unchanged_volumes(self):
+        # 2018-01-01T00:00:00Z
+        start = 1514764800
+        params = {"interval": "weekly", "skip_unchanged": True}
+        inventory = SnapshotInventory()
+        inventory.volumes["vol-1"] = MagicMock(id="vol-1")
+        snapshot = MagicMock(start_time="2018-01-01T00:00:00.000Z", status="pending")
+        inventory.add_snapshot("vol-1", snapshot)
+
+        # not copied by the completion tracker, so looked at again soon to compare and copy it
+        self.assertEqual(start + 360, ebs_snapshots_daemon._next_deadline(inventory, "vol-1", params, start + 60, 300))
+        self.assertEqual(start + 7 * 24 * 3600 + 1, ebs_snapshots_daemon._next_deadline(
+            inventory, "vol-1", {"interval": "weekly"}, start + 60, 300))
+        snapshot.status = "completed"
+        self.assertEqual(start + 7 * 24 * 3600 + 1,
+                         ebs_snapshots_daemon._next_deadline(inventory, "vol-1", params, start + 60, 300))
+
+    def test_next_deadline_waits_for_next_slice_when_deferred(self):
+        # 2018-01-01T00:00:00Z
+        start = 1514764800
+        inventory = SnapshotInventory()
+        inventory.volumes["vol-1"] = MagicMock(id="vol-1")
+        inventory.add_snapshot("vol-1", MagicMock(start_time="2017-12-30T00:00:00.000Z", status="completed"))
+        stagger = ebs_snapshots_daemon.Stagger(creates_per_minute=1, slice_seconds=300)
+
+        # overdue and left alone by the create cap: due again when the cap resets, not every few seconds
+        self.assertEqual(start + 300, ebs_snapshots_daemon._next_deadline(
+            inventory, "vol-1", {"interval": "daily"}, start + 30, 300, stagger))
+        stagger.rates['create'] = 0
+        self.assertEqual(start + 30 + ebs_snapshots_daemon.MIN_RESCHEDULE_DELAY, ebs_snapshots_daemon._next_deadline(
+            inventory, "vol-1", {"interval": "daily"}, start + 30, 300, stagger))
+
+    def test_stagger_slices_last_a_cycle_in_interval_mode(self):
+        with patch.object(ebs_snapshots_daemon, 'stagger_mode', '1'):
+            self.assertEqual(300, ebs_snapshots_daemon.load_targets(interval=300)[0].stagger.slice_seconds)
+            self.assertEqual(60, ebs_snapshots_daemon.load_targets()[0].stagger.slice_seconds)
+            with patch.object(ebs_snapshots_daemon, 'scheduler_mode', 'deadline'):
+                self.assertEqual(60, ebs_snapshots_daemon.load_targets(interval=300)[0].stagger.slice_seconds)
+
+    def test_run_interval_processes_config_changes_between_cycles(self):
+        config = {"vol-1": {"interval": "daily"}, "vol-2": {"interval": "daily"}}
+        target = target_with(config)
+        clock = FakeClock(1000, 3)
+
+        def sleep(seconds):
+            # the config changes 100 seconds into the first wait, waking it
+            if not clock.sleeps:
+                target.backup_conf.get.return_value = {"vol-1": {"interval": "hourly"}, "vol-3": {}}
+                seconds = 100
+            clock.sleep(seconds)
+
+        with patch.object(ebs_snapshots_daemon, '_process_volumes') as process:
+            with self.assertRaises(StopLoop):
+                ebs_snapshots_daemon.run_interval(target, 300, clock=clock.time, sleep=sleep)
+        self.assertEqual([["vol-1", "vol-2"], ["vol-1", "vol-3"], ["vol-1", "vol-3"]],
+                         [sorted(c[0][1].keys()) for c in process.call_args_list])
+        # the rest of the interval, then the next full cycle
+        self.assertEqual([100, 200, 300], clock.sleeps)
+
+    def test_run_scheduled_processes_instance_volumes_together(self):
+        instance = {"interval": "daily", "instance": "i-1"}
+        target = target_with({"vol-1": instance, "vol-2": instance, "vol-3": {"interval": "daily"}})
+        clock = FakeClock(1000, 2)
+        processed = []
+
+        def process(target, config):
+            processed.append(sorted(config.keys()))
+            inventory = SnapshotInventory()
+            if len(processed) == 1:
+                # vol-1 is found without snapshots, so it is due again before the others
+                inventory.volumes["vol-1"] = MagicMock(id="vol-1")
+            return inventory
+
+        with patch.object(ebs_snapshots_daemon, '_process_volumes', side_effect=process):
+            with self.assertRaises(StopLoop):
+                ebs_snapshots_daemon.run_scheduled(target, max_sleep=300, clock=clock.time, sleep=clock.sleep)
+        # vol-2 comes along with vol-1, vol-3 waits for its own deadline
+        self.assertEqual([["vol-1", "vol-2", "vol-3"], ["vol-1", "vol-2"]], processed)
+
+    def test_run_scheduled_only_reschedules_changed_volumes(self):
+        target = target_with({"vol-1": {"interval": "daily"}, "vol-2": {"interval": "daily"}})
+        clock = FakeClock(1000, 3)
+        processed = []
+        configs = [
+            {"vol-1": {"interval": "daily"}, "vol-2": {"interval": "daily"}},
+            {"vol-1": {"interval": "daily"}, "vol-2": {"interval": "daily"}},
+            {"vol-1": {"interval": "daily"}, "vol-2": {"interval": "hourly"}, "vol-3": {}},
+        ]
+        target.backup_conf.get.side_effect = lambda: configs.pop(0)
+
+        def process(target, config):
+            processed.append(sorted(config.keys()))
+            inventory = SnapshotInventory()
+            for volume_id in config:
+                inventory.volumes[volume_id] = MagicMock(id=volume_id)
+                inventory.add_snapshot(volume_id, MagicMock(start_time="1970-01-01T00:16:40.000Z"))
+            return inventory
+
+        with patch.object(ebs_snapshots_daemon, '_process_volumes', side_effect=process):
+            with self.assertRaises(StopLoop):
+                ebs_snapshots_daemon.run_scheduled(target, max_sleep=300, clock=clock.time, sleep=clock.sleep)
+        self.assertEqual([["vol-1", "vol-2"], ["vol-2", "vol-3"]], processed)
+
+    def test_failed_target_restarts_with_backoff(self):
+        target = target_with({})
+        clock = FakeClock(1000, 3)
+        with patch.object(ebs_snapshots_daemon, 'run_interval', side_effect=RuntimeError("boom")) as run:
+            with self.assertRaises(StopLoop):
+                ebs_snapshots_daemon._run_target(target, 300, clock=clock.time, sleep=clock.sleep)
+        self.assertEqual(3, run.call_count)
+        self.assertEqual([30, 60, 120], clock.sleeps)
+
+    def test_sleep_wakes_on_config_change(self):
+        target = target_with({})
+        target.backup_conf.watch.side_effect = lambda callback: callback() or True
+        target.watch_config()
+        start = time.time()
+        target.sleep_until_config_change(60)
+        self.assertLess(time.time() - start, 5)
+        self.assertFalse(target.config_changed.is_set())
+
+    def test_sharded_target_only_processes_owned_volumes(self):
+        target = target_with({"vol-1": {}, "vol-2": {"instance": "i-1"}, "vol-3": {"instance": "i-1"}})
+        target.shard = MagicMock()
+        target.shard.filter.side_effect = lambda config: dict(
+            (v, p) for v, p in config.items() if (p.get("instance") or v) in ("vol-1", "i-1"))
+        target.shard.owns.side_effect = lambda key: key == "i-1"
+        self.assertEqual(["vol-1", "vol-2", "vol-3"], sorted(target.get_config()))
+        self.assertFalse(target.owns("vol-1"))
+        self.assertTrue(target.owns("i-1"))
+
+    def test_run_once_returns_status(self):
+        target = target_with({"vol-1": {}})
+
+        def process(target, config, concurrency):
+            target.last_counts = {"failed": 0}
+            return SnapshotInventory()
+
+        with patch.object(ebs_snapshots_daemon, 'load_targets', return_value=[target]), \
+                patch.object(ebs_snapshots_daemon, '_process_volumes', side_effect=process) as process_volumes:
+            self.assertEqual(0, ebs_snapshots_daemon.run_once())
+            self.assertTrue(target.oneshot)
+            self.assertIsNone(target.get_completion_tracker())
+            process_volumes.side_effect = None
+            process_volumes.return_value = None
+            self.assertEqual(1, ebs_snapshots_daemon.run_once())
+        del ebs_snapshots_daemon.targets[target.name]
+
+    def test_single_runs_copy_snapshots_completed_since_the_last_run(self):
+        from ebs_snapshots import clients
+        from simulation.fake_ec2 import FakeRegion, FakeClientRegistry
+        from simulation.simulator import StaticConfig, VirtualClock
+        clock = VirtualClock(1514764800)
+        primary = FakeRegion('us-west-1', completion_seconds=600, clock=clock)
+        backup = FakeRegion('us-west-2', completion_seconds=600, clock=clock)
+        volume_id = primary.add_volume('us-west-1a')
+        target = ebs_snapshots_daemon.Target('us-west-1', 'us-west-2', StaticConfig({volume_id: {}}))
+        target.oneshot = True
+        target.clock = clock
+        # hourly runs of a daily volume: the snapshot created by the first is copied by the second
+        with patch.object(clients, 'registry', FakeClientRegistry({'us-west-1': primary, 'us-west-2': backup})):
+            ebs_snapshots_daemon._process_volumes(target, target.get_config())
+            self.assertEqual(0, len(backup.snapshots))
+            clock.sleep(3600)
+            ebs_snapshots_daemon._process_volumes(target, target.get_config())
+        self.assertEqual(1, len(primary.snapshots))
+        self.assertEqual(primary.snapshots.keys(), [c.tags['source_snapshot'] for c in backup.snapshots.values()])
+
+    def test_import_leaves_heavy_modules_unloaded(self):
+        script = ("import sys; from ebs_snapshots import ebs_snapshots_daemon; "
+                  "print [m for m in ('boto3', 'yaml', 'jsonschema', 'multiprocessing.pool') if m in sys.modules]")
+        output = subprocess.check_output([sys.executable, '-c', script])
+        self.assertEqual("[]", output.strip())
+
+    def test_group_by_instance(self):
+        config = {"vol-1": {"instance": "i-1"}, "vol-2": {"instance": "i-1"}, "vol-3": {}}
+        volumes, instances = ebs_snapshots_daemon._group_by_instance(config)
+        self.assertEqual([("vol-3", {})], volumes)
+        self.assertEqual(["vol-1", "vol-2"], sorted(v for v, _ in instances["i-1"]))
+
+    def test_record_cycle_tracks_snapshot_age(self):
+        config = {"vol-1": {"interval": "hourly"}, "vol-2": {"interval": "daily"}}
+        inventory = inventory_with("vol-1", "2018-01-01T00:00:00.000Z")
+        inventory.volumes["vol-2"] = MagicMock(id="vol-2")
+        registry = ebs_snapshots_daemon.metrics.registry
+        target = target_with(config)
+        ebs_snapshots_daemon.targets[target.name] = target
+        ebs_snapshots_daemon._record_cycle(target, config, inventory, 12.5)
+        try:
+            self.assertEqual(
+                1514764800, registry.get('volume_newest_snapshot_timestamp_seconds', volume="vol-1"))
+            self.assertTrue(registry.get('volume_snapshot_age_seconds', volume="vol-1") > 3600)
+            # vol-1's snapshot is old, vol-2 has none
+            self.assertEqual(2, registry.get('volumes_overdue'))
+        finally:
+            ebs_snapshots_daemon._forget_volume(target, "vol-1")
+            ebs_snapshots_daemon._forget_volume(target, "vol-2")
+            del ebs_snapshots_daemon.targets[target.name]
+        self.assertEqual(0, registry.get('volumes_overdue'))
+        self.assertEqual(0, registry.get('volume_snapshot_age_seconds', volume="vol-1"))
+
+    def test_load_targets(self):
+        path = tempfile.mktemp()
+        with open(path, 'w') as f:
+            f.write("""
+- region: us-west-1
+  backup_region: us-west-2
+  config: test/example-volumes.yml
+- region: us-east-1
+  backup_region: us-east-2
+  config: test/example-volumes.yml
+  profile: staging
+  inventory_db: /tmp/staging.db
+""")
+        try:
+            targets = ebs_snapshots_daemon.load_targets(path)
+        finally:
+            os.remove(path)
+        self.assertEqual(["us-west-1", "staging/us-east-1"], [t.name for t in targets])
+        self.assertEqual("us-east-2", targets[1].backup_region)
+        self.assertEqual("/tmp/staging.db", targets[1].inventory_db)
+
+    def test_load_targets_from_env(self):
+        targets = ebs_snapshots_daemon.load_targets()
+        self.assertEqual(1, len(targets))
+        self.assertEqual(("us-west-1", "us-west-2"), (targets[0].region, targets[0].backup_region))
+
+    def test_targets_use_separate_clients(self):
+        first = ebs_snapshots_daemon.Target('us-west-1', 'us-west-2', MagicMock())
+        second = ebs_snapshots_daemon.Target('us-east-1', 'us-west-2', MagicMock(), profile='staging')
+        with patch.object(ebs_snapshots_daemon.clients, 'registry') as registry:
+            first.ec2_connection()
+            second.ec2_connection()
+            second.ec2_backup_client()
+        self.assertEqual([('us-west-1', None), ('us-east-1', 'staging')],
+                         [c[1] for c in registry.ec2_connection.mock_calls])
+        registry.ec2_client.assert_called_once_with('us-west-2', 'staging')
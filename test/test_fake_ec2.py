@@ -0,0 +1,86 @@
+from simulation.fake_ec2 import FakeRegion, FakeEC2Connection, FakeEC2Client, FakeEBSClient, generate_fleet
+from ebs_snapshots.inventory import build_inventory
+from ebs_snapshots import snapshot_manager
+from boto.exception import EC2ResponseError
+from botocore.exceptions import ClientError
+import unittest
+from mock import MagicMock
+
+
+class TestFakeEC2(unittest.TestCase):
+
+    def setUp(self):
+        self.primary = FakeRegion('us-west-1')
+        self.backup = FakeRegion('us-east-1')
+        self.connection = FakeEC2Connection(self.primary)
+        self.client = FakeEC2Client(self.backup, {'us-west-1': self.primary})
+
+    def test_inventory_of_generated_fleet(self):
+        config = generate_fleet(self.primary, self.backup, 50, seed=1)
+        self.assertEqual(50, len(config))
+        inventory = build_inventory(self.connection, self.client, config.keys())
+        self.assertEqual(len(self.primary.volumes), len(inventory.volumes))
+        self.assertEqual(len(self.primary.snapshots), sum(len(s) for s in inventory.snapshots.values()))
+        self.assertEqual(len(self.backup.snapshots), sum(len(s) for s in inventory.backup_snapshots.values()))
+        self.assertEqual(1, self.primary.calls['DescribeVolumes'])
+
+    def test_pagination(self):
+        volume_id = self.primary.add_volume('us-west-1a')
+        for i in range(5):
+            self.primary.add_snapshot(volume_id, {'creator': 'ebs-snapshots'})
+        params = {'MaxResults': 2}
+        self.connection.build_filter_params(params, {'volume-id': [volume_id]})
+        ids = []
+        while True:
+            page = self.connection.get_list('DescribeSnapshots', params, [], verb='POST')
+            ids.extend(s.id for s in page)
+            if not page.next_token:
+                break
+            params['NextToken'] = page.next_token
+        self.assertEqual(sorted(self.primary.snapshots), sorted(ids))
+        self.assertEqual(3, self.primary.calls['DescribeSnapshots'])
+
+    def test_tag_on_create(self):
+        volume_id = self.primary.add_volume('us-west-1a')
+        snapshot = snapshot_manager._create_snapshot(self.connection, MagicMock(id=volume_id), 'name')
+        self.assertEqual({'Name': 'name', 'creator': 'ebs-snapshots'}, self.primary.snapshots[snapshot.id].tags)
+
+    def test_list_changed_blocks(self):
+        volume_id = self.primary.add_volume('us-west-1a')
+        first = self.primary.add_snapshot(volume_id, {})
+        self.primary.write(volume_id, [5, 1, 3])
+        self.primary.write(volume_id, [1])
+        second = self.primary.add_snapshot(volume_id, {})
+        self.primary.write(volume_id, [9])
+        ebs = FakeEBSClient(self.primary)
+        page = ebs.list_changed_blocks(FirstSnapshotId=first.id, SecondSnapshotId=second.id, MaxResults=2)
+        self.assertEqual([1, 3], [b["BlockIndex"] for b in page["ChangedBlocks"]])
+        page = ebs.list_changed_blocks(FirstSnapshotId=first.id, SecondSnapshotId=second.id, MaxResults=2,
+                                       NextToken=page["NextToken"])
+        self.assertEqual([5], [b["BlockIndex"] for b in page["ChangedBlocks"]])
+        self.assertNotIn("NextToken", page)
+        third = self.primary.add_snapshot(volume_id, {})
+        fourth = self.primary.add_snapshot(volume_id, {})
+        self.assertEqual([], ebs.list_changed_blocks(FirstSnapshotId=third.id, SecondSnapshotId=fourth.id)[
+            "ChangedBlocks"])
+
+    def test_throttling(self):
+        self.primary.throttle_rate = 1.0
+        self.backup.throttle_rate = 1.0
+        with self.assertRaises(EC2ResponseError) as error:
+            self.connection.get_all_volumes(filters={'volume-id': ['vol-1']})
+        self.assertEqual('RequestLimitExceeded', error.exception.error_code)
+        with self.assertRaises(ClientError):
+            self.client.describe_snapshots()
+        self.assertEqual(1, self.primary.throttles)
+
+    def test_copy_limit(self):
+        self.backup.copy_limit = 1
+        self.backup.completion_seconds = 3600
+        volume = MagicMock(id=self.primary.add_volume('us-west-1a'), zone='us-west-1a')
+        first = self.primary.add_snapshot(volume.id, {})
+        second = self.primary.add_snapshot(volume.id, {})
+        self.assertIsNotNone(snapshot_manager._copy_snapshot(self.client, volume, first.id, 'name'))
+        with self.assertRaises(snapshot_manager.CopyLimitExceeded):
+            snapshot_manager._copy_snapshot(self.client, volume, second.id, 'name', raise_on_limit=True)
+        self.assertEqual(1, self.backup.copy_limit_errors)
@@ -1,6 +1,11 @@
 from ebs_snapshots.file_backup_config import FileBackupConfig
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 import yaml
+from mock import patch
 from jsonschema import ValidationError
 
 
@@ -30,6 +35,10 @@ class TestFileBackupConfig(unittest.TestCase):
         self.assertEquals(
             data['vol-3'], {'interval': 'hourly', 'max_snapshots': 2})
 
+    def test_get_is_empty_until_a_config_loads(self):
+        b = FileBackupConfig("test/does-not-exist.yml")
+        self.assertEqual({}, b.get())
+
     def test_errors_on_invalid_config(self):
         with self.assertRaises(AssertionError):
             FileBackupConfig._validate_config("")
@@ -45,3 +54,52 @@ class TestFileBackupConfig(unittest.TestCase):
             "vol-fake4444": {},
         }
         FileBackupConfig._validate_config(config)
+
+    def test_retention_policy(self):
+        FileBackupConfig._validate_config({"vol-1": {"retention": {"hourly": 24, "daily": 14, "monthly": 12}}})
+        with self.assertRaises(ValidationError):
+            FileBackupConfig._validate_config({"vol-1": {"retention": {"minutely": 60}}})
+        with self.assertRaises(ValidationError):
+            FileBackupConfig._validate_config({"vol-1": {"retention": {"daily": -1}}})
+
+    def test_refresh_caches_until_file_changes(self):
+        path = tempfile.mktemp(suffix=".yml")
+        try:
+            with open(path, "w") as f:
+                f.write("vol-1:\n  interval: daily\n")
+            b = FileBackupConfig(path)
+            first = b.refresh()
+            self.assertIs(first, b.refresh())
+
+            with open(path, "w") as f:
+                f.write("vol-1:\n  interval: hourly\n")
+            second = b.refresh()
+            self.assertIsNot(first, second)
+            self.assertEqual({"vol-1": {"interval": "hourly"}}, second)
+        finally:
+            os.remove(path)
+
+    def test_get_only_validates_changed_config(self):
+        b = FileBackupConfig("test/example-volumes.yml")
+        with patch.object(FileBackupConfig, "_validate_config") as validate:
+            b.get()
+            b.get()
+        self.assertEqual(1, validate.call_count)
+
+    def test_watch_calls_back_when_file_is_replaced(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "volumes.yml")
+            with open(path, "w") as f:
+                f.write("vol-1:\n  interval: daily\n")
+            changed = threading.Event()
+            self.assertTrue(FileBackupConfig(path).watch(changed.set))
+            with open(os.path.join(directory, "other.yml"), "w") as f:
+                f.write("{}\n")
+            self.assertFalse(changed.wait(0.2))
+            with open(path + ".new", "w") as f:
+                f.write("vol-1:\n  interval: hourly\n")
+            os.rename(path + ".new", path)
+            self.assertTrue(changed.wait(5))
+        finally:
+            shutil.rmtree(directory)
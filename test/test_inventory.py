@@ -0,0 +1,66 @@
+from ebs_snapshots.inventory import build_inventory, SnapshotInventory
+import unittest
+from mock import MagicMock
+from boto.resultset import ResultSet
+
+
+def result_set(items, next_token=None):
+    rs = ResultSet()
+    rs.extend(items)
+    rs.next_token = next_token
+    return rs
+
+
+def snapshot(id, volume_id, start_time="2018-01-01T00:00:00.000Z"):
+    return MagicMock(id=id, volume_id=volume_id, start_time=start_time, status="completed")
+
+
+class TestInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MagicMock()
+        self.connection.get_all_volumes.return_value = [
+            MagicMock(id="vol-1"), MagicMock(id="vol-2")]
+        self.connection.get_list.side_effect = [
+            result_set([snapshot("snap-1", "vol-1"), snapshot("snap-x", "vol-other")], "token"),
+            result_set([snapshot("snap-2", "vol-1"), snapshot("snap-3", "vol-2")]),
+        ]
+        self.backup_client = MagicMock()
+        self.backup_client.get_paginator.return_value.paginate.return_value = [
+            {"Snapshots": [
+                {"SnapshotId": "copy-1", "Tags": [{"Key": "volume-id", "Value": "vol-1"}]},
+                {"SnapshotId": "copy-2", "Tags": [{"Key": "Name", "Value": "untracked"}]},
+            ]},
+            {"Snapshots": [
+                {"SnapshotId": "copy-3", "Tags": [{"Key": "volume-id", "Value": "vol-2"}]},
+            ]},
+        ]
+
+    def test_build_indexes_by_volume(self):
+        inventory = build_inventory(self.connection, self.backup_client, ["vol-1", "vol-2"])
+        self.assertEqual(sorted(inventory.volumes.keys()), ["vol-1", "vol-2"])
+        self.assertEqual([s.id for s in inventory.get_snapshots("vol-1")], ["snap-1", "snap-2"])
+        self.assertEqual([s.id for s in inventory.get_snapshots("vol-2")], ["snap-3"])
+        self.assertEqual([s["SnapshotId"] for s in inventory.get_backup_snapshots("vol-1")], ["copy-1"])
+        self.assertEqual([s["SnapshotId"] for s in inventory.get_backup_snapshots("vol-2")], ["copy-3"])
+
+    def test_build_follows_pages(self):
+        build_inventory(self.connection, self.backup_client, ["vol-1", "vol-2"])
+        self.assertEqual(2, self.connection.get_list.call_count)
+        params = self.connection.get_list.call_args[0][1]
+        self.assertEqual("token", params["NextToken"])
+
+    def test_build_batches_volume_ids(self):
+        self.connection.get_all_volumes.return_value = []
+        volume_ids = ["vol-{}".format(i) for i in range(450)]
+        build_inventory(self.connection, self.backup_client, volume_ids)
+        self.assertEqual(3, self.connection.get_all_volumes.call_count)
+
+    def test_add_and_remove(self):
+        inventory = SnapshotInventory()
+        inventory.add_snapshot("vol-1", snapshot("snap-1", "vol-1"))
+        inventory.add_backup_snapshot("vol-1", {"SnapshotId": "copy-1"})
+        inventory.remove_snapshot("vol-1", "snap-1")
+        inventory.remove_backup_snapshot("vol-1", "copy-1")
+        self.assertEqual([], inventory.get_snapshots("vol-1"))
+        self.assertEqual([], inventory.get_backup_snapshots("vol-1"))
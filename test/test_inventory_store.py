@@ -0,0 +1,105 @@
+from ebs_snapshots.inventory_store import InventoryStore, refresh_inventory
+import datetime
+import unittest
+from mock import MagicMock
+from boto.resultset import ResultSet
+from dateutil.tz import tzutc
+
+# 2018-01-10T12:00:00Z
+NOW = 1515585600
+
+
+def result_set(items):
+    rs = ResultSet()
+    rs.extend(items)
+    return rs
+
+
+def snapshot(id, volume_id, start_time, status="completed"):
+    return MagicMock(id=id, volume_id=volume_id, start_time=start_time, status=status)
+
+
+def copy(id, volume_id, source_snapshot_id, state="completed"):
+    return {
+        "SnapshotId": id,
+        "StartTime": datetime.datetime(2018, 1, 9, tzinfo=tzutc()),
+        "State": state,
+        "Tags": [
+            {"Key": "volume-id", "Value": volume_id},
+            {"Key": "source_snapshot", "Value": source_snapshot_id},
+        ],
+    }
+
+
+class TestInventoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = InventoryStore(":memory:")
+        self.connection = MagicMock()
+        self.connection.get_all_volumes.return_value = [MagicMock(id="vol-1", zone="us-west-1a")]
+        self.backup_client = MagicMock()
+        self.backup_pages = self.backup_client.get_paginator.return_value.paginate
+
+    def test_first_refresh_is_full(self):
+        self.connection.get_list.return_value = result_set([
+            snapshot("snap-1", "vol-1", "2018-01-08T00:00:00.000Z"),
+            snapshot("snap-2", "vol-1", "2018-01-09T00:00:00.000Z", "pending")])
+        self.backup_pages.return_value = [{"Snapshots": [copy("copy-1", "vol-1", "snap-1")]}]
+
+        inventory = refresh_inventory(self.store, self.connection, self.backup_client, ["vol-1"], clock=lambda: NOW)
+
+        self.assertEqual(1, self.connection.get_list.call_count)
+        self.assertEqual(["snap-1", "snap-2"], sorted(s.id for s in inventory.get_snapshots("vol-1")))
+        self.assertTrue(inventory.has_backup("vol-1", "snap-1"))
+
+    def test_later_refresh_only_fetches_delta(self):
+        self.connection.get_list.return_value = result_set([
+            snapshot("snap-1", "vol-1", "2018-01-08T00:00:00.000Z"),
+            snapshot("snap-2", "vol-1", "2018-01-09T00:00:00.000Z", "pending")])
+        self.backup_pages.return_value = [{"Snapshots": [copy("copy-1", "vol-1", "snap-1")]}]
+        refresh_inventory(self.store, self.connection, self.backup_client, ["vol-1"], clock=lambda: NOW)
+
+        self.connection.get_list.reset_mock()
+        self.connection.get_list.side_effect = [
+            result_set([snapshot("snap-3", "vol-1", "2018-01-10T00:00:00.000Z", "pending")]),
+            result_set([snapshot("snap-2", "vol-1", "2018-01-09T00:00:00.000Z", "completed")]),
+        ]
+        self.backup_pages.return_value = [{"Snapshots": []}]
+        inventory = refresh_inventory(self.store, self.connection, self.backup_client, ["vol-1"], clock=lambda: NOW + 300)
+
+        self.assertEqual(2, self.connection.get_list.call_count)
+        delta_filters, pending_filters = [c[0][1] for c in self.connection.build_filter_params.call_args_list[-2:]]
+        self.assertEqual(["2018-01-09*", "2018-01-10*"], delta_filters["start-time"])
+        self.assertEqual(["snap-2"], pending_filters["snapshot-id"])
+        self.assertEqual(
+            {"snap-1": "completed", "snap-2": "completed", "snap-3": "pending"},
+            dict((s.id, s.status) for s in inventory.get_snapshots("vol-1")))
+
+    def test_inventory_changes_write_through(self):
+        self.connection.get_list.return_value = result_set([])
+        self.backup_pages.return_value = [{"Snapshots": []}]
+        inventory = refresh_inventory(self.store, self.connection, self.backup_client, ["vol-1"], clock=lambda: NOW)
+        inventory.add_snapshot("vol-1", snapshot("snap-1", "vol-1", "2018-01-10T00:00:00.000Z"))
+        inventory.add_backup_snapshot("vol-1", copy("copy-1", "vol-1", "snap-0"))
+
+        reloaded = self.store.load({"vol-1": inventory.volumes["vol-1"]})
+        self.assertEqual(["snap-1"], [s.id for s in reloaded.get_snapshots("vol-1")])
+        self.assertTrue(reloaded.has_backup("vol-1", "snap-0"))
+
+        inventory.remove_snapshot("vol-1", "snap-1")
+        inventory.remove_backup_snapshot("vol-1", "copy-1")
+        reloaded = self.store.load({"vol-1": inventory.volumes["vol-1"]})
+        self.assertEqual([], reloaded.get_snapshots("vol-1"))
+        self.assertEqual([], reloaded.get_backup_snapshots("vol-1"))
+
+    def test_full_refresh_after_interval(self):
+        self.connection.get_list.return_value = result_set([
+            snapshot("snap-1", "vol-1", "2018-01-10T00:00:00.000Z")])
+        self.backup_pages.return_value = [{"Snapshots": []}]
+        refresh_inventory(self.store, self.connection, self.backup_client, ["vol-1"], clock=lambda: NOW)
+
+        # snap-1 was deleted outside of ebs-snapshots
+        self.connection.get_list.return_value = result_set([])
+        inventory = refresh_inventory(self.store, self.connection, self.backup_client, ["vol-1"],
+                                      full_refresh_interval=3600, clock=lambda: NOW + 3600)
+        self.assertEqual([], inventory.get_snapshots("vol-1"))
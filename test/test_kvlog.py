@@ -0,0 +1,60 @@
+from ebs_snapshots import kvlog
+import logging
+import unittest
+from mock import patch
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestKVLog(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger()
+        self.level = self.logger.level
+        self.handlers = list(self.logger.handlers)
+        self.handler = ListHandler()
+        self.logger.handlers = [self.handler]
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.logger.handlers = self.handlers
+        self.logger.setLevel(self.level)
+
+    def test_skips_formatting_below_level(self):
+        with patch.object(kvlog.kayvee, 'formatLog') as format_log:
+            kvlog.debug("evaluating volume", {"volume": "vol-1"})
+        self.assertEqual(0, format_log.call_count)
+        self.assertEqual([], self.handler.messages)
+
+    def test_formats_when_emitted(self):
+        kvlog.info("created snapshot successfully", {"volume": "vol-1"})
+        self.assertEqual(1, len(self.handler.messages))
+        self.assertIn('"title":"created snapshot successfully"', self.handler.messages[0])
+        self.assertIn('"volume":"vol-1"', self.handler.messages[0])
+
+    def test_queue_handler(self):
+        queue_handler = kvlog.use_queue(self.logger)
+        self.assertEqual([queue_handler], self.logger.handlers)
+        kvlog.info("one")
+        kvlog.warning("two")
+        queue_handler.close()
+        self.assertEqual(2, len(self.handler.messages))
+        self.assertIn('"title":"two"', self.handler.messages[1])
+
+    def test_summary(self):
+        summary = kvlog.CycleSummary()
+        summary.count('created')
+        summary.count('deleted', 2)
+        counts = summary.flush({"volumes": 3})
+        self.assertEqual(dict(created=1, copied=0, unchanged=0, deleted=2, skipped=0, failed=0), counts)
+        self.assertIn('"deleted":2', self.handler.messages[0])
+        self.assertIn('"volumes":3', self.handler.messages[0])
+        self.assertEqual(0, summary.flush()['created'])
@@ -0,0 +1,70 @@
+from ebs_snapshots.metrics import MetricsRegistry, InstrumentedClient, serve
+from botocore.exceptions import ClientError
+import unittest
+import urllib2
+from mock import MagicMock
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        registry.describe('calls_total', 'Calls made')
+        registry.inc('calls_total', region="us-west-1")
+        registry.inc('calls_total', 2, region="us-west-1")
+        registry.set('age_seconds', lambda: 42, volume="vol-1")
+        registry.observe('latency_seconds', 0.2, buckets=(0.1, 1))
+        registry.observe('latency_seconds', 5, buckets=(0.1, 1))
+        self.assertEqual("\n".join([
+            '# HELP calls_total Calls made',
+            '# TYPE calls_total counter',
+            'calls_total{region="us-west-1"} 3',
+            '# TYPE age_seconds gauge',
+            'age_seconds{volume="vol-1"} 42',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 0',
+            'latency_seconds_bucket{le="1"} 1',
+            'latency_seconds_bucket{le="+Inf"} 2',
+            'latency_seconds_sum 5.2',
+            'latency_seconds_count 2',
+        ]) + "\n", registry.render())
+
+    def test_serve(self):
+        registry = MetricsRegistry()
+        registry.set('up', 1)
+        server = serve(registry, 0)
+        try:
+            body = urllib2.urlopen('http://127.0.0.1:{}/metrics'.format(server.server_address[1])).read()
+        finally:
+            server.shutdown()
+        self.assertIn('up 1', body)
+
+
+class TestInstrumentedClient(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.client = MagicMock()
+        self.instrumented = InstrumentedClient(self.client, self.registry, 'ec2', 'us-west-1')
+
+    def test_records_calls_and_errors(self):
+        self.client.delete_snapshot.side_effect = ClientError(
+            {"Error": {"Code": "InvalidSnapshot.InUse"}}, "DeleteSnapshot")
+        self.instrumented.copy_snapshot(SourceSnapshotId="snap-1")
+        self.instrumented.get_list('DescribeSnapshots', {}, [])
+        with self.assertRaises(ClientError):
+            self.instrumented.delete_snapshot(SnapshotId="snap-1")
+
+        labels = dict(service='ec2', region='us-west-1')
+        self.assertEqual(1, self.registry.get('aws_api_calls_total', operation='CopySnapshot', **labels))
+        self.assertEqual(1, self.registry.get('aws_api_calls_total', operation='DescribeSnapshots', **labels))
+        self.assertEqual(1, self.registry.get('aws_api_latency_seconds', operation='DeleteSnapshot', **labels))
+        self.assertEqual(1, self.registry.get(
+            'aws_api_errors_total', operation='DeleteSnapshot', code='InvalidSnapshot.InUse', **labels))
+
+    def test_records_each_page(self):
+        self.client.get_paginator.return_value.paginate.return_value = [{"Snapshots": []}] * 3
+        pages = list(self.instrumented.get_paginator('describe_snapshots').paginate(OwnerIds=['self']))
+        self.assertEqual(3, len(pages))
+        self.assertEqual(3, self.registry.get(
+            'aws_api_calls_total', service='ec2', region='us-west-1', operation='DescribeSnapshots'))
@@ -0,0 +1,159 @@
+from ebs_snapshots.rate_limiter import api_family, TokenBucket, RateLimiter, RateLimitedClient, RetryBudget
+from ebs_snapshots.metrics import MetricsRegistry
+from boto.exception import EC2ResponseError
+from botocore.exceptions import ClientError
+import unittest
+from mock import MagicMock
+
+
+def throttle():
+    return ClientError({"Error": {"Code": "RequestLimitExceeded", "Message": ""}}, 'CopySnapshot')
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_api_family(self):
+        self.assertEqual('describe', api_family('get_all_snapshots'))
+        self.assertEqual('describe', api_family('describe_snapshots'))
+        self.assertEqual('describe', api_family('DescribeVolumes'))
+        self.assertEqual('describe', api_family('get_only_instances'))
+        self.assertEqual('create', api_family('create_snapshot'))
+        self.assertEqual('create', api_family('create_tags'))
+        self.assertEqual('copy', api_family('copy_snapshot'))
+        self.assertEqual('delete', api_family('DeleteSnapshot'))
+        self.assertEqual(None, api_family('build_filter_params'))
+
+    def test_bucket_allows_burst_then_waits(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, 3, clock=clock.time, sleep=clock.sleep)
+        for _ in range(3):
+            self.assertEqual(0, bucket.acquire())
+        self.assertAlmostEqual(0.5, bucket.acquire())
+        self.assertAlmostEqual(0.5, bucket.acquire())
+        self.assertEqual([0.5, 0.5], clock.slept)
+
+    def test_bucket_refills(self):
+        clock = FakeClock()
+        bucket = TokenBucket(1, 2, clock=clock.time, sleep=clock.sleep)
+        bucket.acquire()
+        bucket.acquire()
+        clock.now += 10
+        self.assertEqual(0, bucket.acquire())
+        self.assertEqual(0, bucket.acquire())
+
+    def test_buckets_are_per_region_and_family(self):
+        limiter = RateLimiter()
+        self.assertIs(limiter.bucket('us-west-1', 'copy'), limiter.bucket('us-west-1', 'copy'))
+        self.assertIsNot(limiter.bucket('us-west-1', 'copy'), limiter.bucket('us-west-2', 'copy'))
+        self.assertIsNot(limiter.bucket('us-west-1', 'copy'), limiter.bucket('us-west-1', 'create'))
+
+    def test_client_acquires_per_call(self):
+        limiter = RateLimiter()
+        limiter.acquire = MagicMock()
+        client = MagicMock()
+        limited = RateLimitedClient(client, limiter, 'us-west-1')
+        limited.copy_snapshot(SourceSnapshotId='snap-1')
+        limited.get_list('DescribeSnapshots', {})
+        limited.build_filter_params({}, {})
+        self.assertEqual(
+            [('us-west-1', 'copy'), ('us-west-1', 'describe')],
+            [c[0] for c in limiter.acquire.call_args_list])
+        client.copy_snapshot.assert_called_once_with(SourceSnapshotId='snap-1')
+
+    def test_paginator_acquires_per_page(self):
+        limiter = RateLimiter()
+        limiter.acquire = MagicMock()
+        client = MagicMock()
+        client.get_paginator.return_value.paginate.return_value = [{"Snapshots": []}] * 3
+        limited = RateLimitedClient(client, limiter, 'us-west-2')
+        pages = list(limited.get_paginator('describe_snapshots').paginate(OwnerIds=['self']))
+        self.assertEqual(3, len(pages))
+        self.assertEqual(4, limiter.acquire.call_count)
+
+    def test_bucket_backs_off_and_recovers(self):
+        clock = FakeClock()
+        bucket = TokenBucket(4, 10, clock=clock.time, sleep=clock.sleep)
+        self.assertTrue(bucket.decrease())
+        # throttles within a second of each other count once
+        self.assertFalse(bucket.decrease())
+        self.assertEqual(2, bucket.rate)
+        self.assertAlmostEqual(0.5, bucket.acquire())
+        clock.now += 1
+        bucket.decrease()
+        self.assertEqual(1, bucket.rate)
+        for _ in range(100):
+            bucket.increase()
+        self.assertEqual(4, bucket.rate)
+
+    def test_call_retries_throttled_calls_and_slows_down(self):
+        clock = FakeClock()
+        metrics = MetricsRegistry()
+        limiter = RateLimiter(metrics=metrics, clock=clock.time, sleep=clock.sleep, random=lambda: 1.0)
+        function = MagicMock(side_effect=[throttle(), throttle(), "copied"])
+        self.assertEqual("copied", limiter.call('us-west-2', 'copy', function, SourceSnapshotId='snap-1'))
+        self.assertEqual(3, function.call_count)
+        self.assertLess(limiter.bucket('us-west-2', 'copy').rate, 5)
+        self.assertEqual(2, metrics.get('aws_api_retries_total', region='us-west-2', family='copy',
+                                        code='RequestLimitExceeded'))
+        # backoffs of up to 1 then 2 seconds, plus waits for the slowed down bucket
+        self.assertTrue(set([1.0, 2.0]) <= set(clock.slept))
+
+    def test_call_gives_up(self):
+        clock = FakeClock()
+        limiter = RateLimiter(clock=clock.time, sleep=clock.sleep)
+        error = EC2ResponseError(500, 'Internal Server Error')
+        error.error_code = 'InternalError'
+        create = MagicMock(side_effect=error)
+        with self.assertRaises(EC2ResponseError):
+            limiter.call('us-west-1', 'create', create)
+        # a create might have gone through
+        self.assertEqual(1, create.call_count)
+        describe = MagicMock(side_effect=error)
+        with self.assertRaises(EC2ResponseError):
+            limiter.call('us-west-1', 'describe', describe)
+        self.assertEqual(5, describe.call_count)
+        not_found = MagicMock(side_effect=ClientError({"Error": {"Code": "InvalidVolume.NotFound"}}, 'x'))
+        with self.assertRaises(ClientError):
+            limiter.call('us-west-1', 'describe', not_found)
+        self.assertEqual(1, not_found.call_count)
+
+    def test_retry_budget(self):
+        budget = RetryBudget(ratio=0.5, maximum=2)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+    def test_paginator_resumes_after_throttle(self):
+        limiter = RateLimiter(sleep=lambda seconds: None)
+        client = MagicMock()
+
+        def paginate(PaginationConfig, **kwargs):
+            if PaginationConfig.get("StartingToken") == "t1":
+                yield {"Snapshots": [2]}
+                return
+            yield {"Snapshots": [1], "NextToken": "t1"}
+            raise throttle()
+        client.get_paginator.return_value.paginate.side_effect = paginate
+        limited = RateLimitedClient(client, limiter, 'us-west-2')
+        pages = list(limited.get_paginator('describe_snapshots').paginate(
+            OwnerIds=['self'], PaginationConfig={"PageSize": 1}))
+        self.assertEqual([[1], [2]], [p["Snapshots"] for p in pages])
+        self.assertEqual({"PageSize": 1, "StartingToken": "t1"},
+                         client.get_paginator.return_value.paginate.call_args[1]["PaginationConfig"])
@@ -57,3 +57,20 @@ class TestS3BackupConfig(unittest.TestCase):
             data['vol-2'], {'interval': 'monthly', 'max_snapshots': 1})
         self.assertEquals(
             data['vol-3'], {'interval': 'hourly', 'max_snapshots': 2})
+
+    @mock_s3
+    def test_refresh_reuses_parsed_config_until_object_changes(self):
+        conn = boto.connect_s3()
+        bucket = conn.create_bucket('fake-bucket')
+        k = boto.s3.key.Key(bucket)
+        k.key = "example-volumes.yml"
+        k.set_contents_from_filename("test/example-volumes.yml")
+
+        b = S3BackupConfig(
+            "s3://fake-bucket/example-volumes.yml")
+        first = b.refresh()
+        self.assertIs(first, b.refresh())
+
+        k.set_contents_from_string("vol-1:\n  interval: hourly\n")
+        second = b.refresh()
+        self.assertEqual({"vol-1": {"interval": "hourly"}}, second)
@@ -0,0 +1,31 @@
+from ebs_snapshots.scheduler import Scheduler
+import unittest
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_pops_only_due_volumes_in_order(self):
+        s = Scheduler()
+        s.schedule("vol-2", 20)
+        s.schedule("vol-1", 10)
+        s.schedule("vol-3", 30)
+        self.assertEqual(10, s.next_deadline())
+        self.assertEqual(["vol-1", "vol-2"], s.pop_due(25))
+        self.assertEqual(30, s.next_deadline())
+        self.assertEqual(1, len(s))
+
+    def test_reschedule_replaces_deadline(self):
+        s = Scheduler()
+        s.schedule("vol-1", 10)
+        s.schedule("vol-1", 50)
+        self.assertEqual([], s.pop_due(20))
+        self.assertEqual(50, s.next_deadline())
+        self.assertEqual(["vol-1"], s.pop_due(50))
+        self.assertEqual(None, s.next_deadline())
+
+    def test_remove(self):
+        s = Scheduler()
+        s.schedule("vol-1", 10)
+        s.remove("vol-1")
+        self.assertFalse("vol-1" in s)
+        self.assertEqual([], s.pop_due(100))
@@ -0,0 +1,117 @@
+from ebs_snapshots.sharding import HashRing, SQLiteLeaseStore, Shard
+import socket
+import sqlite3
+import unittest
+from mock import MagicMock
+
+
+class FakeClock:
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_removing_a_replica_only_moves_its_keys(self):
+        keys = ['vol-{}'.format(i) for i in range(1000)]
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b'])
+        owners = dict((k, before.owner(k)) for k in keys)
+        for key in keys:
+            if owners[key] != 'c':
+                self.assertEqual(owners[key], after.owner(key))
+        # roughly even split
+        for replica in ('a', 'b', 'c'):
+            self.assertTrue(200 < owners.values().count(replica) < 466)
+
+    def test_empty_ring(self):
+        self.assertIsNone(HashRing([]).owner('vol-1'))
+
+
+class TestShard(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(1000)
+        self.store = SQLiteLeaseStore(':memory:', ttl=60, clock=self.clock.time)
+        self.keys = ['vol-{}'.format(i) for i in range(200)]
+
+    def shard(self, replica_id):
+        return Shard(self.store, replica_id, ttl=60, clock=self.clock.time)
+
+    def owned(self, shard):
+        return set(k for k in self.keys if shard.owns(k))
+
+    def test_leases_expire(self):
+        self.store.renew('a')
+        self.clock.now += 59
+        self.assertEqual(['a'], self.store.live())
+        self.clock.now += 1
+        self.assertEqual([], self.store.live())
+
+    def advance(self, seconds, *shards):
+        """ Advance the clock, with the given replicas heartbeating every 20s as they would at ttl 60 """
+        for _ in range(seconds / 20):
+            for shard in shards:
+                shard.heartbeat()
+            self.clock.now += 20
+        for shard in shards:
+            shard.heartbeat()
+
+    def test_new_replica_waits_for_ttl(self):
+        a = self.shard('a')
+        self.advance(40, a)
+        self.assertEqual(set(), self.owned(a))
+        self.advance(20, a)
+        self.assertEqual(set(self.keys), self.owned(a))
+
+    def test_replicas_split_volumes_without_overlap(self):
+        a, b = self.shard('a'), self.shard('b')
+        self.advance(60, a)
+        self.advance(0, b, a)
+        # a lets go of b's volumes at once, b waits until a has surely seen it
+        self.assertTrue(0 < len(self.owned(a)) < len(self.keys))
+        self.assertEqual(set(), self.owned(b))
+        self.advance(60, a, b)
+        self.assertEqual(set(), self.owned(a) & self.owned(b))
+        self.assertEqual(set(self.keys), self.owned(a) | self.owned(b))
+
+        # b dies: a takes its volumes over once b's lease has expired, and ttl after that
+        self.advance(100, a)
+        self.assertNotEqual(set(self.keys), self.owned(a))
+        self.advance(20, a)
+        self.assertEqual(set(self.keys), self.owned(a))
+
+    def test_filter_keeps_instance_volumes_together(self):
+        a, b = self.shard('a'), self.shard('b')
+        self.advance(60, a, b)
+        config = dict(('vol-{}'.format(i), {'instance': 'i-1'}) for i in range(20))
+        owner, other = (a, b) if a.owns('i-1') else (b, a)
+        self.assertEqual(config, owner.filter(config))
+        self.assertEqual({}, other.filter(config))
+
+    def test_gives_up_volumes_when_lease_cannot_be_renewed(self):
+        a = self.shard('a')
+        self.advance(60, a)
+        a.store = MagicMock()
+        a.store.renew.side_effect = sqlite3.OperationalError('database is locked')
+        self.clock.now += 30
+        a.heartbeat()
+        self.assertTrue(a.owns('vol-1'))
+        self.clock.now += 30
+        self.assertFalse(a.owns('vol-1'))
+
+    def test_heartbeat_survives_network_errors(self):
+        a = self.shard('a')
+        self.advance(60, a)
+        a.store = MagicMock()
+        a.store.renew.side_effect = socket.error('connection reset by peer')
+        a.heartbeat()
+        a.store.renew.side_effect = None
+        a.store.live.return_value = ['a']
+        self.clock.now += 30
+        a.heartbeat()
+        self.assertTrue(a.owns('vol-1'))
@@ -0,0 +1,48 @@
+from simulation.fake_ec2 import FakeRegion
+from simulation.simulator import Simulation, VirtualClock
+from ebs_snapshots.stagger import Stagger, offset
+import unittest
+
+DAY = 24 * 3600
+
+
+class TestSimulation(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock(1514764800)
+        self.primary = FakeRegion('us-west-1', completion_seconds=600, clock=self.clock, sleep=self.clock.sleep)
+        self.backup = FakeRegion('us-east-1', completion_seconds=900, clock=self.clock, sleep=self.clock.sleep)
+        self.volume_ids = [self.primary.add_volume('us-west-1a') for _ in range(5)]
+
+    def simulate(self, params, days, stagger=None):
+        config = dict((volume_id, dict(params)) for volume_id in self.volume_ids)
+        simulation = Simulation(config, self.primary, self.backup, self.clock, stagger=stagger)
+        return simulation.run(days * DAY)
+
+    def test_daily_snapshots_copies_and_retention(self):
+        samples = self.simulate({"interval": "daily", "max_snapshots": 3}, 10)
+        last = samples[-1]
+        # one snapshot a day per volume, each just over a day after the last
+        self.assertEqual(50, last["created"])
+        # retention runs as each new snapshot starts, so the three before it are kept until the next cycle
+        self.assertEqual(30, last["deleted"])
+        self.assertEqual(20, last["snapshots"])
+        # plus the copy of the newest snapshot, made after the cycle that pruned the copies
+        self.assertEqual(20, last["copies"])
+        self.assertEqual(0, last["failed"])
+        # once running, no volume is ever more than an interval plus completion time behind
+        for sample in samples[1:]:
+            self.assertEqual(0, sample["overdue"])
+            self.assertTrue(sample["max_rpo_intervals"] < 1.01, sample)
+            self.assertTrue(sample["max_backup_rpo_seconds"] < DAY + 1800, sample)
+
+    def test_staggered_volumes_come_due_at_their_offsets(self):
+        start = self.clock()
+        self.simulate({"interval": "daily"}, 3, Stagger(clock=self.clock))
+        starts = {}
+        for snapshot in self.primary.snapshots.values():
+            starts.setdefault(snapshot.volume_id, []).append(snapshot.created - start)
+        for volume_id in self.volume_ids:
+            # the first snapshot right away, then one a day at the volume's offset
+            due = offset(volume_id, DAY)
+            self.assertEqual([0, due, due + DAY, due + 2 * DAY], sorted(starts[volume_id]))
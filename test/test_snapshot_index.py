@@ -0,0 +1,49 @@
+from ebs_snapshots.snapshot_index import SnapshotIndex, parse_start_time, backup_snapshot_start
+from ebs_snapshots.inventory import SnapshotInventory
+import datetime
+import unittest
+from dateutil.tz import tzutc
+from mock import MagicMock
+
+
+def snapshot(day, status="completed"):
+    return MagicMock(id="snap-{}".format(day), start_time="2018-01-0{}T00:00:00.000Z".format(day), status=status)
+
+
+class TestSnapshotIndex(unittest.TestCase):
+
+    def test_parse_start_time(self):
+        self.assertEqual(1514764800.5, parse_start_time("2018-01-01T00:00:00.500Z"))
+        self.assertEqual(1514764800, parse_start_time("2018-01-01T00:00:00Z"))
+        self.assertEqual(1514764800.25, backup_snapshot_start(
+            {"StartTime": datetime.datetime(2018, 1, 1, 0, 0, 0, 250000, tzinfo=tzutc())}))
+
+    def test_all_but_newest(self):
+        index = SnapshotIndex([snapshot(d) for d in [3, 1, 5, 2, 4]])
+        self.assertEqual(["snap-1", "snap-2", "snap-3"], [s.id for s in index.all_but_newest(2)])
+        self.assertEqual([], index.all_but_newest(0))
+        self.assertEqual([], index.all_but_newest(5))
+
+    def test_newest_and_newest_completed(self):
+        index = SnapshotIndex([snapshot(1), snapshot(3, "pending"), snapshot(2)])
+        self.assertEqual("snap-3", index.newest()[1].id)
+        self.assertEqual(parse_start_time("2018-01-02T00:00:00.000Z"), index.newest_completed()[0])
+        self.assertIsNone(SnapshotIndex([]).newest())
+        self.assertIsNone(SnapshotIndex([snapshot(1, "pending")]).newest_completed())
+
+    def test_pending_since_completed(self):
+        index = SnapshotIndex([snapshot(1, "pending"), snapshot(2), snapshot(3, "pending"), snapshot(4, "error"),
+                               snapshot(5, "pending")])
+        self.assertEqual(["snap-5", "snap-3"], [s.id for s in index.pending_since_completed()])
+        self.assertEqual([], SnapshotIndex([snapshot(1, "pending"), snapshot(2)]).pending_since_completed())
+
+    def test_inventory_keeps_index_up_to_date(self):
+        inventory = SnapshotInventory()
+        inventory.add_snapshot("vol-1", snapshot(2))
+        index = inventory.snapshot_index("vol-1")
+        inventory.add_snapshot("vol-1", snapshot(1))
+        inventory.add_snapshot("vol-1", snapshot(3))
+        inventory.remove_snapshot("vol-1", "snap-2")
+        self.assertEqual(["snap-1", "snap-3"], [s.id for s in index])
+        self.assertEqual([parse_start_time("2018-01-01T00:00:00.000Z"), parse_start_time("2018-01-03T00:00:00.000Z")],
+                         list(index.starts))
@@ -1,9 +1,19 @@
 import ebs_snapshots.snapshot_manager as snapshot_manager
+from ebs_snapshots.inventory import SnapshotInventory, build_inventory
+from ebs_snapshots.snapshot_index import SnapshotIndex, parse_start_time
+from ebs_snapshots.stagger import Stagger
+from ebs_snapshots import kvlog
+from simulation.fake_ec2 import FakeRegion, FakeEC2Connection, FakeEC2Client, FakeEBSClient
+import time
 import unittest
-from mock import MagicMock
+from mock import MagicMock, patch
 import boto
+from boto.exception import EC2ResponseError
 from moto import mock_ec2
 
+OLD_START_TIME = "2018-01-01T00:00:00.000Z"
+
+
 class TestSnapshotManager(unittest.TestCase):
 
     @mock_ec2
@@ -14,12 +24,275 @@ class TestSnapshotManager(unittest.TestCase):
         volume = conn.create_volume(50, 'us-west-1a')
 
         # mock out details for snapshot_manager.run
-        snapshot_manager._ensure_snapshot = MagicMock()
-        snapshot_manager._remove_old_snapshots = MagicMock()
-        snapshot_manager._remove_old_snapshot_backups = MagicMock()
-
-        # run function for volume
-        snapshot_manager.run(conn, volume.id, 'daily', 0, '')
-        self.assertEqual(1, snapshot_manager._ensure_snapshot.call_count)
-        self.assertEqual(1, snapshot_manager._remove_old_snapshots.call_count)
-        self.assertEqual(1, snapshot_manager._remove_old_snapshot_backups.call_count)
+        with patch.object(snapshot_manager, '_ensure_snapshot') as ensure, \
+                patch.object(snapshot_manager, '_remove_old_snapshots') as remove_snapshots, \
+                patch.object(snapshot_manager, '_remove_old_snapshot_backups') as remove_backups:
+
+            # run function for volume
+            snapshot_manager.run(conn, MagicMock(), volume.id, 'daily', 0, '')
+            self.assertEqual(1, ensure.call_count)
+            self.assertEqual(1, remove_snapshots.call_count)
+            self.assertEqual(1, remove_backups.call_count)
+
+
+class TestEnsureSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = MagicMock()
+        self.connection.get_object.return_value = MagicMock(
+            id="snap-new", status="pending", start_time="2030-01-01T00:00:00.000Z")
+        self.volume = MagicMock(id="vol-1", zone="us-west-1a")
+        self.inventory = SnapshotInventory()
+        self.inventory.volumes["vol-1"] = self.volume
+        self.inventory.add_snapshot("vol-1", MagicMock(
+            id="snap-old", status="completed", start_time=OLD_START_TIME))
+        self.copy_queue = MagicMock()
+        self.tracker = MagicMock()
+
+    def ensure(self, stagger=None):
+        snapshot_manager._ensure_snapshot(
+            self.connection, MagicMock(), self.volume, 'daily', 'name', self.inventory,
+            copy_queue=self.copy_queue, completion_tracker=self.tracker, stagger=stagger)
+
+    def test_watches_new_snapshot_and_queues_copy(self):
+        self.ensure()
+        self.assertEqual(1, self.connection.get_object.call_count)
+        self.tracker.watch.assert_called_once_with("snap-new", self.volume, "name")
+        self.copy_queue.enqueue.assert_called_once_with(self.volume, "snap-old", "name")
+        self.assertEqual(2, len(self.inventory.get_snapshots("vol-1")))
+
+    def test_counts_created_in_summary(self):
+        with patch.object(snapshot_manager.kvlog, 'count') as count:
+            self.ensure()
+        count.assert_called_once_with('created')
+
+    def test_skips_copy_if_already_backed_up(self):
+        self.inventory.add_backup_snapshot("vol-1", {
+            "SnapshotId": "copy-1",
+            "Tags": [{"Key": "source_snapshot", "Value": "snap-old"}],
+        })
+        self.ensure()
+        self.assertEqual(0, self.copy_queue.enqueue.call_count)
+
+    def test_watches_pending_snapshots(self):
+        self.inventory.add_snapshot("vol-1", MagicMock(
+            id="snap-pending", status="pending", start_time="2030-01-01T00:00:00.000Z"))
+        self.ensure()
+        self.tracker.watch.assert_called_once_with("snap-pending", self.volume, "name")
+        self.assertEqual(0, self.connection.get_object.call_count)
+
+    def test_copies_completed_snapshot_without_backup_when_not_due(self):
+        self.inventory.now = parse_start_time(OLD_START_TIME) + 60
+        self.tracker.__contains__ = MagicMock(return_value=False)
+        self.ensure()
+        self.assertEqual(0, self.connection.get_object.call_count)
+        self.copy_queue.enqueue.assert_called_once_with(self.volume, "snap-old", "name")
+
+    def test_recopies_failed_backup(self):
+        self.inventory.now = parse_start_time(OLD_START_TIME) + 60
+        self.tracker.__contains__ = MagicMock(return_value=False)
+        self.inventory.add_backup_snapshot("vol-1", {
+            "SnapshotId": "copy-1",
+            "State": "error",
+            "Tags": [{"Key": "source_snapshot", "Value": "snap-old"}],
+        })
+        self.ensure()
+        self.copy_queue.enqueue.assert_called_once_with(self.volume, "snap-old", "name")
+
+    def test_leaves_tracked_snapshot_to_tracker(self):
+        self.inventory.now = parse_start_time(OLD_START_TIME) + 60
+        self.tracker.__contains__ = MagicMock(return_value=True)
+        self.ensure()
+        self.assertEqual(0, self.copy_queue.enqueue.call_count)
+
+    def test_stagger_waits_for_volume_offset(self):
+        stagger = Stagger()
+        due = stagger.due_at("vol-1", 86400, parse_start_time(OLD_START_TIME))
+        self.inventory.now = due - 1
+        self.ensure(stagger)
+        self.assertEqual(0, self.connection.get_object.call_count)
+        self.inventory.now = due
+        self.ensure(stagger)
+        self.assertEqual(1, self.connection.get_object.call_count)
+
+    def test_stagger_defers_creates_over_cap(self):
+        stagger = Stagger(creates_per_minute=1)
+        stagger.take('create', 'vol-other')
+        with patch.object(snapshot_manager.kvlog, 'count') as count:
+            self.ensure(stagger)
+        self.assertEqual(0, self.connection.get_object.call_count)
+        count.assert_called_once_with('skipped')
+
+    def test_tags_snapshot_on_creation(self):
+        self.ensure()
+        action, params = self.connection.get_object.call_args[0][:2]
+        self.assertEqual("CreateSnapshot", action)
+        self.assertEqual({
+            "VolumeId": "vol-1",
+            "Description": "automatic snapshot by ebs-snapshots",
+            "TagSpecification.1.ResourceType": "snapshot",
+            "TagSpecification.1.Tag.1.Key": "Name",
+            "TagSpecification.1.Tag.1.Value": "name",
+            "TagSpecification.1.Tag.2.Key": "creator",
+            "TagSpecification.1.Tag.2.Value": "ebs-snapshots",
+        }, params)
+        self.assertEqual(0, self.connection.create_tags.call_count)
+
+    def test_failed_create_only_fails_its_volume(self):
+        self.connection.get_object.side_effect = EC2ResponseError(500, "Internal Error")
+        summary = kvlog.CycleSummary()
+        kvlog.use_summary(summary)
+        try:
+            snapshot_manager.run(self.connection, MagicMock(), "vol-1", 'daily', 0, 'name', inventory=self.inventory,
+                                 copy_queue=self.copy_queue, completion_tracker=self.tracker)
+        finally:
+            kvlog.use_summary(kvlog.summary)
+        self.assertEqual(1, summary.flush()['failed'])
+
+
+class TestCopySnapshot(unittest.TestCase):
+
+    def test_tags_copy_on_creation(self):
+        backup_client = MagicMock()
+        backup_client.copy_snapshot.return_value = {"SnapshotId": "copy-1"}
+        volume = MagicMock(id="vol-1", zone="us-west-1a")
+        self.assertEqual("copy-1", snapshot_manager._copy_snapshot(backup_client, volume, "snap-1", "name"))
+        tag_specs = backup_client.copy_snapshot.call_args[1]["TagSpecifications"]
+        self.assertEqual([{
+            "ResourceType": "snapshot",
+            "Tags": [
+                {"Key": "Name", "Value": "name"},
+                {"Key": "creator", "Value": "ebs-snapshots"},
+                {"Key": "source_snapshot", "Value": "snap-1"},
+                {"Key": "volume-id", "Value": "vol-1"},
+            ],
+        }], tag_specs)
+        self.assertEqual(0, backup_client.create_tags.call_count)
+
+
+class TestRunInstance(unittest.TestCase):
+
+    def setUp(self):
+        self.primary = FakeRegion('us-west-1')
+        self.connection = FakeEC2Connection(self.primary)
+        self.volume_ids = [self.primary.add_volume('us-west-1a') for _ in range(3)]
+        self.instance_id = self.primary.add_instance(self.volume_ids)
+        self.copy_queue = MagicMock()
+
+    def run_instance(self, volume_ids, inventory):
+        snapshot_manager.run_instance(
+            self.connection, MagicMock(), self.instance_id, volume_ids, 'daily', 0, 'raid',
+            exclude_boot_volume=True, inventory=inventory, copy_queue=self.copy_queue)
+
+    def test_snapshots_instance_with_one_call(self):
+        self.primary.completion_seconds = 3600
+        inventory = build_inventory(self.connection, MagicMock(), self.volume_ids[1:])
+        self.run_instance(self.volume_ids[1:], inventory)
+        self.assertEqual(1, self.primary.calls['CreateSnapshots'])
+        self.assertNotIn('CreateSnapshot', self.primary.calls)
+        for volume_id in self.volume_ids[1:]:
+            snapshots = inventory.get_snapshots(volume_id)
+            self.assertEqual(1, len(snapshots))
+            self.assertEqual('pending', snapshots[0].status)
+            self.assertEqual({'Name': 'raid', 'creator': 'ebs-snapshots'},
+                             self.primary.snapshots[snapshots[0].id].tags)
+        self.assertEqual([], inventory.get_snapshots(self.volume_ids[0]))
+
+    def test_snapshots_all_volumes_when_one_is_due(self):
+        self.primary.add_snapshot(self.volume_ids[1], {'creator': 'ebs-snapshots'})
+        self.primary.add_snapshot(self.volume_ids[2], {'creator': 'ebs-snapshots'}, created=0, completes=0)
+        inventory = build_inventory(self.connection, MagicMock(), self.volume_ids[1:])
+        self.run_instance(self.volume_ids[1:], inventory)
+        self.assertEqual(1, self.primary.calls['CreateSnapshots'])
+
+        self.primary.reset_stats()
+        inventory = build_inventory(self.connection, MagicMock(), self.volume_ids[1:])
+        self.run_instance(self.volume_ids[1:], inventory)
+        self.assertNotIn('CreateSnapshots', self.primary.calls)
+
+
+class TestSkipUnchanged(unittest.TestCase):
+
+    def setUp(self):
+        self.primary = FakeRegion('us-west-1')
+        self.backup = FakeRegion('us-west-2')
+        self.connection = FakeEC2Connection(self.primary)
+        self.backup_client = FakeEC2Client(self.backup, {'us-west-1': self.primary})
+        self.volume_id = self.primary.add_volume('us-west-1a')
+        now = time.time()
+        self.previous = self.primary.add_snapshot(self.volume_id, {'creator': 'ebs-snapshots'}, created=now - 7200)
+        self.copy = self.backup.add_snapshot(
+            self.volume_id, {'creator': 'ebs-snapshots', 'volume-id': self.volume_id, 'source_snapshot': self.previous.id},
+            created=now - 7000)
+
+    def run_volume(self):
+        self.latest = self.primary.add_snapshot(self.volume_id, {'creator': 'ebs-snapshots'},
+                                                created=time.time() - 3600)
+        inventory = build_inventory(self.connection, self.backup_client, [self.volume_id])
+        snapshot_manager.run(self.connection, self.backup_client, self.volume_id, 'daily', 0, '',
+                             inventory=inventory, ebs_client=FakeEBSClient(self.primary))
+        return inventory
+
+    def test_reuses_backup_of_unchanged_volume(self):
+        inventory = self.run_volume()
+        self.assertNotIn('CopySnapshot', self.backup.calls)
+        self.assertEqual(self.latest.id, self.backup.snapshots[self.copy.id].tags['source_snapshot'])
+        self.assertTrue(inventory.has_backup(self.volume_id, self.latest.id))
+        # the previous snapshot is left to retention
+        self.assertNotIn('DeleteSnapshot', self.primary.calls)
+        self.assertEqual(sorted([self.previous.id, self.latest.id]),
+                         sorted(s.id for s in inventory.get_snapshots(self.volume_id)))
+
+    def test_copies_changed_volume(self):
+        self.primary.write(self.volume_id, [0, 7])
+        self.run_volume()
+        self.assertEqual(1, self.backup.calls['CopySnapshot'])
+        self.assertEqual(self.previous.id, self.backup.snapshots[self.copy.id].tags['source_snapshot'])
+        self.assertIn(self.previous.id, self.primary.snapshots)
+
+
+class TestRetention(unittest.TestCase):
+
+    def test_tiered_retention(self):
+        # hourly snapshots for 60 days, up to 2018-03-01T23:00Z
+        start = 1514764800
+        snapshots = [MagicMock(id=i, start_time=time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(start + i * 3600)))
+                     for i in range(60 * 24)]
+        index = SnapshotIndex(snapshots)
+        expired = snapshot_manager._expired_snapshots(index, 0, {"hourly": 24, "daily": 7, "monthly": 3})
+        kept = sorted(set(range(len(snapshots))) - set(s.id for s in expired))
+        newest = len(snapshots) - 1
+        # the last 24 hours, the last snapshot of each of the 6 days before, and the end of January (the
+        # end of February is one of those days)
+        self.assertEqual(range(newest - 23, newest + 1), kept[-24:])
+        self.assertEqual([newest - 24 * d for d in range(6, 0, -1)], kept[1:7])
+        self.assertEqual(31 * 24 - 1, kept[0])
+        self.assertEqual(31, len(kept))
+        self.assertEqual(sorted(expired, key=lambda s: s.id), expired)
+
+    def test_tiered_retention_keeps_newest(self):
+        index = SnapshotIndex([MagicMock(id=1, start_time="2018-01-01T00:00:00.000Z")])
+        self.assertEqual([], snapshot_manager._expired_snapshots(index, 0, {"daily": 0, "weekly": 0}))
+
+    def test_keeps_newest_completed_while_new_snapshots_are_pending(self):
+        snapshots = [MagicMock(id=day, status=status, start_time="2018-01-0{}T00:00:00.000Z".format(day))
+                     for day, status in [(1, "completed"), (2, "completed"), (3, "pending"), (4, "pending")]]
+        index = SnapshotIndex(snapshots)
+        self.assertEqual([1], [s.id for s in snapshot_manager._expired_snapshots(index, 1)])
+        self.assertEqual([1], [s.id for s in snapshot_manager._expired_snapshots(index, 0, {"daily": 1})])
+        # pending snapshots older than the newest completed one count as usual
+        index = SnapshotIndex(snapshots[:2] + [MagicMock(id=0, status="pending", start_time="2017-12-31T00:00:00.000Z")])
+        self.assertEqual([0, 1], [s.id for s in snapshot_manager._expired_snapshots(index, 1)])
+
+    def test_remove_old_snapshots_deletes_all_but_newest(self):
+        connection = MagicMock()
+        volume = MagicMock(id="vol-1")
+        inventory = SnapshotInventory()
+        for day in range(1, 6):
+            inventory.add_snapshot("vol-1", MagicMock(
+                id="snap-{}".format(day), start_time="2018-01-0{}T00:00:00.000Z".format(day)))
+        snapshot_manager._remove_old_snapshots(connection, volume, 2, inventory)
+        self.assertEqual(
+            ["snap-1", "snap-2", "snap-3"],
+            sorted(c[0][0] for c in connection.delete_snapshot.call_args_list))
+        self.assertEqual(["snap-4", "snap-5"], sorted(s.id for s in inventory.get_snapshots("vol-1")))
@@ -0,0 +1,45 @@
+from ebs_snapshots.stagger import Stagger, offset
+import unittest
+from mock import patch
+
+DAY = 24 * 3600
+
+
+class TestStagger(unittest.TestCase):
+
+    def test_offsets_are_stable_and_spread(self):
+        self.assertEqual(offset("vol-1", DAY), offset("vol-1", DAY))
+        offsets = [offset("vol-{}".format(i), DAY) for i in range(1000)]
+        # every hour of the day gets some volumes, none gets most of them
+        hours = [0] * 24
+        for o in offsets:
+            hours[o // 3600] += 1
+        self.assertTrue(min(hours) > 10, hours)
+        self.assertTrue(max(hours) < 80, hours)
+
+    def test_due_at_own_offset_within_one_interval(self):
+        stagger = Stagger()
+        start = offset("vol-1", DAY)
+        for newest in (0, start - 1, start, start + 1, DAY + 5, 10 * DAY + start):
+            due = stagger.due_at("vol-1", DAY, newest)
+            self.assertTrue(newest < due <= newest + DAY, (newest, due))
+            self.assertEqual(start, due % DAY)
+
+    def test_caps_per_slice(self):
+        now = [0]
+        stagger = Stagger(creates_per_minute=2, copies_per_minute=1, clock=lambda: now[0])
+        with patch('ebs_snapshots.stagger.metrics.registry') as registry:
+            self.assertEqual([True, True, False], [stagger.take('create', 'vol-1') for _ in range(3)])
+            self.assertEqual([True, False], [stagger.take('copy', 'vol-1') for _ in range(2)])
+            now[0] = 60
+            self.assertTrue(stagger.take('create', 'vol-1'))
+        registry.inc.assert_any_call('snapshots_deferred_total', kind='create')
+        registry.inc.assert_any_call('snapshots_deferred_total', kind='copy')
+
+    def test_longer_slices_allow_the_per_minute_rate(self):
+        stagger = Stagger(creates_per_minute=2, slice_seconds=300, clock=lambda: 0)
+        self.assertEqual(10, sum(stagger.take('create', 'vol-1') for _ in range(20)))
+
+    def test_no_cap_by_default(self):
+        stagger = Stagger()
+        self.assertTrue(all(stagger.take('create', 'vol-1') for _ in range(100)))